@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""账号池后端模块 - 让同一主机上的多个 worker 进程共享账号槽位和 token
+
+AccountScheduler 在每个进程内负责选号（负载分桶、健康分、熔断），占用槽位时
+再向后端登记租约：
+- local（默认）：只有当前进程，进程内计数即为准，登记总是成功；
+- sqlite：所有 worker 共用一个 WAL 模式的 SQLite 文件，按账号统计未过期的租约数，
+  超过槽位数时登记失败，调度器改选其他账号；登录得到的 token 也写入该文件，
+  其他 worker 定期同步，不必各自登录。
+
+配置项（config.json 中的 account_pool，均可省略）：
+    {"backend": "sqlite", "path": "/tmp/ds2api-pool-<uid>/pool.sqlite3", "sync_interval": 1}
+文件中以明文保存账号 token，目录以 0700、文件以 0600 权限创建。
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import CONFIG, logger
+from .constants import ACCOUNT_POOL_BACKEND, ACCOUNT_POOL_SYNC_INTERVAL
+
+POOL_BACKENDS = ("local", "sqlite")
+
+# 共享后端的 SQLite 操作在其他 worker 持有写锁时最多等待 5 秒，统一在这个单线程执行器中执行，
+# 不占用事件循环和调度器锁；单线程同时保证本进程先归还的租约先于之后的登记生效
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ds2api-pool")
+
+
+def pool_submit(fn, *args):
+    """在账号池执行器中调用后端方法，返回 concurrent.futures.Future"""
+    return _executor.submit(fn, *args)
+
+
+def _default_pool_dir() -> str:
+    """默认的共享账号池目录：按用户区分，同一用户的多个 worker 共用"""
+    suffix = f"-{os.getuid()}" if hasattr(os, "getuid") else ""
+    return os.path.join(tempfile.gettempdir(), f"ds2api-pool{suffix}")
+
+
+def _prepare_private_file(path: str):
+    """以仅当前用户可读写的权限准备 SQLite 文件
+
+    目录不存在时以 0700 创建；主文件预先以 0600 创建（SQLite 创建 -wal/-shm 时沿用主文件的权限），
+    已存在的文件收紧为 0600。文件属于其他用户时 chmod 抛出 OSError，由调用方退回进程内账号池。
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+    for name in (path, f"{path}-wal", f"{path}-shm"):
+        if os.path.exists(name):
+            os.chmod(name, 0o600)
+
+
+def pool_config() -> dict:
+    cfg = CONFIG.get("account_pool", {}) or {}
+    backend = os.getenv("DS2API_POOL_BACKEND") or cfg.get("backend", ACCOUNT_POOL_BACKEND)
+    if backend not in POOL_BACKENDS:
+        logger.warning(f"[account_pool] 未知的账号池后端 {backend}，改用 {ACCOUNT_POOL_BACKEND}")
+        backend = ACCOUNT_POOL_BACKEND
+    return {
+        "backend": backend,
+        "path": os.getenv("DS2API_POOL_PATH")
+        or cfg.get("path")
+        or os.path.join(_default_pool_dir(), "pool.sqlite3"),
+        "sync_interval": float(cfg.get("sync_interval", ACCOUNT_POOL_SYNC_INTERVAL)),
+    }
+
+
+class LocalPoolBackend:
+    """进程内后端：槽位以调度器自身的计数为准"""
+
+    name = "local"
+    shared = False
+
+    def reserve(self, key: str, acc_id: str, capacity: int, owner: str, ttl: float) -> bool:
+        return True
+
+    def release(self, key: str):
+        pass
+
+    def reap(self) -> int:
+        return 0
+
+    def get_token(self, acc_id: str) -> str:
+        return ""
+
+    def put_token(self, acc_id: str, token: str):
+        pass
+
+    def drop_token(self, acc_id: str, token: str):
+        pass
+
+    def changed_tokens(self) -> list:
+        return []
+
+    def remote_load(self) -> dict:
+        return {}
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+class SqlitePoolBackend:
+    """基于 SQLite WAL 的共享后端，适用于同一主机上的多个 uvicorn worker
+
+    每个租约一行（key 由调度器生成，包含进程号），登记时在 BEGIN IMMEDIATE 事务内统计该账号
+    未过期的租约数，保证多个进程不会超额占用槽位。已退出进程留下的租约在回收时清理。
+    """
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._token_version = 0  # 已同步到的 token 版本
+        self.conflicts = 0  # 因其他 worker 占满槽位而登记失败的次数
+        _prepare_private_file(path)
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS leases (
+                key TEXT PRIMARY KEY,
+                acc_id TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                owner TEXT,
+                acquired_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS leases_acc ON leases (acc_id, expires_at);
+            CREATE TABLE IF NOT EXISTS tokens (
+                acc_id TEXT PRIMARY KEY,
+                token TEXT NOT NULL,
+                version INTEGER NOT NULL
+            );
+            """
+        )
+        # 同一 pid 的旧进程（容器重启后 pid 复用）留下的租约不再有效
+        self._conn.execute("DELETE FROM leases WHERE pid = ?", (self.pid,))
+        logger.info(f"[SqlitePoolBackend] 使用共享账号池 {path}")
+
+    def reserve(self, key: str, acc_id: str, capacity: int, owner: str, ttl: float) -> bool:
+        now = time.time()
+        expires_at = now + ttl if ttl > 0 else float("inf")
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                (held,) = self._conn.execute(
+                    "SELECT COUNT(*) FROM leases WHERE acc_id = ? AND expires_at > ?", (acc_id, now)
+                ).fetchone()
+                if held >= capacity:
+                    self._conn.execute("COMMIT")
+                    self.conflicts += 1
+                    return False
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, acc_id, self.pid, owner, now, expires_at),
+                )
+                self._conn.execute("COMMIT")
+                return True
+            except sqlite3.Error as e:
+                self._rollback()
+                # 共享存储不可用时不阻断请求，退化为进程内计数
+                logger.warning(f"[SqlitePoolBackend] 登记租约失败: {e}")
+                return True
+
+    def release(self, key: str):
+        with self._lock:
+            try:
+                self._conn.execute("DELETE FROM leases WHERE key = ?", (key,))
+            except sqlite3.Error as e:
+                logger.warning(f"[SqlitePoolBackend] 归还租约失败: {e}")
+
+    def reap(self) -> int:
+        """清理过期租约和已退出进程的租约"""
+        with self._lock:
+            try:
+                removed = self._conn.execute(
+                    "DELETE FROM leases WHERE expires_at <= ?", (time.time(),)
+                ).rowcount
+                pids = [row[0] for row in self._conn.execute("SELECT DISTINCT pid FROM leases")]
+                for pid in pids:
+                    if pid != self.pid and not _pid_alive(pid):
+                        removed += self._conn.execute(
+                            "DELETE FROM leases WHERE pid = ?", (pid,)
+                        ).rowcount
+                return removed
+            except sqlite3.Error as e:
+                logger.warning(f"[SqlitePoolBackend] 清理租约失败: {e}")
+                return 0
+
+    def get_token(self, acc_id: str) -> str:
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT token FROM tokens WHERE acc_id = ?", (acc_id,)
+                ).fetchone()
+            except sqlite3.Error:
+                return ""
+        return row[0] if row else ""
+
+    def put_token(self, acc_id: str, token: str):
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                (version,) = self._conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM tokens").fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)", (acc_id, token, version)
+                )
+                self._conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                self._rollback()
+                logger.warning(f"[SqlitePoolBackend] 写入 token 失败: {e}")
+
+    def drop_token(self, acc_id: str, token: str):
+        """token 被判定失效时清空，避免其他 worker 再复用它
+
+        保留该行而不是删除，版本号只增不减，其他 worker 的增量同步不会漏掉后续写入。
+        """
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "UPDATE tokens SET token = '' WHERE acc_id = ? AND token = ?", (acc_id, token)
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"[SqlitePoolBackend] 删除 token 失败: {e}")
+
+    def changed_tokens(self) -> list:
+        """自上次同步以来其他 worker 写入的 token [(account_id, token)]"""
+        with self._lock:
+            try:
+                rows = self._conn.execute(
+                    "SELECT acc_id, token, version FROM tokens WHERE version > ? ORDER BY version",
+                    (self._token_version,),
+                ).fetchall()
+            except sqlite3.Error:
+                return []
+            if rows:
+                self._token_version = rows[-1][2]
+        return [(acc_id, token) for acc_id, token, _ in rows if token]
+
+    def remote_load(self) -> dict:
+        """其他进程当前占用的槽位数 {account_id: 数量}"""
+        with self._lock:
+            try:
+                rows = self._conn.execute(
+                    "SELECT acc_id, COUNT(*) FROM leases WHERE pid != ? AND expires_at > ? GROUP BY acc_id",
+                    (self.pid, time.time()),
+                ).fetchall()
+            except sqlite3.Error:
+                return {}
+        return dict(rows)
+
+    def _rollback(self):
+        try:
+            self._conn.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            try:
+                (leases,) = self._conn.execute("SELECT COUNT(*) FROM leases").fetchone()
+                (workers,) = self._conn.execute("SELECT COUNT(DISTINCT pid) FROM leases").fetchone()
+            except sqlite3.Error:
+                leases = workers = None
+        return {
+            "backend": self.name,
+            "path": self.path,
+            "pid": self.pid,
+            "shared_leases": leases,
+            "active_workers": workers,
+            "remote_slots": self.remote_load(),
+            "conflicts": self.conflicts,
+        }
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def create_pool_backend():
+    """按配置创建账号池后端；共享后端初始化失败时退回进程内后端"""
+    cfg = pool_config()
+    if cfg["backend"] == "sqlite":
+        try:
+            return SqlitePoolBackend(cfg["path"])
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"[account_pool] 共享账号池初始化失败，改用进程内账号池: {e}")
+    return LocalPoolBackend()
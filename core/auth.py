@@ -1,30 +1,1113 @@
 # -*- coding: utf-8 -*-
 """账号认证与管理模块 - 轮询(Round-Robin)策略"""
+import asyncio
+import heapq
+import itertools
+import os
 import threading
+import time
+from collections import OrderedDict
+
 from fastapi import HTTPException, Request
 
-from .config import CONFIG, logger
+from .config import CONFIG, IS_VERCEL, logger
+from .constants import (
+    ACCOUNT_MAX_CONCURRENCY,
+    ACCOUNT_WAIT_TIMEOUT,
+    ACCOUNT_WAIT_QUEUE_SIZE,
+    ACCOUNT_BATCH_MIN_SHARE,
+    ACCOUNT_STRATEGY,
+    ACCOUNT_HEALTH_ALPHA,
+    ACCOUNT_HEALTH_PENALTY,
+    ACCOUNT_HEALTH_STALE,
+    ACCOUNT_BREAKER_THRESHOLD,
+    ACCOUNT_BREAKER_COOLDOWN,
+    ACCOUNT_BREAKER_MAX_COOLDOWN,
+    ACCOUNT_BREAKER_PROBE_INTERVAL,
+    ACCOUNT_BREAKER_TRIP_STATUS,
+    TOKEN_REFRESH_INTERVAL,
+    TOKEN_REFRESH_CONCURRENCY,
+    ACCOUNT_LEASE_TTL,
+    ACCOUNT_LEASE_REAP_INTERVAL,
+    ACCOUNT_LEASE_STATUS_LIMIT,
+    ACCOUNT_POOL_MAX_CONFLICTS,
+)
+from .account_pool import LocalPoolBackend, create_pool_backend, pool_config, pool_submit
+from .key_limits import PRIORITY_CLASSES, key_limiter, key_policy
 from .deepseek import login_deepseek_via_account, BASE_HEADERS
 from .utils import get_account_identifier
+from .http_pool import get_pool_stats
+from .session_stock import session_stock
+from .pow import pow_cache, pow_solver
+
+# -------------------------- 全局账号调度器 --------------------------
+def _has_token(account: dict) -> bool:
+    return bool(account.get("token", "").strip())
+
+
+def _account_capacity(account: dict) -> int:
+    """账号可同时承载的对话数：账号的 max_concurrency 优先，其次全局默认值"""
+    default = CONFIG.get("account_max_concurrency", ACCOUNT_MAX_CONCURRENCY)
+    try:
+        return max(1, int(account.get("max_concurrency") or default))
+    except (TypeError, ValueError):
+        return ACCOUNT_MAX_CONCURRENCY
+
+
+ACCOUNT_STRATEGIES = ("round_robin", "least_latency")
+
+
+def _account_strategy() -> str:
+    strategy = CONFIG.get("account_strategy", ACCOUNT_STRATEGY)
+    return strategy if strategy in ACCOUNT_STRATEGIES else ACCOUNT_STRATEGY
+
+
+class AccountHealth:
+    """单个账号的指数加权健康统计：首字节延迟、上游错误率、登录失败率"""
+
+    __slots__ = ("ttfb", "error_rate", "login_failure_rate", "samples", "updated")
+
+    def __init__(self):
+        self.ttfb = 0.0
+        self.error_rate = 0.0
+        self.login_failure_rate = 0.0
+        self.samples = 0
+        self.updated = 0.0
+
+    @staticmethod
+    def _ewma(old: float, value: float, first: bool) -> float:
+        return value if first else old + ACCOUNT_HEALTH_ALPHA * (value - old)
+
+    def record_upstream(self, ok: bool, ttfb: float | None = None):
+        first = self.samples == 0
+        self.error_rate = self._ewma(self.error_rate, 0.0 if ok else 1.0, first)
+        if ok and ttfb is not None:
+            self.ttfb = ttfb if not self.ttfb else self._ewma(self.ttfb, ttfb, False)
+        self.samples += 1
+        self.updated = time.monotonic()
+
+    def record_login(self, ok: bool):
+        self.login_failure_rate = self._ewma(
+            self.login_failure_rate, 0.0 if ok else 1.0, self.samples == 0
+        )
+        self.samples += 1
+        self.updated = time.monotonic()
+
+    def score(self, now: float) -> float:
+        """预估的请求耗时（秒），越小越好；没有样本或样本过期时为 0，让账号优先被探测"""
+        if not self.samples or now - self.updated > ACCOUNT_HEALTH_STALE:
+            return 0.0
+        return self.ttfb + ACCOUNT_HEALTH_PENALTY * (self.error_rate + self.login_failure_rate)
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "ttfb_ms": round(self.ttfb * 1000, 1),
+            "error_rate": round(self.error_rate, 4),
+            "login_failure_rate": round(self.login_failure_rate, 4),
+            "samples": self.samples,
+            "score": round(self.score(now), 4),
+        }
+
+
+def _breaker_config() -> dict:
+    cfg = CONFIG.get("account_breaker", {}) or {}
+    return {
+        "threshold": int(cfg.get("threshold", ACCOUNT_BREAKER_THRESHOLD)),
+        "cooldown": float(cfg.get("cooldown", ACCOUNT_BREAKER_COOLDOWN)),
+        "max_cooldown": float(cfg.get("max_cooldown", ACCOUNT_BREAKER_MAX_COOLDOWN)),
+        "interval": float(cfg.get("interval", ACCOUNT_BREAKER_PROBE_INTERVAL)),
+    }
+
+
+class CircuitBreaker:
+    """单个账号的熔断器：closed（正常）→ open（冷却中，不参与调度）→ half_open（后台探测中）"""
+
+    __slots__ = ("state", "failures", "cooldown", "opened_at", "trips", "reason")
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0  # 连续失败次数
+        self.cooldown = 0.0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.reason = ""
+
+    def open(self, reason: str, cooldown: float):
+        self.state = "open"
+        self.cooldown = cooldown
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self.reason = reason
+
+    def to_dict(self, now: float) -> dict:
+        result = {"state": self.state, "failures": self.failures, "trips": self.trips}
+        if self.state != "closed":
+            result["reason"] = self.reason
+            result["retry_in"] = round(max(0.0, self.opened_at + self.cooldown - now), 1)
+        return result
+
+
+def _lease_config() -> dict:
+    cfg = CONFIG.get("account_lease", {}) or {}
+    return {
+        "ttl": float(cfg.get("ttl", ACCOUNT_LEASE_TTL)),
+        "interval": float(cfg.get("interval", ACCOUNT_LEASE_REAP_INTERVAL)),
+    }
+
+
+class Lease:
+    """账号槽位的租约：请求结束时按 lease_id 归还，超过 TTL 仍未归还的由回收任务收回"""
+
+    __slots__ = ("lease_id", "acc_id", "owner", "acquired_at", "expires_at")
+
+    def __init__(self, lease_id: int, acc_id: str, owner: str, ttl: float):
+        self.lease_id = lease_id
+        self.acc_id = acc_id
+        self.owner = owner
+        self.acquired_at = time.monotonic()
+        self.expires_at = self.acquired_at + ttl if ttl > 0 else float("inf")
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "lease_id": self.lease_id,
+            "account": self.acc_id,
+            "owner": self.owner,
+            "age": round(now - self.acquired_at, 1),
+            "expires_in": round(self.expires_at - now, 1) if self.expires_at != float("inf") else None,
+        }
+
+
+class AccountScheduler:
+    """按并发槽位调度账号
+
+    每个账号有 max_concurrency 个槽位。仍有空闲槽位且已有 token 的账号按当前负载
+    分桶（{负载: OrderedDict[account_id, account]}），acquire 从负载最低的桶中
+    按轮询顺序取出账号，选择和释放的开销只与槽位数有关，与账号总数无关；
+    排除列表使用集合判断。没有 token 的空闲账号单独排队，只有在没有可用的
+    已登录账号时才会被选中（同一时刻只允许一个请求为其登录）。
+
+    least_latency 策略下，在负载最低的桶中取队首两个候选账号（two choices），
+    选择健康分更好的一个；落选的队首账号移到队尾，下次与其他账号比较。
+
+    连续失败或遇到封禁、限流状态码的账号会被熔断：从所有桶中移除，冷却结束后由
+    后台探测任务验证，探测成功才重新参与调度。
+
+    每次占用槽位都登记一个租约（lease_id、占用方、占用时间、TTL），归还时按租约
+    核销，重复归还不会多释放槽位；重载账号配置时未归还的租约继续计入负载。
+
+    没有空闲槽位时请求按调用方 key 的优先级类别排队：释放的槽位优先交给 interactive
+    类，两类都在排队时 batch 类至少分得 batch_share 比例；同一类别内按 key 的权重做
+    加权公平排队（虚拟完成时间 = max(类别虚拟时间, 该 key 上一个请求的完成时间) + 1/权重）。
+    """
+
+    def __init__(self, backend=None):
+        self._lock = threading.Lock()
+        self.backend = backend or LocalPoolBackend()
+        self._ready = {}  # {负载: OrderedDict[account_id, account]}，只包含有空闲槽位的账号
+        self._needs_login = OrderedDict()  # 需要登录的空闲账号
+        self._capacity = {}  # {account_id: 槽位数}
+        self._load = {}  # {account_id: 已占用槽位数}
+        self.in_use = {}  # 至少占用一个槽位的账号 {account_id: account}
+        self.health = {}  # {account_id: AccountHealth}
+        self.breakers = {}  # {account_id: CircuitBreaker}
+        self._blocked = set()  # 熔断中（open / half_open）的账号
+        self._accounts = {}  # {account_id: account}
+        self.leases = {}  # {lease_id: Lease}，按占用先后排列
+        self._held = {}  # {account_id: [lease_id, ...]}
+        self._lease_ids = itertools.count(1)
+        self._expiry = []  # 租约到期堆 [(expires_at, lease_id)]，已归还或续期的条目惰性跳过
+        self.lease_stats = {
+            "granted": 0,
+            "released": 0,
+            "leaked": 0,  # 超过 TTL 未归还、由回收任务收回的租约数
+            "stale_releases": 0,  # 重复归还或归还已回收租约的次数
+        }
+        # 等待账号的请求，按优先级类别分堆 {类别: [(虚拟完成时间, 序号, waiter)]}
+        # waiter 为 (future, loop, enqueued_at, owner, key)
+        self._waiters = {priority: [] for priority in PRIORITY_CLASSES}
+        self._waiter_seq = itertools.count()
+        self._vtime = dict.fromkeys(PRIORITY_CLASSES, 0.0)  # 各类别最近交付的虚拟完成时间
+        self._finish = {}  # {key: 该 key 最近一个等待者的虚拟完成时间}
+        self._batch_credit = 0.0  # 两类都在排队时 batch 类累积的份额
+        self.wait_stats = {
+            "served": 0,  # 排队后拿到账号的请求数
+            "timeouts": 0,
+            "rejected": 0,  # 队列已满被直接拒绝的请求数
+            "total_wait": 0.0,
+            "max_wait": 0.0,
+        }
+        self.class_stats = {
+            priority: {
+                "requests": 0,  # 申请账号的请求数（含无需排队的）
+                "queued": 0,
+                "timeouts": 0,
+                "rejected": 0,
+                "total_wait": 0.0,
+                "max_wait": 0.0,
+            }
+            for priority in PRIORITY_CLASSES
+        }
+
+    def reset(self, accounts: list):
+        """按配置顺序重建队列（没有标识的账号和重复账号会被忽略）
+
+        未归还的租约跨重载保留并继续占用槽位；已删除账号的租约归还时直接核销。
+        """
+        capacity, by_id = {}, {}
+        for account in accounts:
+            acc_id = get_account_identifier(account)
+            if not acc_id or acc_id in capacity:
+                continue
+            capacity[acc_id] = _account_capacity(account)
+            by_id[acc_id] = account
+        with self._lock:
+            # 健康统计和熔断状态跨重载保留，只清理已删除的账号
+            self.health = {k: v for k, v in self.health.items() if k in capacity}
+            self.breakers = {k: v for k, v in self.breakers.items() if k in capacity}
+            self._blocked = {k for k in self._blocked if k in capacity}
+            self._capacity = capacity
+            self._accounts = by_id
+            self._load = {acc_id: len(held) for acc_id, held in self._held.items() if acc_id in capacity}
+            self.in_use = {acc_id: by_id[acc_id] for acc_id in self._load}
+            self._ready = {}
+            self._needs_login = OrderedDict()
+            for acc_id, account in by_id.items():
+                self._place(acc_id, account, self._load.get(acc_id, 0))
+            self._dispatch_locked()
+
+    @staticmethod
+    def _first(bucket: OrderedDict, exclude) -> str | None:
+        for acc_id in bucket:
+            if acc_id not in exclude:
+                return acc_id
+        return None
+
+    def _pick(self, bucket: OrderedDict, exclude, strategy: str) -> str | None:
+        """从桶中选出候选账号：轮询取队首；least_latency 在队首两个候选中取健康分更好的"""
+        if strategy != "least_latency":
+            return self._first(bucket, exclude)
+        candidates = []
+        for acc_id in bucket:
+            if acc_id not in exclude:
+                candidates.append(acc_id)
+                if len(candidates) == 2:
+                    break
+        if len(candidates) < 2:
+            return candidates[0] if candidates else None
+        now = time.monotonic()
+        first, second = candidates
+        if self._score(second, now) < self._score(first, now):
+            bucket.move_to_end(first)
+            return second
+        return first
+
+    def _score(self, acc_id: str, now: float) -> float:
+        health = self.health.get(acc_id)
+        return health.score(now) if health is not None else 0.0
+
+    def record_upstream(
+        self, acc_id: str, ok: bool, ttfb: float | None = None, code=None
+    ) -> bool:
+        """记录一次上游调用结果；ttfb 为从准备请求到收到响应头的秒数
+
+        返回账号是否因此被熔断。
+        """
+        with self._lock:
+            self.health.setdefault(acc_id, AccountHealth()).record_upstream(ok, ttfb)
+            if ok:
+                return self._succeed_locked(acc_id)
+            if code in ACCOUNT_BREAKER_TRIP_STATUS:
+                return self._trip_locked(acc_id, f"status {code}")
+            return self._fail_locked(acc_id, f"code {code}" if code else "request error")
+
+    def record_login(self, acc_id: str, ok: bool) -> bool:
+        """记录登录结果；登录失败说明账号凭据或状态有问题，直接熔断
+
+        登录成功的空闲账号从待登录队列移入可用桶。
+        """
+        with self._lock:
+            self.health.setdefault(acc_id, AccountHealth()).record_login(ok)
+            if not ok:
+                return self._trip_locked(acc_id, "login failed")
+            account = self._needs_login.get(acc_id)
+            if account is not None and _has_token(account):
+                del self._needs_login[acc_id]
+                self._place(acc_id, account, 0)
+                self._dispatch_locked()
+            return self._succeed_locked(acc_id)
+
+    def sync_shared(self, changed: list | None = None) -> list:
+        """同步其他 worker 写入的 token，并为排队中的请求重新尝试选号（共享账号池）
+
+        changed 为后端 changed_tokens() 的结果，由调用方在账号池执行器中取得；省略时直接读取。
+        返回 token 有变化的账号标识。
+        """
+        if changed is None:
+            changed = self.backend.changed_tokens()
+        updated = []
+        with self._lock:
+            for acc_id, token in changed:
+                account = self._accounts.get(acc_id)
+                if account is None or account.get("token", "").strip() == token:
+                    continue
+                account["token"] = token
+                updated.append(acc_id)
+                if acc_id in self._needs_login:
+                    del self._needs_login[acc_id]
+                    self._place(acc_id, account, 0)
+            # 其他 worker 归还的槽位不会通知本进程，定期重试
+            self._dispatch_locked()
+        return updated
+
+    def idle_without_token(self) -> list:
+        """没有 token 的空闲账号 [(account_id, account)]，供后台登录"""
+        with self._lock:
+            return list(self._needs_login.items())
+
+    # ------------------------------------------------------------------
+    # 熔断
+    # ------------------------------------------------------------------
+    def _succeed_locked(self, acc_id: str) -> bool:
+        breaker = self.breakers.get(acc_id)
+        if breaker is not None and breaker.state == "closed":
+            breaker.failures = 0
+        return False
+
+    def _fail_locked(self, acc_id: str, reason: str) -> bool:
+        threshold = _breaker_config()["threshold"]
+        if acc_id not in self._capacity:
+            return False
+        breaker = self.breakers.setdefault(acc_id, CircuitBreaker())
+        breaker.failures += 1
+        if threshold > 0 and breaker.failures >= threshold:
+            return self._trip_locked(acc_id, f"{breaker.failures} consecutive failures ({reason})")
+        return False
+
+    def _trip_locked(self, acc_id: str, reason: str) -> bool:
+        cfg = _breaker_config()
+        if cfg["threshold"] <= 0 or acc_id not in self._capacity:
+            return False
+        breaker = self.breakers.setdefault(acc_id, CircuitBreaker())
+        if breaker.state != "closed":
+            return False
+        breaker.open(reason, cfg["cooldown"])
+        self._blocked.add(acc_id)
+        # 从所有桶中移除；正在使用的槽位照常释放，但不再放回
+        bucket = self._ready.get(self._load.get(acc_id, 0))
+        if bucket is not None and bucket.pop(acc_id, None) is not None and not bucket:
+            del self._ready[self._load.get(acc_id, 0)]
+        self._needs_login.pop(acc_id, None)
+        logger.warning(f"[AccountScheduler] 账号 {acc_id} 已熔断: {reason}，{breaker.cooldown:.0f}s 后探测")
+        return True
+
+    def is_blocked(self, acc_id: str) -> bool:
+        """账号是否因熔断（open / half_open）暂停调度"""
+        return acc_id in self._blocked
+
+    def due_probes(self) -> list:
+        """取出冷却结束的熔断账号并转为 half_open，返回 [(account_id, account)]"""
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            for acc_id in self._blocked:
+                breaker = self.breakers[acc_id]
+                if breaker.state == "open" and now - breaker.opened_at >= breaker.cooldown:
+                    breaker.state = "half_open"
+                    due.append((acc_id, self._accounts.get(acc_id)))
+        return [(acc_id, account) for acc_id, account in due if account is not None]
+
+    def finish_probe(self, acc_id: str, ok: bool):
+        """探测成功时恢复账号，失败时冷却时间翻倍后继续熔断"""
+        with self._lock:
+            breaker = self.breakers.get(acc_id)
+            if breaker is None or breaker.state != "half_open":
+                return
+            if not ok:
+                cfg = _breaker_config()
+                breaker.trips -= 1  # 同一次熔断的延续，不重复计数
+                breaker.open(breaker.reason, min(breaker.cooldown * 2, cfg["max_cooldown"]))
+                logger.info(f"[AccountScheduler] 账号 {acc_id} 探测失败，{breaker.cooldown:.0f}s 后重试")
+                return
+            breaker.state = "closed"
+            breaker.failures = 0
+            self._blocked.discard(acc_id)
+            account = self._accounts.get(acc_id)
+            if account is not None:
+                bucket = self._ready.get(self._load.get(acc_id, 0))
+                if bucket is None or acc_id not in bucket:
+                    self._place(acc_id, account, self._load.get(acc_id, 0))
+                self._dispatch_locked()
+            logger.info(f"[AccountScheduler] 账号 {acc_id} 探测成功，恢复调度")
+
+    def _place(self, acc_id: str, account: dict, load: int):
+        """按当前负载把账号放回对应的桶
+
+        槽位已满的账号不放入任何桶；没有 token 的账号等所有槽位释放后才进入待登录队列。
+        """
+        if acc_id in self._blocked:
+            return
+        if not _has_token(account):
+            if load == 0:
+                self._needs_login[acc_id] = account
+        elif load < self._capacity.get(acc_id, 1):
+            self._ready.setdefault(load, OrderedDict())[acc_id] = account
+
+    def _lease_key(self, lease_id: int) -> str:
+        """共享账号池中的租约键：进程号 + 调度器实例 + 本地租约编号"""
+        return f"{os.getpid()}:{id(self):x}:{lease_id}"
+
+    def _grant(self, acc_id: str, account: dict, owner: str) -> tuple:
+        """占用一个槽位并登记租约，返回 (account_id, account, 是否需要登录, lease_id)
+
+        需要登录的账号不放入任何桶：登录完成并归还前不再分配给其他请求。
+        共享账号池中的登记在调度器锁之外进行，见 _reservation / _revoke。
+        """
+        ttl = _lease_config()["ttl"]
+        lease_id = next(self._lease_ids)
+        load = self._load.get(acc_id, 0) + 1
+        self._load[acc_id] = load
+        self.in_use[acc_id] = account
+        self._place(acc_id, account, load)
+
+        lease = Lease(lease_id, acc_id, owner, ttl)
+        self.leases[lease.lease_id] = lease
+        self._held.setdefault(acc_id, []).append(lease.lease_id)
+        if lease.expires_at != float("inf"):
+            heapq.heappush(self._expiry, (lease.expires_at, lease.lease_id))
+        self.lease_stats["granted"] += 1
+        return acc_id, account, not _has_token(account), lease.lease_id
+
+    def acquire(self, exclude_ids=None, owner: str = "") -> tuple | None:
+        """占用负载最低的账号的一个槽位，返回 (account_id, account, 是否需要登录, lease_id)
+
+        没有可用账号时返回 None。共享账号池中会同步等待登记结果，事件循环中应使用 aacquire。
+        """
+        exclude = set(exclude_ids) if exclude_ids else set()
+        for _ in range(ACCOUNT_POOL_MAX_CONFLICTS + 1):
+            with self._lock:
+                result = self._acquire_locked(exclude, owner)
+            if result is None or not self.backend.shared:
+                return result
+            if pool_submit(self.backend.reserve, *self._reservation(result, owner)).result():
+                return result
+            self._revoke(result[3])
+            exclude.add(result[0])
+        return None
+
+    async def aacquire(self, exclude_ids=None, owner: str = "") -> tuple | None:
+        """acquire 的异步版本：共享账号池的登记在账号池执行器中进行，不阻塞事件循环"""
+        exclude = set(exclude_ids) if exclude_ids else set()
+        for _ in range(ACCOUNT_POOL_MAX_CONFLICTS + 1):
+            with self._lock:
+                result = self._acquire_locked(exclude, owner)
+            if result is None or await self.backend_call("reserve", *self._reservation(result, owner)):
+                return result
+            self._revoke(result[3])
+            exclude.add(result[0])
+        return None
+
+    def _acquire_locked(self, exclude, owner: str = "") -> tuple | None:
+        strategy = _account_strategy()
+        for load in sorted(self._ready):
+            bucket = self._ready[load]
+            while True:
+                acc_id = self._pick(bucket, exclude, strategy)
+                if acc_id is None:
+                    break
+                account = bucket.pop(acc_id)
+                if not _has_token(account):
+                    # token 在排队期间被清除，等槽位全部释放后转入待登录队列
+                    if load == 0:
+                        self._needs_login[acc_id] = account
+                    continue
+                if not bucket:
+                    del self._ready[load]
+                return self._grant(acc_id, account, owner)
+            if not bucket:
+                del self._ready[load]
+
+        acc_id = self._first(self._needs_login, exclude)
+        if acc_id is None:
+            return None
+        return self._grant(acc_id, self._needs_login.pop(acc_id), owner)
+
+    def _reservation(self, result: tuple, owner: str) -> tuple:
+        """共享账号池 reserve() 的参数：(租约键, account_id, 槽位数, 占用方, TTL)"""
+        acc_id, _, _, lease_id = result
+        return self._lease_key(lease_id), acc_id, self._capacity.get(acc_id, 1), owner, _lease_config()["ttl"]
+
+    def _revoke(self, lease_id: int):
+        """撤销共享账号池登记失败（其他 worker 已占满该账号）的本地占用
+
+        账号放回队尾，但不交给等待者，等其他 worker 归还后由定期同步或下一次归还重新分配。
+        """
+        with self._lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                return
+            self.lease_stats["granted"] -= 1
+            self._release_locked(lease, reserved=False)
+
+    def backend_submit(self, method: str, *args):
+        """调用账号池后端而不等待结果：共享后端交给账号池执行器，进程内后端直接调用"""
+        if self.backend.shared:
+            pool_submit(getattr(self.backend, method), *args)
+        else:
+            getattr(self.backend, method)(*args)
+
+    async def backend_call(self, method: str, *args):
+        """调用账号池后端并等待结果：共享后端在账号池执行器中执行，进程内后端直接调用"""
+        if not self.backend.shared:
+            return getattr(self.backend, method)(*args)
+        return await asyncio.wrap_future(pool_submit(getattr(self.backend, method), *args))
+
+    def release(self, account: dict, lease_id: int | None = None) -> bool:
+        """按租约归还一个槽位，账号放回对应桶的队尾
+
+        未指定 lease_id 时归还该账号最早的租约。租约不存在（重复归还或已被回收）时返回 False。
+        """
+        acc_id = get_account_identifier(account)
+        with self._lock:
+            if lease_id is None:
+                held = self._held.get(acc_id)
+                lease_id = held[0] if held else None
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                self.lease_stats["stale_releases"] += 1
+                return False
+            self.lease_stats["released"] += 1
+            self._release_locked(lease)
+            return True
+
+    def _release_locked(self, lease: Lease, reserved: bool = True):
+        """归还租约占用的槽位；reserved 为 False 表示租约未在共享账号池中登记成功"""
+        acc_id = lease.acc_id
+        if reserved and self.backend.shared:
+            pool_submit(self.backend.release, self._lease_key(lease.lease_id))
+        held = self._held[acc_id]
+        held.remove(lease.lease_id)
+        if not held:
+            del self._held[acc_id]
+        if len(self._expiry) > 2 * len(self.leases) + 1024:
+            # 已归还租约的到期条目过多时重建堆
+            self._expiry = [
+                (l.expires_at, l.lease_id) for l in self.leases.values() if l.expires_at != float("inf")
+            ]
+            heapq.heapify(self._expiry)
+        if acc_id not in self._capacity:
+            return  # 账号已从配置中删除
+
+        load = self._load.get(acc_id, 0)
+        bucket = self._ready.get(load)
+        if bucket is not None and bucket.pop(acc_id, None) is not None and not bucket:
+            del self._ready[load]
+        load -= 1
+        if load > 0:
+            self._load[acc_id] = load
+        else:
+            load = 0
+            self._load.pop(acc_id, None)
+            self.in_use.pop(acc_id, None)
+        self._place(acc_id, self._accounts[acc_id], load)
+        if reserved:
+            self._dispatch_locked()
+
+    def reap_expired(self) -> list:
+        """收回超过 TTL 仍未归还的租约，返回被收回的租约
+
+        共享账号池中的过期租约由 LeaseReaper 在账号池执行器中另行清理。
+        """
+        now = time.monotonic()
+        reaped = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                _, lease_id = heapq.heappop(self._expiry)
+                lease = self.leases.pop(lease_id, None)
+                if lease is None:
+                    continue
+                self.lease_stats["leaked"] += 1
+                self._release_locked(lease)
+                reaped.append(lease)
+        for lease in reaped:
+            logger.warning(
+                f"[AccountScheduler] 回收超时租约 #{lease.lease_id}: 账号 {lease.acc_id}, "
+                f"占用方 {lease.owner or '-'}, 已占用 {now - lease.acquired_at:.0f}s"
+            )
+        return reaped
+
+    # ------------------------------------------------------------------
+    # 等待队列
+    # ------------------------------------------------------------------
+    def _next_class_locked(self) -> tuple:
+        """选出下一个交付空闲槽位的类别，返回 (类别, 两类是否都在排队)，没有等待者时类别为 None"""
+        for heap in self._waiters.values():
+            while heap and heap[0][2][0].done():
+                heapq.heappop(heap)
+        interactive, batch = self._waiters["interactive"], self._waiters["batch"]
+        if interactive and batch:
+            share = _wait_queue_config()["batch_share"]
+            return ("batch" if self._batch_credit + share >= 1 - 1e-9 else "interactive"), True
+        if interactive:
+            return "interactive", False
+        return ("batch" if batch else None), False
+
+    def _record_wait_locked(self, priority: str, waited: float):
+        stats = self.class_stats[priority]
+        stats["total_wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+
+    def _dispatch_locked(self):
+        """把空闲槽位按优先级类别和加权公平顺序直接交给等待中的请求"""
+        if not any(self._waiters.values()):
+            return
+        while True:
+            priority, contended = self._next_class_locked()
+            if priority is None:
+                # 队列已清空，重新开始计算虚拟时间
+                self._finish.clear()
+                self._vtime = dict.fromkeys(PRIORITY_CLASSES, 0.0)
+                return
+            heap = self._waiters[priority]
+            tag, _, (future, loop, enqueued_at, owner, _key) = heap[0]
+            result = self._acquire_locked((), owner)
+            if result is None:
+                return
+            heapq.heappop(heap)
+            self._vtime[priority] = tag
+            if contended:
+                self._batch_credit += _wait_queue_config()["batch_share"]
+                if priority == "batch":
+                    self._batch_credit -= 1
+            waited = time.monotonic() - enqueued_at
+            self.wait_stats["served"] += 1
+            self.wait_stats["total_wait"] += waited
+            self.wait_stats["max_wait"] = max(self.wait_stats["max_wait"], waited)
+            self._record_wait_locked(priority, waited)
+            try:
+                loop.call_soon_threadsafe(self._deliver, future, result)
+            except RuntimeError:
+                # 等待者所在的事件循环已关闭，槽位稍后归还
+                threading.Thread(target=self.release, args=(result[1], result[3]), daemon=True).start()
+
+    def _deliver(self, future, result: tuple):
+        """在等待者的事件循环中交付账号；等待者已超时或取消时归还槽位"""
+        if future.done():
+            self.release(result[1], result[3])
+        else:
+            future.set_result(result)
+
+    def _waiting_locked(self) -> int:
+        return sum(1 for heap in self._waiters.values() for entry in heap if not entry[2][0].done())
+
+    async def acquire_wait(
+        self,
+        timeout: float,
+        max_waiters: int,
+        owner: str = "",
+        key: str = "",
+        priority: str = "interactive",
+        weight: float = 1.0,
+    ) -> tuple | None:
+        """占用一个槽位，没有空闲账号时按 key 的优先级类别和权重排队等待最多 timeout 秒
+
+        队列中已有 max_waiters 个请求或等待超时时返回 None。没有配置任何账号时不排队。
+        共享账号池中拿到槽位后在账号池执行器中登记，其他 worker 已占满该账号时换账号或继续排队。
+        """
+        with self._lock:
+            self.class_stats[priority]["requests"] += 1
+        deadline = time.monotonic() + timeout
+        exclude = set()
+        while True:
+            result = await self._wait_slot(
+                max(0.0, deadline - time.monotonic()), max_waiters, owner, key, priority, weight, exclude
+            )
+            if result is None or not self.backend.shared:
+                return result
+            try:
+                reserved = await self.backend_call("reserve", *self._reservation(result, owner))
+            except asyncio.CancelledError:
+                self.release(result[1], result[3])
+                raise
+            if reserved:
+                return result
+            self._revoke(result[3])
+            exclude.add(result[0])
+
+    async def _wait_slot(
+        self,
+        timeout: float,
+        max_waiters: int,
+        owner: str,
+        key: str,
+        priority: str,
+        weight: float,
+        exclude,
+    ) -> tuple | None:
+        """在本进程内占用一个槽位，必要时排队；exclude 只影响不排队直接选号的情况"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            stats = self.class_stats[priority]
+            # 已有请求在排队时新请求也进入队列，由 _dispatch_locked 决定交付顺序
+            if not self._waiting_locked():
+                result = self._acquire_locked(exclude, owner)
+                if result is not None:
+                    self._record_wait_locked(priority, 0.0)
+                    return result
+            if not self._capacity or timeout <= 0:
+                return None
+            if self._waiting_locked() >= max_waiters:
+                self.wait_stats["rejected"] += 1
+                stats["rejected"] += 1
+                return None
+            stats["queued"] += 1
+            tag = max(self._vtime[priority], self._finish.get(key, 0.0)) + 1 / weight
+            self._finish[key] = tag
+            waiter = (loop.create_future(), loop, time.monotonic(), owner, key)
+            entry = (tag, next(self._waiter_seq), waiter)
+            heapq.heappush(self._waiters[priority], entry)
+
+        future = waiter[0]
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return future.result()  # 超时的同时恰好拿到了账号
+            with self._lock:
+                self.wait_stats["timeouts"] += 1
+                stats["timeouts"] += 1
+                self._record_wait_locked(priority, time.monotonic() - waiter[2])
+            return None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                result = future.result()
+                self.release(result[1], result[3])
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            with self._lock:
+                heap = self._waiters[priority]
+                try:
+                    heap.remove(entry)
+                except ValueError:
+                    pass
+                else:
+                    heapq.heapify(heap)
 
-# -------------------------- 全局账号队列 --------------------------
-# 使用列表实现轮询队列，配合线程锁保证并发安全
-account_queue = []  # 可用账号队列
-in_use_accounts = {}  # 正在使用的账号 {account_id: account}
-_queue_lock = threading.Lock()  # 线程锁
+    def wait_queue_status(self) -> dict:
+        with self._lock:
+            served = self.wait_stats["served"]
+            return {
+                "waiting": self._waiting_locked(),
+                "served": served,
+                "timeouts": self.wait_stats["timeouts"],
+                "rejected": self.wait_stats["rejected"],
+                "avg_wait_ms": round(self.wait_stats["total_wait"] * 1000 / served, 2) if served else 0.0,
+                "max_wait_ms": round(self.wait_stats["max_wait"] * 1000, 2),
+                "classes": {
+                    priority: {
+                        "waiting": sum(1 for entry in self._waiters[priority] if not entry[2][0].done()),
+                        "requests": stats["requests"],
+                        "queued": stats["queued"],
+                        "timeouts": stats["timeouts"],
+                        "rejected": stats["rejected"],
+                        "avg_wait_ms": round(stats["total_wait"] * 1000 / stats["requests"], 2)
+                        if stats["requests"] else 0.0,
+                        "max_wait_ms": round(stats["max_wait"] * 1000, 2),
+                    }
+                    for priority, stats in self.class_stats.items()
+                },
+            }
+
+    def available_count(self) -> int:
+        """仍有空闲槽位的账号数"""
+        return sum(len(bucket) for bucket in self._ready.values()) + len(self._needs_login)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            available = [acc_id for load in sorted(self._ready) for acc_id in self._ready[load]]
+            available.extend(self._needs_login)
+            return {
+                "available_accounts": available,
+                "in_use_accounts": list(self.in_use.keys()),
+                "slots": {
+                    acc_id: {"in_use": self._load.get(acc_id, 0), "max": capacity}
+                    for acc_id, capacity in self._capacity.items()
+                },
+                "slots_in_use": sum(self._load.values()),
+                "slots_total": sum(self._capacity.values()),
+                "strategy": _account_strategy(),
+                "health": {acc_id: health.to_dict(now) for acc_id, health in self.health.items()},
+                "breakers": {acc_id: breaker.to_dict(now) for acc_id, breaker in self.breakers.items()},
+                "blocked_accounts": sorted(self._blocked),
+                "leases": {
+                    "active": len(self.leases),
+                    **self.lease_stats,
+                    "oldest_age": round(now - next(iter(self.leases.values())).acquired_at, 1)
+                    if self.leases else 0.0,
+                    "items": [
+                        lease.to_dict(now)
+                        for lease in itertools.islice(self.leases.values(), ACCOUNT_LEASE_STATUS_LIMIT)
+                    ],
+                },
+            }
+
+
+account_scheduler = AccountScheduler(create_pool_backend())
+
+class BreakerProber:
+    """后台探测熔断账号：冷却结束后登录（如需要）并创建一个会话验证账号可用"""
+
+    def __init__(self, scheduler: AccountScheduler):
+        self.scheduler = scheduler
+        self._task = None
+        self._loop = None
+        self.probes = 0
+        self.recovered = 0
+
+    def ensure_started(self):
+        """在当前事件循环中启动后台探测任务（只启动一次）"""
+        if _breaker_config()["threshold"] <= 0:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._task = loop.create_task(self._probe_loop())
+
+    async def probe(self, acc_id: str, account: dict) -> bool:
+        self.probes += 1
+        try:
+            if not _has_token(account):
+                await login_account(account)
+            ok = await session_stock.probe(acc_id, account.get("token", "").strip())
+        except Exception as e:
+            logger.debug(f"[BreakerProber] 账号 {acc_id} 探测异常: {e}")
+            ok = False
+        self.scheduler.finish_probe(acc_id, ok)
+        if ok:
+            self.recovered += 1
+        return ok
+
+    async def _probe_loop(self):
+        while True:
+            cfg = _breaker_config()
+            if cfg["threshold"] <= 0:
+                self._task = None
+                return
+            due = self.scheduler.due_probes()
+            if due:
+                await asyncio.gather(
+                    *(self.probe(acc_id, account) for acc_id, account in due),
+                    return_exceptions=True,
+                )
+            await asyncio.sleep(cfg["interval"])
+
+    def stats(self) -> dict:
+        return {"running": self._task is not None and not self._task.done(),
+                "probes": self.probes, "recovered": self.recovered}
+
+
+breaker_prober = BreakerProber(account_scheduler)
+
+
+def _token_refresh_config() -> dict:
+    cfg = CONFIG.get("token_refresh", {}) or {}
+    default_interval = 0 if IS_VERCEL else TOKEN_REFRESH_INTERVAL
+    return {
+        "interval": float(cfg.get("interval", default_interval)),
+        "concurrency": max(1, int(cfg.get("concurrency", TOKEN_REFRESH_CONCURRENCY))),
+    }
+
+
+class TokenRefresher:
+    """后台为缺少 token 的空闲账号登录，让请求拿到的账号都已有 token
+
+    启动时和 token 被判定失效后（wake）立即检查，其余时间按 interval 轮询。
+    登录与请求路径上的登录共用 single-flight，不会重复登录；登录失败的账号交给熔断器处理。
+    """
+
+    def __init__(self, scheduler: AccountScheduler):
+        self.scheduler = scheduler
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+        self.logins = 0
+        self.failures = 0
+
+    def ensure_started(self):
+        """在当前事件循环中启动后台登录任务（只启动一次）"""
+        if _token_refresh_config()["interval"] <= 0:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._refresh_loop())
+        logger.info("[TokenRefresher] 后台登录任务已启动")
+
+    def wake(self):
+        """有 token 失效时提前唤醒后台任务（可在任意线程调用）"""
+        if self._wakeup is None or self._loop is None or self._loop.is_closed():
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            pass
+
+    async def _login(self, acc_id: str, account: dict, sem: asyncio.Semaphore):
+        async with sem:
+            if _has_token(account):
+                return
+            try:
+                await login_account(account)
+                self.logins += 1
+                logger.info(f"[TokenRefresher] 账号 {acc_id} 后台登录成功")
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"[TokenRefresher] 账号 {acc_id} 后台登录失败: {e}")
+
+    async def refresh_once(self):
+        pending = self.scheduler.idle_without_token()
+        if not pending:
+            return
+        sem = asyncio.Semaphore(_token_refresh_config()["concurrency"])
+        await asyncio.gather(
+            *(self._login(acc_id, account, sem) for acc_id, account in pending),
+            return_exceptions=True,
+        )
+
+    async def _refresh_loop(self):
+        while True:
+            cfg = _token_refresh_config()
+            if cfg["interval"] <= 0:
+                self._task = None
+                return
+            try:
+                await self.refresh_once()
+            except Exception as e:
+                logger.warning(f"[TokenRefresher] 后台登录异常: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), cfg["interval"])
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {"running": self._task is not None and not self._task.done(),
+                "logins": self.logins, "failures": self.failures}
+
+
+token_refresher = TokenRefresher(account_scheduler)
+
+class LeaseReaper:
+    """后台定期收回超过 TTL 仍未归还的账号租约"""
+
+    def __init__(self, scheduler: AccountScheduler):
+        self.scheduler = scheduler
+        self._task = None
+        self._loop = None
+
+    def ensure_started(self):
+        """在当前事件循环中启动后台回收任务（只启动一次）"""
+        if _lease_config()["ttl"] <= 0:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._task = loop.create_task(self._reap_loop())
+
+    async def _reap_loop(self):
+        while True:
+            cfg = _lease_config()
+            if cfg["ttl"] <= 0:
+                self._task = None
+                return
+            try:
+                self.scheduler.reap_expired()
+                if self.scheduler.backend.shared:
+                    shared = await self.scheduler.backend_call("reap")
+                    if shared:
+                        logger.info(f"[LeaseReaper] 共享账号池清理过期租约 {shared} 个")
+            except Exception as e:
+                logger.warning(f"[LeaseReaper] 回收租约异常: {e}")
+            await asyncio.sleep(cfg["interval"])
+
+
+lease_reaper = LeaseReaper(account_scheduler)
+
+
+class SharedPoolSync:
+    """共享账号池的后台同步：拉取其他 worker 刷新的 token，重试排队中的请求"""
+
+    def __init__(self, scheduler: AccountScheduler):
+        self.scheduler = scheduler
+        self._task = None
+        self._loop = None
+        self.synced_tokens = 0
+
+    def ensure_started(self):
+        """在当前事件循环中启动后台同步任务（只启动一次，仅共享账号池）"""
+        if not self.scheduler.backend.shared:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._task = loop.create_task(self._sync_loop())
+
+    async def sync_once(self) -> list:
+        changed = await self.scheduler.backend_call("changed_tokens")
+        updated = self.scheduler.sync_shared(changed)
+        for acc_id in updated:
+            # 依赖旧 token 的预热会话和 PoW 缓存随之失效
+            session_stock.invalidate(acc_id)
+            pow_cache.invalidate(acc_id)
+        self.synced_tokens += len(updated)
+        return updated
+
+    async def _sync_loop(self):
+        while True:
+            try:
+                await self.sync_once()
+            except Exception as e:
+                logger.warning(f"[SharedPoolSync] 同步共享账号池异常: {e}")
+            await asyncio.sleep(pool_config()["sync_interval"])
+
+    def stats(self) -> dict:
+        return {
+            **self.scheduler.backend.stats(),
+            "running": self._task is not None and not self._task.done(),
+            "synced_tokens": self.synced_tokens,
+        }
+
+
+shared_pool_sync = SharedPoolSync(account_scheduler)
 
 claude_api_key_queue = []  # 维护所有可用的Claude API keys
 
 
 def init_account_queue():
     """初始化时从配置加载账号（不再随机排序，保持配置顺序）"""
-    global account_queue, in_use_accounts
-    with _queue_lock:
-        account_queue = CONFIG.get("accounts", [])[:]  # 深拷贝
-        in_use_accounts = {}
-        # 按 token 有无排序：有 token 的账号优先
-        account_queue.sort(key=lambda a: 0 if a.get("token", "").strip() else 1)
-        logger.info(f"[init_account_queue] 初始化 {len(account_queue)} 个账号，轮询模式")
+    account_scheduler.reset(CONFIG.get("accounts", []))
+    logger.info(
+        f"[init_account_queue] 初始化 {account_scheduler.available_count()} 个账号，轮询模式"
+    )
 
 
 def init_claude_api_key_queue():
@@ -43,72 +1126,156 @@ init_claude_api_key_queue()
 
 def get_queue_status() -> dict:
     """获取账号队列状态（用于监控）"""
-    with _queue_lock:
-        # total 应该是配置中的账号总数，而非队列相加（避免状态不一致导致重复计数）
-        total_accounts = len(CONFIG.get("accounts", []))
-        return {
-            "available": len(account_queue),
-            "in_use": len(in_use_accounts),
-            "total": total_accounts,
-            "available_accounts": [get_account_identifier(a) for a in account_queue],
-            "in_use_accounts": list(in_use_accounts.keys()),
-        }
+    snapshot = account_scheduler.snapshot()
+    # total 应该是配置中的账号总数，而非队列相加（避免状态不一致导致重复计数）
+    total_accounts = len(CONFIG.get("accounts", []))
+    return {
+        "available": len(snapshot["available_accounts"]),
+        "in_use": len(snapshot["in_use_accounts"]),
+        "total": total_accounts,
+        **snapshot,
+        "wait_queue": account_scheduler.wait_queue_status(),
+        "breaker_prober": breaker_prober.stats(),
+        "token_refresher": token_refresher.stats(),
+        "account_pool": shared_pool_sync.stats(),
+        "api_keys": key_limiter.stats(),
+        "upstream_sessions": get_pool_stats(),
+        "session_stock": session_stock.stats(),
+        "pow_cache": pow_cache.stats(),
+        "pow_solver": pow_solver.stats(),
+    }
 
 
 # ----------------------------------------------------------------------
 # 账号选择与释放 - 轮询(Round-Robin)策略
 # ----------------------------------------------------------------------
-def choose_new_account(exclude_ids=None):
+def _lease_owner(request: Request) -> str:
+    """租约占用方描述：请求路径与客户端地址，用于排查泄漏"""
+    url = getattr(request, "url", None)
+    client = getattr(request, "client", None)
+    path = getattr(url, "path", "") if url is not None else ""
+    host = getattr(client, "host", "") if client is not None else ""
+    return f"{path}@{host}" if host else path
+
+
+async def choose_new_account(exclude_ids=None, owner: str = ""):
     """轮询选择策略：
-    1. 使用线程锁保证并发安全
-    2. 优先选择队首的有 token 账号
-    3. 从队列头部取出账号（FIFO）
-    4. 请求完成后调用 release_account 将账号放回队尾
+    1. 优先选择有 token 队列的队首账号，其次选择需要登录的账号
+    2. 跳过 exclude_ids 中的账号（已尝试过的账号）
+    3. 请求完成后调用 release_account 按租约将账号放回队尾
+
+    返回 (account, lease_id)，没有可用账号时返回 None。
+    """
+    result = await account_scheduler.aacquire(exclude_ids, owner)
+    if result is None:
+        logger.warning(
+            f"[choose_new_account] 没有可用账号 | 队列: {account_scheduler.available_count()}, "
+            f"使用中: {len(account_scheduler.in_use)}"
+        )
+        return None
+    acc_id, selected, needs_login, lease_id = result
+    logger.info(
+        f"[choose_new_account] 轮询选择({'需登录' if needs_login else '有token'}): {acc_id} "
+        f"| 租约 #{lease_id} | 队列剩余: {account_scheduler.available_count()}"
+    )
+    return selected, lease_id
+
+
+def _wait_queue_config() -> dict:
+    cfg = CONFIG.get("account_queue", {}) or {}
+    return {
+        "timeout": float(cfg.get("timeout", ACCOUNT_WAIT_TIMEOUT)),
+        "max_waiters": int(cfg.get("max_waiters", ACCOUNT_WAIT_QUEUE_SIZE)),
+        "batch_share": min(1.0, max(0.0, float(cfg.get("batch_share", ACCOUNT_BATCH_MIN_SHARE)))),
+    }
+
+
+async def acquire_account(owner: str = "", key: str = ""):
+    """为新请求分配账号；所有账号都忙时按调用方 key 的优先级类别和权重排队等待其他请求释放
+
+    返回 (account, lease_id)，等待超时或等待队列已满时返回 None。
     """
-    if exclude_ids is None:
-        exclude_ids = []
-
-    with _queue_lock:
-        # 第一轮：优先选择已有 token 的账号
-        for i in range(len(account_queue)):
-            acc = account_queue[i]
-            acc_id = get_account_identifier(acc)
-            if acc_id and acc_id not in exclude_ids:
-                if acc.get("token", "").strip():  # 已有 token
-                    selected = account_queue.pop(i)
-                    in_use_accounts[acc_id] = selected
-                    logger.info(f"[choose_new_account] 轮询选择(有token): {acc_id} | 队列剩余: {len(account_queue)}")
-                    return selected
-
-        # 第二轮：选择任意账号（需要登录）
-        for i in range(len(account_queue)):
-            acc = account_queue[i]
-            acc_id = get_account_identifier(acc)
-            if acc_id and acc_id not in exclude_ids:
-                selected = account_queue.pop(i)
-                in_use_accounts[acc_id] = selected
-                logger.info(f"[choose_new_account] 轮询选择(需登录): {acc_id} | 队列剩余: {len(account_queue)}")
-                return selected
-
-        logger.warning(f"[choose_new_account] 没有可用账号 | 队列: {len(account_queue)}, 使用中: {len(in_use_accounts)}")
+    breaker_prober.ensure_started()
+    token_refresher.ensure_started()
+    lease_reaper.ensure_started()
+    shared_pool_sync.ensure_started()
+    cfg = _wait_queue_config()
+    start = time.monotonic()
+    policy = key_policy(key)
+    result = await account_scheduler.acquire_wait(
+        cfg["timeout"], cfg["max_waiters"], owner, key, policy["priority"], policy["weight"]
+    )
+    if result is None:
+        logger.warning(
+            f"[acquire_account] 没有可用账号 | 等待 {time.monotonic() - start:.2f}s, "
+            f"排队: {account_scheduler.wait_queue_status()['waiting']}, 使用中: {len(account_scheduler.in_use)}"
+        )
         return None
+    acc_id, selected, needs_login, lease_id = result
+    logger.info(
+        f"[acquire_account] 轮询选择({'需登录' if needs_login else '有token'}): {acc_id} "
+        f"| 租约 #{lease_id} | 队列剩余: {account_scheduler.available_count()}"
+    )
+    return selected, lease_id
+
 
+async def login_account(account: dict) -> str:
+    """登录账号并记录登录结果到健康统计，失败时抛出原异常
 
-def release_account(account: dict):
-    """将账号重新加入队列末尾（轮询核心：用完放队尾）"""
+    共享账号池中其他 worker 已登录得到的 token 直接复用；本进程登录成功后写入共享池。
+    """
+    acc_id = get_account_identifier(account)
+    shared = await account_scheduler.backend_call("get_token", acc_id)
+    if shared and shared != account.get("token", "").strip():
+        account["token"] = shared
+        account_scheduler.record_login(acc_id, True)
+        logger.info(f"[login_account] 账号 {acc_id} 复用其他 worker 的 token")
+        return shared
+    try:
+        token = await login_deepseek_via_account(account)
+    except Exception:
+        account_scheduler.record_login(acc_id, False)
+        raise
+    await account_scheduler.backend_call("put_token", acc_id, token)
+    account_scheduler.record_login(acc_id, True)
+    return token
+
+
+def report_upstream_result(request: Request, ok: bool, code=None):
+    """记录当前账号本次上游调用的结果与首字节延迟（仅配置模式）
+
+    首字节延迟从 prepare_upstream_call 开始准备会话和 PoW 时计时，到收到补全响应头为止。
+    code 为上游错误码或 HTTP 状态码，用于判断是否立即熔断账号；没有 code 的失败
+    （本地 PoW 求解失败、网络异常等）与账号无关，不计入健康度。
+    """
+    if not getattr(request.state, "use_config_token", False):
+        return
+    if not ok and not code:
+        return
+    account = getattr(request.state, "account", None)
+    if not account:
+        return
+    started = getattr(request.state, "upstream_started", None)
+    ttfb = time.monotonic() - started if ok and started is not None else None
+    account_scheduler.record_upstream(get_account_identifier(account), ok, ttfb, code)
+
+
+def release_account(account: dict, lease_id: int | None = None):
+    """按租约将账号重新加入队列末尾（轮询核心：用完放队尾）"""
     if not account:
         return
     
-    acc_id = get_account_identifier(account)
-    with _queue_lock:
-        # 从使用中移除
-        if acc_id in in_use_accounts:
-            del in_use_accounts[acc_id]
-            # 放回队尾
-            account_queue.append(account)
-            logger.debug(f"[release_account] 释放账号: {acc_id} | 队列长度: {len(account_queue)}")
-        else:
-            logger.warning(f"[release_account] 账号 {acc_id} 不在使用列表中 (可能是因为重置了队列)，跳过释放")
+    if account_scheduler.release(account, lease_id):
+        logger.debug(
+            f"[release_account] 释放账号: {get_account_identifier(account)} "
+            f"| 队列长度: {account_scheduler.available_count()}"
+        )
+        if not _has_token(account):
+            token_refresher.wake()  # token 已失效，由后台重新登录
+    else:
+        logger.warning(
+            f"[release_account] 账号 {get_account_identifier(account)} 的租约 #{lease_id} 已归还或已被回收，跳过释放"
+        )
 
 
 # ----------------------------------------------------------------------
@@ -127,13 +1294,14 @@ def release_claude_api_key(api_key):
 # ----------------------------------------------------------------------
 # 判断调用模式：配置模式 vs 用户自带 token
 # ----------------------------------------------------------------------
-def determine_mode_and_token(request: Request):
+async def determine_mode_and_token(request: Request):
     """
     根据请求头 Authorization 判断使用哪种模式：
     - 如果 Bearer token 出现在 CONFIG["keys"] 中，则为配置模式，从 CONFIG["accounts"] 中随机选择一个账号（排除已尝试账号），
       检查该账号是否已有 token，否则调用登录接口获取；
     - 否则，直接使用请求中的 Bearer 值作为 DeepSeek token。
     结果存入 request.state.deepseek_token；配置模式下同时存入 request.state.account 与 request.state.tried_accounts。
+    配置模式下先按 key_policies 检查调用方 key 的限流策略，超限时抛出带 Retry-After 的 429。
     """
     auth_header = request.headers.get("Authorization", "")
     if not auth_header.startswith("Bearer "):
@@ -144,16 +1312,23 @@ def determine_mode_and_token(request: Request):
     config_keys = CONFIG.get("keys", [])
     if caller_key in config_keys:
         request.state.use_config_token = True
-        request.state.tried_accounts = []  # 初始化已尝试账号
-        selected_account = choose_new_account()
-        if not selected_account:
+        request.state.tried_accounts = set()  # 初始化已尝试账号
+        # 先按 key 限流，超限时不占用账号；放行后占用的并发槽位由路由的 cleanup_account 归还
+        key_limiter.admit(caller_key)
+        request.state.api_key = caller_key
+        request.state.key_slot = caller_key
+        acquired = await acquire_account(_lease_owner(request), caller_key)
+        if not acquired:
             raise HTTPException(
                 status_code=429,
                 detail="No accounts configured or all accounts are busy.",
             )
+        selected_account, request.state.lease_id = acquired
+        # 先登记账号，登录失败时由路由的 cleanup_account 归还租约
+        request.state.account = selected_account
         if not selected_account.get("token", "").strip():
             try:
-                login_deepseek_via_account(selected_account)
+                await login_account(selected_account)
             except Exception as e:
                 logger.error(
                     f"[determine_mode_and_token] 账号 {get_account_identifier(selected_account)} 登录失败：{e}"
@@ -161,25 +1336,48 @@ def determine_mode_and_token(request: Request):
                 raise HTTPException(status_code=500, detail="Account login failed.")
 
         request.state.deepseek_token = selected_account.get("token")
-        request.state.account = selected_account
 
     else:
         request.state.use_config_token = False
         request.state.deepseek_token = caller_key
 
 
+def charge_key_tokens(request: Request, tokens: int):
+    """按本次请求实际消耗的 token 数扣减调用方 key 的额度（仅配置模式）"""
+    key = getattr(request.state, "api_key", None)
+    if key:
+        key_limiter.charge(key, tokens)
+
+
 def get_auth_headers(request: Request) -> dict:
     """返回 DeepSeek 请求所需的公共请求头"""
     return {**BASE_HEADERS, "authorization": f"Bearer {request.state.deepseek_token}"}
 
 
+def get_session_key(request: Request) -> str:
+    """返回上游会话池的 key：配置模式用账号标识，用户自带 token 模式用 token 本身"""
+    if getattr(request.state, "use_config_token", False) and getattr(request.state, "account", None):
+        return get_account_identifier(request.state.account)
+    return request.state.deepseek_token or ""
+
+
 # determine_claude_mode_and_token 已移除（直接使用 determine_mode_and_token）
 
 
 # ----------------------------------------------------------------------
 # Token 刷新机制
 # ----------------------------------------------------------------------
-def refresh_account_token(request: Request) -> bool:
+def _invalidate_token(acc_id: str, account: dict):
+    """清除失效的 token 及依赖它的预热会话和 PoW 缓存；共享账号池中同时删除"""
+    old_token = account.get("token", "").strip()
+    account["token"] = ""
+    session_stock.invalidate(acc_id)
+    pow_cache.invalidate(acc_id)
+    if old_token:
+        account_scheduler.backend_submit("drop_token", acc_id, old_token)
+
+
+async def refresh_account_token(request: Request) -> bool:
     """当 token 过期时，刷新账号 token。
     
     返回 True 表示刷新成功，False 表示刷新失败。
@@ -197,10 +1395,10 @@ def refresh_account_token(request: Request) -> bool:
     logger.info(f"[refresh_account_token] 尝试刷新账号 {acc_id} 的 token")
     
     try:
-        # 清除旧 token
-        account["token"] = ""
+        # 清除旧 token（预热会话随之失效）
+        _invalidate_token(acc_id, account)
         # 重新登录
-        login_deepseek_via_account(account)
+        await login_account(account)
         # 更新 request 状态
         request.state.deepseek_token = account.get("token")
         logger.info(f"[refresh_account_token] 账号 {acc_id} token 刷新成功")
@@ -219,5 +1417,54 @@ def mark_token_invalid(request: Request):
     if account:
         acc_id = get_account_identifier(account)
         logger.warning(f"[mark_token_invalid] 标记账号 {acc_id} 的 token 为无效")
-        account["token"] = ""
+        _invalidate_token(acc_id, account)
+
+
 
+# ----------------------------------------------------------------------
+# 账号故障转移
+# ----------------------------------------------------------------------
+def is_token_error(code, msg: str = "") -> bool:
+    """判断上游错误是否由 token 失效引起"""
+    msg = (msg or "").lower()
+    return code in (40001, 40002, 40003) or "token" in msg or "unauthorized" in msg
+
+
+async def switch_account(request: Request, caller: str = "switch_account") -> bool:
+    """当前账号失败时切换到下一个未尝试过的账号。
+
+    成功时释放旧账号，并更新 request.state.account / deepseek_token；
+    新账号没有 token 时先登录，登录失败则放回队列并继续尝试下一个。
+    没有可切换的账号时返回 False（保留当前账号，由调用方负责释放）。
+    """
+    if not getattr(request.state, "use_config_token", False):
+        return False
+
+    current = request.state.account
+    if not hasattr(request.state, "tried_accounts"):
+        request.state.tried_accounts = set()
+    current_id = get_account_identifier(current)
+    request.state.tried_accounts.add(current_id)
+
+    while True:
+        acquired = await choose_new_account(request.state.tried_accounts, _lease_owner(request))
+        if acquired is None:
+            return False
+
+        new_account, new_lease = acquired
+        new_id = get_account_identifier(new_account)
+        if not new_account.get("token", "").strip():
+            try:
+                await login_account(new_account)
+            except Exception as e:
+                logger.error(f"[{caller}] 账号 {new_id} 登录失败：{e}")
+                request.state.tried_accounts.add(new_id)
+                release_account(new_account, new_lease)
+                continue
+
+        release_account(current, getattr(request.state, "lease_id", None))
+        request.state.lease_id = new_lease
+        request.state.account = new_account
+        request.state.deepseek_token = new_account.get("token")
+        logger.info(f"[{caller}] 账号 {current_id} 切换到 {new_id}")
+        return True
@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 """配置管理模块"""
+import asyncio
 import base64
 import json
 import logging
 import os
 import sys
-
-import transformers
+import tempfile
+import threading
 
 # -------------------------- 获取项目根目录 --------------------------
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -30,11 +31,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger("ds2api")
 
-# -------------------------- 初始化 tokenizer --------------------------
-chat_tokenizer_dir = resolve_path("DS2API_TOKENIZER_DIR", "")
-tokenizer = transformers.AutoTokenizer.from_pretrained(
-    chat_tokenizer_dir, trust_remote_code=True
-)
 
 # ----------------------------------------------------------------------
 # 配置文件的读写函数
@@ -70,23 +66,58 @@ def load_config() -> dict:
         return {}
 
 
+_save_lock = threading.Lock()
+_save_seq = 0  # 最近一次序列化的编号
+_saved_seq = 0  # 已写入文件的最新编号，较旧的快照不再覆盖较新的
+
+
+def _config_from_env() -> bool:
+    return bool(os.getenv("DS2API_CONFIG_JSON") or os.getenv("CONFIG_JSON"))
+
+
+def _snapshot_config(cfg: dict) -> tuple[int, str]:
+    """在调用方线程中序列化配置，避免写文件的线程遍历正在被修改的字典"""
+    global _save_seq
+    text = json.dumps(cfg, ensure_ascii=False, indent=2)
+    with _save_lock:
+        _save_seq += 1
+        return _save_seq, text
+
+
+def _write_config(seq: int, text: str) -> None:
+    """原地写入配置文件（保留单文件挂载和符号链接），多次保存按序列化顺序串行执行"""
+    global _saved_seq
+    with _save_lock:
+        if seq < _saved_seq:
+            return
+        try:
+            with open(CONFIG_PATH, "w", encoding="utf-8") as f:
+                f.write(text)
+            _saved_seq = seq
+        except PermissionError as e:
+            logger.warning(f"[save_config] 配置文件不可写({CONFIG_PATH}): {e}")
+        except Exception as e:
+            logger.exception(f"[save_config] 写入 config.json 失败: {e}")
+
+
 def save_config(cfg: dict) -> None:
     """将配置写回 config.json。
 
     Vercel 环境文件系统通常是只读的；且如果配置来自环境变量，也无法回写。
     所以这里失败不应影响主流程。
     """
-    if os.getenv("DS2API_CONFIG_JSON") or os.getenv("CONFIG_JSON"):
+    if _config_from_env():
         logger.info("[save_config] 配置来自环境变量，跳过写回")
         return
+    _write_config(*_snapshot_config(cfg))
 
-    try:
-        with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-            json.dump(cfg, f, ensure_ascii=False, indent=2)
-    except PermissionError as e:
-        logger.warning(f"[save_config] 配置文件不可写({CONFIG_PATH}): {e}")
-    except Exception as e:
-        logger.exception(f"[save_config] 写入 config.json 失败: {e}")
+
+async def save_config_async(cfg: dict) -> None:
+    """save_config 的异步版本：文件写入放到线程中，不阻塞事件循环"""
+    if _config_from_env():
+        logger.info("[save_config] 配置来自环境变量，跳过写回")
+        return
+    await asyncio.to_thread(_write_config, *_snapshot_config(cfg))
 
 
 # 全局配置
@@ -96,9 +127,104 @@ if not CONFIG:
         "[config] 未加载到有效配置，请提供 config.json（路径可用 DS2API_CONFIG_PATH 指定）或设置环境变量 DS2API_CONFIG_JSON"
     )
 
+# -------------------------- tokenizer（按需加载） --------------------------
+chat_tokenizer_dir = resolve_path("DS2API_TOKENIZER_DIR", "")
+TOKENIZER_BACKENDS = ("transformers", "fast", "heuristic")
+
+_tokenizer = None
+_tokenizer_backend = None
+_tokenizer_lock = threading.Lock()
+
+
+class _FastTokenizer:
+    """tokenizers 库的快速后端（只依赖 tokenizer.json，不导入 transformers）"""
+
+    def __init__(self, tokenizer_dir: str):
+        from tokenizers import Tokenizer
+
+        self._tokenizer = Tokenizer.from_file(os.path.join(tokenizer_dir, "tokenizer.json"))
+
+    def encode(self, text: str) -> list:
+        return self._tokenizer.encode(text, add_special_tokens=False).ids
+
+    def encode_batch(self, texts: list) -> list:
+        return [e.ids for e in self._tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+
+class _TransformersTokenizer:
+    """transformers AutoTokenizer 后端（导入耗时和内存占用都较大）"""
+
+    def __init__(self, tokenizer_dir: str):
+        import transformers
+
+        self._tokenizer = transformers.AutoTokenizer.from_pretrained(
+            tokenizer_dir, trust_remote_code=True
+        )
+
+    def encode(self, text: str) -> list:
+        return self._tokenizer.encode(text, add_special_tokens=False)
+
+    def encode_batch(self, texts: list) -> list:
+        return self._tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+
+def get_tokenizer_backend() -> str:
+    """配置的 tokenizer 后端：transformers / fast / heuristic（默认 fast）"""
+    backend = str((CONFIG.get("tokenizer", {}) or {}).get("backend", "fast")).lower()
+    return backend if backend in TOKENIZER_BACKENDS else "fast"
+
+
+def get_tokenizer():
+    """按需加载 tokenizer，首次调用时才导入依赖
+
+    返回带有 encode / encode_batch 方法的对象；配置为 heuristic 或加载失败时返回 None，
+    调用方应回退到估算方式。
+    """
+    global _tokenizer, _tokenizer_backend
+
+    backend = get_tokenizer_backend()
+    if _tokenizer_backend == backend:
+        return _tokenizer
+
+    with _tokenizer_lock:
+        if _tokenizer_backend == backend:
+            return _tokenizer
+        tokenizer = None
+        if backend != "heuristic":
+            loader = _TransformersTokenizer if backend == "transformers" else _FastTokenizer
+            try:
+                tokenizer = loader(chat_tokenizer_dir)
+                logger.info(f"[tokenizer] 已加载 {backend} tokenizer: {chat_tokenizer_dir}")
+            except Exception as e:
+                logger.warning(f"[tokenizer] 加载 {backend} tokenizer 失败，改用估算方式: {e}")
+        _tokenizer = tokenizer
+        _tokenizer_backend = backend
+    return _tokenizer
+
+
+def peek_tokenizer():
+    """返回已加载的 tokenizer，不触发加载
+
+    尚未加载、配置为 heuristic 或加载失败时返回 None。事件循环中应使用它而不是 get_tokenizer，
+    避免首次加载（transformers 后端需要数秒）阻塞所有请求。
+    """
+    return _tokenizer if _tokenizer_backend == get_tokenizer_backend() else None
+
+
+def tokenizer_resolved() -> bool:
+    """当前配置的 tokenizer 后端是否已经尝试过加载（无论成功与否）"""
+    return _tokenizer_backend == get_tokenizer_backend()
+
+
 # WASM 模块文件路径
 WASM_PATH = resolve_path("DS2API_WASM_PATH", "sha3_wasm_bg.7b9ca65ddd.wasm")
 
+# WASM 预编译产物缓存目录（Vercel 只有 /tmp 可写）；按用户区分，避免与其他用户共用目录
+WASM_CACHE_DIR = os.getenv("DS2API_WASM_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(),
+    f"ds2api-wasm-cache-{os.getuid()}" if hasattr(os, "getuid") else "ds2api-wasm-cache",
+)
+
 # 模板目录
 TEMPLATES_DIR = resolve_path("DS2API_TEMPLATES_DIR", "templates")
 
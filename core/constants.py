@@ -7,6 +7,8 @@
 KEEP_ALIVE_TIMEOUT = 5  # 保活超时（秒）
 STREAM_IDLE_TIMEOUT = 30  # 流无新内容超时（秒）
 MAX_KEEPALIVE_COUNT = 10  # 最大连续 keepalive 次数
+UPSTREAM_RETRY_BACKOFF = 0.5  # 本地或网络故障后用同一账号重试前的等待（秒），按重试次数递增
+NONSTREAM_KEEPALIVE = False  # 非流式响应等待期间是否输出空白保活（可由 config.json 的 nonstream_keepalive 覆盖）
 
 # ----------------------------------------------------------------------
 # DeepSeek API 配置
@@ -17,6 +19,82 @@ DEEPSEEK_CREATE_SESSION_URL = f"https://{DEEPSEEK_HOST}/api/v0/chat_session/crea
 DEEPSEEK_CREATE_POW_URL = f"https://{DEEPSEEK_HOST}/api/v0/chat/create_pow_challenge"
 DEEPSEEK_COMPLETION_URL = f"https://{DEEPSEEK_HOST}/api/v0/chat/completion"
 
+# ----------------------------------------------------------------------
+# 上游 HTTP 客户端配置
+# ----------------------------------------------------------------------
+DEEPSEEK_IMPERSONATE = "safari15_3"  # curl_cffi TLS 指纹模拟
+UPSTREAM_MAX_CLIENTS = 64  # 单个会话（账号）可同时使用的 curl 句柄数（即并发上游请求数）
+UPSTREAM_POOL_MAX_SIZE = 128  # 会话池最多保留的会话（账号）数
+UPSTREAM_POOL_IDLE_TIMEOUT = 300  # 会话空闲多久后关闭（秒）
+
+# ----------------------------------------------------------------------
+# 会话预热默认值（可在 config.json 的 session_prewarm 中覆盖）
+# ----------------------------------------------------------------------
+SESSION_PREWARM_SIZE = 2  # 每个账号预创建的会话数
+SESSION_PREWARM_TTL = 600  # 预创建会话的有效期（秒）
+SESSION_PREWARM_INTERVAL = 5  # 补货间隔（秒）
+SESSION_PREWARM_CONCURRENCY = 4  # 同时补货的账号数
+SESSION_PREWARM_ACTIVE_WINDOW = 300  # 最近多少秒内取用过会话的账号视为活跃
+
+# ----------------------------------------------------------------------
+# PoW 预取默认值（可在 config.json 的 pow_prefetch 中覆盖）
+# ----------------------------------------------------------------------
+POW_PREFETCH_SIZE = 1  # 每个活跃账号缓存的已求解 PoW 数
+POW_PREFETCH_EXPIRE_MARGIN = 20  # 距离过期不足该秒数的 PoW 视为已过期
+POW_PREFETCH_INTERVAL = 2  # 预取间隔（秒）
+POW_PREFETCH_ACTIVE_WINDOW = 300  # 最近多少秒内被使用过的账号视为活跃
+POW_PREFETCH_CONCURRENCY = 2  # 同时预取求解的账号数（求解占用 CPU）
+
+# ----------------------------------------------------------------------
+# WASM 求解器池配置
+# ----------------------------------------------------------------------
+POW_SOLVER_POOL_SIZE = 8  # 最多保留的空闲求解器实例数
+POW_SOLVER_MAX_MEMORY = 16 * 1024 * 1024  # 线性内存超过该字节数的实例用完后重建
+POW_SOLVER_BACKEND = "process"  # 求解后端：process（多进程）或 thread（线程池）
+POW_SOLVER_QUEUE_PER_WORKER = 4  # 每个工作进程允许排队的求解任务数，超出时拒绝
+
+# ----------------------------------------------------------------------
+# Token 计数配置
+# ----------------------------------------------------------------------
+TOKEN_CACHE_SIZE = 4096  # 按内容哈希缓存的文本条数
+TOKEN_MESSAGE_OVERHEAD = 2  # 每条消息的角色标记等额外 token
+TOKEN_STREAM_SEGMENT = 256  # 流式输出攒够该字符数后增量计数
+
+# ----------------------------------------------------------------------
+# 账号调度配置
+# ----------------------------------------------------------------------
+ACCOUNT_MAX_CONCURRENCY = 1  # 每个账号默认允许的并发对话数（可在账号上用 max_concurrency 覆盖）
+ACCOUNT_WAIT_TIMEOUT = 30  # 所有账号都忙时请求最多排队等待的秒数（0 表示不等待）
+ACCOUNT_WAIT_QUEUE_SIZE = 256  # 最多排队等待的请求数，超出时直接返回 429
+ACCOUNT_BATCH_MIN_SHARE = 0.2  # 两类请求都在排队时，batch 类至少分得的空闲账号比例
+ACCOUNT_STRATEGY = "round_robin"  # 账号选择策略：round_robin 或 least_latency
+ACCOUNT_HEALTH_ALPHA = 0.3  # 健康统计的指数加权系数（越大越看重最近的样本）
+ACCOUNT_HEALTH_PENALTY = 5.0  # 错误率、登录失败率为 1 时折算的延迟惩罚（秒）
+ACCOUNT_HEALTH_STALE = 600  # 超过该秒数没有新样本的统计视为过期，账号重新参与探测
+ACCOUNT_BREAKER_THRESHOLD = 3  # 连续失败多少次后熔断账号（0 表示关闭熔断）
+ACCOUNT_BREAKER_COOLDOWN = 30  # 熔断后首次探测前的冷却秒数，探测失败时翻倍
+ACCOUNT_BREAKER_MAX_COOLDOWN = 600  # 冷却时间上限（秒）
+ACCOUNT_BREAKER_PROBE_INTERVAL = 5  # 后台探测任务的检查间隔（秒）
+ACCOUNT_BREAKER_TRIP_STATUS = (403, 429)  # 出现即立即熔断的上游状态码（封禁、限流）
+TOKEN_REFRESH_INTERVAL = 10  # 后台为缺少 token 的空闲账号登录的检查间隔（秒，0 表示关闭）
+TOKEN_REFRESH_CONCURRENCY = 2  # 后台同时登录的账号数
+ACCOUNT_LEASE_TTL = 1800  # 账号租约有效期（秒），超时未归还视为泄漏并由后台回收（0 表示不回收）
+ACCOUNT_LEASE_REAP_INTERVAL = 30  # 租约回收任务的检查间隔（秒）
+ACCOUNT_LEASE_STATUS_LIMIT = 20  # 状态接口中最多列出的租约数（按占用时间从早到晚）
+ACCOUNT_POOL_BACKEND = "local"  # 账号池后端：local（进程内）或 sqlite（多 worker 共享）
+ACCOUNT_POOL_SYNC_INTERVAL = 1  # 共享账号池同步 token、重试排队请求的间隔（秒）
+ACCOUNT_POOL_MAX_CONFLICTS = 8  # 一次选号中最多跳过多少个被其他 worker 占满的账号
+
+# ----------------------------------------------------------------------
+# API Key 限流配置（可在 config.json 的 key_policies 中按 key 覆盖，0 表示不限制）
+# ----------------------------------------------------------------------
+KEY_RATE_LIMIT_RPM = 0  # 每个 key 每分钟允许的请求数
+KEY_MAX_CONCURRENCY = 0  # 每个 key 同时进行中的请求数
+KEY_TOKEN_BUDGET = 0  # 每个 key 在 budget_window 内可消耗的 token 数
+KEY_TOKEN_BUDGET_WINDOW = 86400  # token 额度的恢复周期（秒）
+KEY_PRIORITY = "interactive"  # 排队时的优先级类别：interactive（交互）或 batch（批量）
+KEY_WEIGHT = 1  # 同一类别内按权重公平分配空闲账号
+
 # ----------------------------------------------------------------------
 # 请求头配置
 # ----------------------------------------------------------------------
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 """DeepSeek API 相关逻辑"""
-import time
-from curl_cffi import requests
+import asyncio
+import weakref
+
 from fastapi import HTTPException
 
-from .config import CONFIG, save_config, logger
+from .config import CONFIG, save_config_async, logger
 from .utils import get_account_identifier
+from .http_pool import get_upstream_session
 from .constants import (
     DEEPSEEK_HOST,
     DEEPSEEK_LOGIN_URL,
@@ -19,15 +21,63 @@ from .constants import (
 # get_account_identifier 已移至 core.utils
 
 
+# ----------------------------------------------------------------------
+# 流式响应关闭
+# ----------------------------------------------------------------------
+async def close_response(resp) -> None:
+    """关闭流式响应
+
+    如果流还没有读完，先取消底层传输任务，避免 aclose 一直等到上游生成结束。
+    """
+    if resp is None:
+        return
+    task = getattr(resp, "astream_task", None)
+    if task is not None and not task.done():
+        task.cancel()
+    try:
+        await resp.aclose()
+    except (asyncio.CancelledError, Exception):
+        pass
 
 
 # ----------------------------------------------------------------------
 # 登录函数：支持使用 email 或 mobile 登录
 # ----------------------------------------------------------------------
-def login_deepseek_via_account(account: dict) -> str:
+# 正在进行的登录 {事件循环: {account_id: Task}}，同一账号的并发登录合并为一次
+_login_tasks = weakref.WeakKeyDictionary()
+
+
+def _forget_login(tasks: dict, acc_id: str, task: asyncio.Task):
+    if tasks.get(acc_id) is task:
+        del tasks[acc_id]
+    if not task.cancelled():
+        task.exception()  # 所有等待者都已取消时也要取走异常，避免 "never retrieved" 警告
+
+
+async def login_deepseek_via_account(account: dict) -> str:
     """使用 account 中的 email 或 mobile 登录 DeepSeek，
     成功后将返回的 token 写入 account 并保存至配置文件，返回新 token。
+
+    同一账号已有登录在进行时不再重复请求，直接等待该次登录的结果（single-flight）。
+    登录任务不随某个等待者取消而中断。
     """
+    acc_id = get_account_identifier(account)
+    loop = asyncio.get_running_loop()
+    tasks = _login_tasks.setdefault(loop, {})
+    task = tasks.get(acc_id)
+    if task is None:
+        task = loop.create_task(_login_once(account))
+        tasks[acc_id] = task
+        task.add_done_callback(lambda t: _forget_login(tasks, acc_id, t))
+    else:
+        logger.info(f"[login_deepseek_via_account] 账号 {acc_id} 正在登录，等待同一次登录结果")
+    token = await asyncio.shield(task)
+    # 配置重载后同一账号可能对应不同的字典对象
+    account["token"] = token
+    return token
+
+
+async def _login_once(account: dict) -> str:
     email = account.get("email", "").strip()
     mobile = account.get("mobile", "").strip()
     password = account.get("password", "").strip()
@@ -52,8 +102,8 @@ def login_deepseek_via_account(account: dict) -> str:
             "os": "android",
         }
     try:
-        resp = requests.post(
-            DEEPSEEK_LOGIN_URL, headers=BASE_HEADERS, json=payload, impersonate="safari15_3"
+        resp = await get_upstream_session(get_account_identifier(account)).post(
+            DEEPSEEK_LOGIN_URL, headers=BASE_HEADERS, json=payload
         )
         resp.raise_for_status()
     except Exception as e:
@@ -102,28 +152,39 @@ def login_deepseek_via_account(account: dict) -> str:
             status_code=500, detail="Account login failed: missing token"
         )
     account["token"] = new_token
-    save_config(CONFIG)
+    await save_config_async(CONFIG)
     return new_token
 
 
 # ----------------------------------------------------------------------
 # 封装对话接口调用的重试机制
 # ----------------------------------------------------------------------
-def call_completion_endpoint(payload: dict, headers: dict, max_attempts: int = 3):
-    """调用 DeepSeek 对话接口，支持重试"""
+async def call_completion_endpoint(
+    payload: dict,
+    headers: dict,
+    max_attempts: int = 3,
+    session_key: str = "",
+    failed_statuses: list | None = None,
+):
+    """调用 DeepSeek 对话接口，支持重试
+
+    session_key 用于从会话池借用对应账号的长连接，通常传 get_session_key(request)。
+    failed_statuses 不为 None 时，依次追加每次失败尝试的 HTTP 状态码（网络异常不追加），
+    供调用方向账号调度器报告上游的拒绝。
+    返回流式响应对象，调用方通过 iter_deepseek_events() 读取，用完后调用 close_response() 关闭。
+    """
     attempts = 0
     while attempts < max_attempts:
         try:
-            deepseek_resp = requests.post(
+            deepseek_resp = await get_upstream_session(session_key).post(
                 DEEPSEEK_COMPLETION_URL,
                 headers=headers,
                 json=payload,
                 stream=True,
-                impersonate="safari15_3",
             )
         except Exception as e:
             logger.warning(f"[call_completion_endpoint] 请求异常: {e}")
-            time.sleep(1)
+            await asyncio.sleep(1)
             attempts += 1
             continue
         if deepseek_resp.status_code == 200:
@@ -132,7 +193,9 @@ def call_completion_endpoint(payload: dict, headers: dict, max_attempts: int = 3
             logger.warning(
                 f"[call_completion_endpoint] 调用对话接口失败, 状态码: {deepseek_resp.status_code}"
             )
-            deepseek_resp.close()
-            time.sleep(1)
+            if failed_statuses is not None:
+                failed_statuses.append(deepseek_resp.status_code)
+            await close_response(deepseek_resp)
+            await asyncio.sleep(1)
             attempts += 1
     return None
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""上游 HTTP 会话池模块 - 按账号复用长连接的 curl_cffi AsyncSession
+
+每个 AsyncSession 拥有独立的 curl multi 句柄和连接缓存：
+- 同一账号的 create_session / PoW / completion 请求复用同一条 TLS 连接（keep-alive），
+  省去每次请求的握手开销；
+- 浏览器指纹模拟会通过 ALPN 协商 HTTP/2，上游支持时多个请求在同一连接上多路复用；
+- 不同账号的 cookie 互相隔离。
+
+会话按 LRU 顺序管理，超过空闲时间或超过容量上限时关闭；正在处理请求的会话不会被淘汰。
+"""
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from curl_cffi.requests import AsyncSession
+
+from .config import logger
+from .constants import (
+    DEEPSEEK_IMPERSONATE,
+    UPSTREAM_MAX_CLIENTS,
+    UPSTREAM_POOL_MAX_SIZE,
+    UPSTREAM_POOL_IDLE_TIMEOUT,
+)
+
+_DEFAULT_KEY = "__default__"
+
+
+class UpstreamSessionPool:
+    """绑定单个事件循环的 AsyncSession 池"""
+
+    def __init__(
+        self,
+        max_size: int = UPSTREAM_POOL_MAX_SIZE,
+        idle_timeout: float = UPSTREAM_POOL_IDLE_TIMEOUT,
+    ):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()  # {key: [session, last_used]}
+        self._last_sweep = time.monotonic()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _in_flight(session: AsyncSession) -> int:
+        """正在使用的 curl 句柄数（流式响应未读完时也计入）"""
+        pool = getattr(session, "pool", None)
+        if pool is None:
+            return 0
+        return max(0, session.max_clients - pool.qsize())
+
+    def _close_later(self, key: str, session: AsyncSession, reason: str):
+        self.evicted += 1
+        logger.debug(f"[UpstreamSessionPool] 关闭会话 {key} ({reason})")
+        task = asyncio.get_running_loop().create_task(session.close())
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def _sweep(self, now: float):
+        """关闭空闲超时的会话"""
+        self._last_sweep = now
+        for key, (session, last_used) in list(self._sessions.items()):
+            if now - last_used > self.idle_timeout and not self._in_flight(session):
+                del self._sessions[key]
+                self._close_later(key, session, "idle")
+
+    def _enforce_cap(self):
+        """超过容量时按 LRU 顺序淘汰空闲会话"""
+        for key, (session, _) in list(self._sessions.items()):
+            if len(self._sessions) <= self.max_size:
+                return
+            if not self._in_flight(session):
+                del self._sessions[key]
+                self._close_later(key, session, "capacity")
+
+    def get(self, key: str = "") -> AsyncSession:
+        """借出 key 对应的会话，不存在时创建"""
+        key = key or _DEFAULT_KEY
+        now = time.monotonic()
+        if now - self._last_sweep > min(self.idle_timeout, 60):
+            self._sweep(now)
+
+        entry = self._sessions.get(key)
+        if entry is not None:
+            entry[1] = now
+            self._sessions.move_to_end(key)
+            self.reused += 1
+            return entry[0]
+
+        session = AsyncSession(
+            impersonate=DEEPSEEK_IMPERSONATE,
+            max_clients=UPSTREAM_MAX_CLIENTS,
+        )
+        self._sessions[key] = [session, now]
+        self.created += 1
+        self._enforce_cap()
+        return session
+
+    async def close_all(self):
+        sessions = [entry[0] for entry in self._sessions.values()]
+        self._sessions.clear()
+        for session in sessions:
+            try:
+                await session.close()
+            except Exception as e:
+                logger.warning(f"[UpstreamSessionPool] 关闭会话异常: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "max_size": self.max_size,
+            "in_flight": sum(self._in_flight(entry[0]) for entry in self._sessions.values()),
+            "created": self.created,
+            "reused": self.reused,
+            "evicted": self.evicted,
+        }
+
+
+# AsyncSession 绑定创建它的事件循环，因此按事件循环各维护一个池
+_pools = weakref.WeakKeyDictionary()
+_pools_lock = threading.Lock()
+
+
+def get_session_pool() -> UpstreamSessionPool:
+    """获取当前事件循环的会话池（必须在协程内调用）"""
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(loop)
+            if pool is None:
+                pool = UpstreamSessionPool()
+                _pools[loop] = pool
+    return pool
+
+
+def get_upstream_session(key: str = "") -> AsyncSession:
+    """按账号（或用户 token）借用长连接会话"""
+    return get_session_pool().get(key)
+
+
+def get_pool_stats() -> dict:
+    """汇总所有事件循环的会话池状态（用于监控）"""
+    total = {"sessions": 0, "in_flight": 0, "created": 0, "reused": 0, "evicted": 0}
+    for pool in list(_pools.values()):
+        for k, v in pool.stats().items():
+            if k in total:
+                total[k] += v
+    total["max_size"] = UPSTREAM_POOL_MAX_SIZE
+    return total
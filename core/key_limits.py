@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""API Key 限流模块 - 按调用方 key 限制请求速率、并发数和 token 用量
+
+避免单个调用方占满整个账号池。策略在 config.json 的 key_policies 中按 key 配置，
+"*" 为所有 key 的默认策略，各项为 0 或省略表示不限制：
+    {"key_policies": {
+        "*": {"rpm": 120},
+        "your-api-key-1": {"rpm": 30, "concurrency": 2, "token_budget": 200000, "budget_window": 86400},
+        "your-batch-key": {"priority": "batch", "weight": 2}
+    }}
+- rpm：每分钟请求数，令牌桶实现，允许一分钟额度内的突发；
+- concurrency：同时进行中的请求数（含流式响应）；
+- token_budget：每个 budget_window 秒内可消耗的 token 数，请求结束后按实际用量扣减，
+  额度耗尽后拒绝新请求，直到按速率恢复为正。
+超限时返回 429 并带上 Retry-After 头。
+
+账号池满载排队时还会用到 priority（interactive 或 batch）和 weight（默认 1），
+见 AccountScheduler 的等待队列。
+"""
+import hashlib
+import math
+import threading
+import time
+
+from fastapi import HTTPException
+
+from .config import CONFIG, logger
+from .constants import (
+    KEY_RATE_LIMIT_RPM,
+    KEY_MAX_CONCURRENCY,
+    KEY_TOKEN_BUDGET,
+    KEY_TOKEN_BUDGET_WINDOW,
+    KEY_PRIORITY,
+    KEY_WEIGHT,
+)
+
+PRIORITY_CLASSES = ("interactive", "batch")
+
+
+def key_policy(key: str) -> dict:
+    """合并默认策略与 key 自身的策略"""
+    policies = CONFIG.get("key_policies", {}) or {}
+    merged = {
+        "rpm": KEY_RATE_LIMIT_RPM,
+        "concurrency": KEY_MAX_CONCURRENCY,
+        "token_budget": KEY_TOKEN_BUDGET,
+        "budget_window": KEY_TOKEN_BUDGET_WINDOW,
+        "priority": KEY_PRIORITY,
+        "weight": KEY_WEIGHT,
+    }
+    for name in ("*", key):
+        policy = policies.get(name)
+        if isinstance(policy, dict):
+            merged.update({k: v for k, v in policy.items() if k in merged})
+    if merged["priority"] not in PRIORITY_CLASSES:
+        merged["priority"] = KEY_PRIORITY
+    try:
+        return {
+            "rpm": max(0.0, float(merged["rpm"] or 0)),
+            "concurrency": max(0, int(merged["concurrency"] or 0)),
+            "token_budget": max(0, int(merged["token_budget"] or 0)),
+            "budget_window": max(1.0, float(merged["budget_window"] or KEY_TOKEN_BUDGET_WINDOW)),
+            "priority": merged["priority"],
+            "weight": max(0.01, float(merged["weight"] or KEY_WEIGHT)),
+        }
+    except (TypeError, ValueError):
+        logger.warning(f"[key_policy] key {_preview(key)} 的限流策略无效，不做限制")
+        return {
+            "rpm": 0.0,
+            "concurrency": 0,
+            "token_budget": 0,
+            "budget_window": float(KEY_TOKEN_BUDGET_WINDOW),
+            "priority": merged["priority"],
+            "weight": float(KEY_WEIGHT),
+        }
+
+
+class TokenBucket:
+    """令牌桶：容量 capacity，每秒补充 rate 个；余额可以被扣成负数（按实际用量后扣）"""
+
+    __slots__ = ("rate", "capacity", "level", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = now
+
+    def configure(self, rate: float, capacity: float):
+        """策略变化时调整速率和容量，已有余额不超过新容量"""
+        self.rate = rate
+        self.capacity = capacity
+        self.level = min(self.level, capacity)
+
+    def refill(self, now: float):
+        if now > self.updated:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """余额达到 amount 还需等待的秒数，0 表示现在即可"""
+        self.refill(now)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate if self.rate > 0 else math.inf
+
+    def take(self, amount: float, now: float):
+        self.refill(now)
+        self.level -= amount
+
+    def to_dict(self) -> dict:
+        return {"remaining": round(self.level, 2), "capacity": self.capacity}
+
+
+class KeyUsage:
+    """单个 key 的限流状态与计数"""
+
+    __slots__ = ("requests", "budget", "active", "admitted", "rejected", "tokens")
+
+    def __init__(self):
+        self.requests = None  # 请求速率令牌桶（未配置 rpm 时为 None）
+        self.budget = None  # token 额度令牌桶（未配置 token_budget 时为 None）
+        self.active = 0
+        self.admitted = 0
+        self.rejected = {"rate": 0, "concurrency": 0, "budget": 0}
+        self.tokens = 0
+
+
+class KeyLimiter:
+    """按 API key 执行限流策略：admit 放行并占用并发槽位，leave 归还，charge 扣减 token 额度"""
+
+    def __init__(self):
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bucket(bucket, rate: float, capacity: float, now: float):
+        if capacity <= 0:
+            return None
+        if bucket is None:
+            return TokenBucket(rate, capacity, now)
+        if bucket.rate != rate or bucket.capacity != capacity:
+            bucket.configure(rate, capacity)
+        return bucket
+
+    def _sync_policy(self, usage: KeyUsage, policy: dict, now: float):
+        usage.requests = self._bucket(usage.requests, policy["rpm"] / 60, policy["rpm"], now)
+        usage.budget = self._bucket(
+            usage.budget,
+            policy["token_budget"] / policy["budget_window"],
+            policy["token_budget"],
+            now,
+        )
+
+    def admit(self, key: str):
+        """检查 key 的限流策略，放行时占用一个并发槽位；超限时抛出带 Retry-After 的 429"""
+        policy = key_policy(key)
+        now = time.monotonic()
+        with self._lock:
+            usage = self._usage.get(key)
+            if usage is None:
+                usage = self._usage[key] = KeyUsage()
+            self._sync_policy(usage, policy, now)
+
+            reason = None
+            retry_after = 0.0
+            if policy["concurrency"] and usage.active >= policy["concurrency"]:
+                reason, retry_after = "concurrency", 1.0
+            elif usage.budget is not None and (wait := usage.budget.wait_time(1, now)) > 0:
+                reason, retry_after = "budget", wait
+            elif usage.requests is not None and (wait := usage.requests.wait_time(1, now)) > 0:
+                reason, retry_after = "rate", wait
+            if reason is None:
+                if usage.requests is not None:
+                    usage.requests.take(1, now)
+                usage.active += 1
+                usage.admitted += 1
+                return
+            usage.rejected[reason] += 1
+
+        retry_after = max(1, math.ceil(min(retry_after, policy["budget_window"])))
+        messages = {
+            "rate": "Rate limit exceeded for this API key.",
+            "concurrency": "Too many concurrent requests for this API key.",
+            "budget": "Token budget exhausted for this API key.",
+        }
+        logger.warning(f"[KeyLimiter] key {_preview(key)} 超出限制({reason})，{retry_after}s 后重试")
+        raise HTTPException(
+            status_code=429, detail=messages[reason], headers={"Retry-After": str(retry_after)}
+        )
+
+    def leave(self, key: str):
+        """请求结束，归还并发槽位"""
+        with self._lock:
+            usage = self._usage.get(key)
+            if usage is not None and usage.active > 0:
+                usage.active -= 1
+
+    def charge(self, key: str, tokens: int):
+        """按本次请求实际消耗的 token 数扣减额度"""
+        if tokens <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            usage = self._usage.get(key)
+            if usage is None:
+                return
+            usage.tokens += tokens
+            if usage.budget is not None:
+                usage.budget.take(tokens, now)
+
+    def stats(self) -> dict:
+        """各 key 的用量统计，以 _key_id 代替原始 key，避免在管理接口中泄露 API Key"""
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for key, usage in self._usage.items():
+                item = {
+                    "active": usage.active,
+                    "admitted": usage.admitted,
+                    "rejected": dict(usage.rejected),
+                    "tokens": usage.tokens,
+                }
+                for name in ("requests", "budget"):
+                    bucket = getattr(usage, name)
+                    if bucket is not None:
+                        bucket.refill(now)
+                        item[name] = bucket.to_dict()
+                result[_key_id(key)] = item
+            return result
+
+
+def _preview(key: str) -> str:
+    return key[:8] + "..." if len(key) > 12 else key
+
+
+def _key_id(key: str) -> str:
+    """统计中代替 key 的标识：稳定的短哈希，长 key 再带上前 4 个字符便于辨认"""
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=4).hexdigest()
+    return f"{key[:4]}...{digest}" if len(key) > 12 else digest
+
+
+key_limiter = KeyLimiter()
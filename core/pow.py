@@ -1,16 +1,42 @@
 # -*- coding: utf-8 -*-
 """PoW (Proof of Work) 计算模块"""
+import asyncio
 import base64
 import ctypes
+import hashlib
+import importlib.metadata
 import json
+import multiprocessing
+import os
+import platform
+import stat
 import struct
+import sys
 import threading
 import time
+import types
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from curl_cffi import requests
 from wasmtime import Engine, Linker, Module, Store
 
-from .config import CONFIG, WASM_PATH, logger
+from .config import CONFIG, IS_VERCEL, WASM_CACHE_DIR, WASM_PATH, logger
+from .constants import (
+    BASE_HEADERS,
+    DEEPSEEK_CREATE_POW_URL,
+    POW_PREFETCH_SIZE,
+    POW_PREFETCH_EXPIRE_MARGIN,
+    POW_PREFETCH_INTERVAL,
+    POW_PREFETCH_ACTIVE_WINDOW,
+    POW_PREFETCH_CONCURRENCY,
+    POW_SOLVER_POOL_SIZE,
+    POW_SOLVER_MAX_MEMORY,
+    POW_SOLVER_BACKEND,
+    POW_SOLVER_QUEUE_PER_WORKER,
+    UPSTREAM_RETRY_BACKOFF,
+)
+from .http_pool import get_upstream_session
 from .utils import get_account_identifier
 
 # ----------------------------------------------------------------------
@@ -21,8 +47,86 @@ _wasm_engine = None
 _wasm_module = None
 
 
+def _wasm_cache_paths(wasm_bytes: bytes, wasm_path: str) -> tuple[str, str]:
+    """预编译产物路径：按 WASM 内容、wasmtime 版本和 CPU 架构生成缓存键"""
+    try:
+        wasmtime_version = importlib.metadata.version("wasmtime")
+    except importlib.metadata.PackageNotFoundError:
+        wasmtime_version = "unknown"
+    digest = hashlib.sha256()
+    digest.update(wasm_bytes)
+    digest.update(f"|wasmtime={wasmtime_version}|{platform.machine()}".encode())
+    name = os.path.splitext(os.path.basename(wasm_path))[0]
+    base = os.path.join(WASM_CACHE_DIR, f"{name}.{digest.hexdigest()[:16]}")
+    return base + ".cwasm", base + ".json"
+
+
+def _trusted_cache_dir(directory: str) -> bool:
+    """缓存目录属于当前用户且其他用户不可写时才信任其中的预编译产物
+
+    预编译产物是直接执行的机器码，其他用户事先创建的目录（或符号链接）中的文件可能被替换。
+    """
+    if not hasattr(os, "geteuid"):
+        return True
+    try:
+        st = os.lstat(directory)
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(st.st_mode)
+        and st.st_uid == os.geteuid()
+        and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    )
+
+
+def _load_precompiled(engine: Engine, cwasm_path: str, meta_path: str) -> Module | None:
+    """从缓存文件（mmap）加载预编译模块，不存在、不兼容或缓存目录不可信时返回 None"""
+    if not os.path.exists(cwasm_path):
+        return None
+    if not _trusted_cache_dir(os.path.dirname(cwasm_path)):
+        logger.warning(f"[WASM] 缓存目录 {os.path.dirname(cwasm_path)} 不属于当前用户或可被其他用户写入，跳过预编译缓存")
+        return None
+    start = time.perf_counter()
+    try:
+        module = Module.deserialize_file(engine, cwasm_path)
+    except Exception as e:
+        logger.warning(f"[WASM] 预编译缓存不可用，将重新编译: {e}")
+        return None
+    load_ms = (time.perf_counter() - start) * 1000
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            compile_ms = float(json.load(f)["compile_ms"])
+        logger.info(
+            f"[WASM] 从预编译缓存加载模块 {load_ms:.1f}ms"
+            f"（编译需 {compile_ms:.1f}ms，节省 {compile_ms - load_ms:.1f}ms）"
+        )
+    except Exception:
+        logger.info(f"[WASM] 从预编译缓存加载模块 {load_ms:.1f}ms")
+    return module
+
+
+def _save_precompiled(module: Module, cwasm_path: str, meta_path: str, compile_ms: float):
+    """写入预编译缓存（先写临时文件再原子替换，失败不影响主流程）"""
+    try:
+        os.makedirs(os.path.dirname(cwasm_path), mode=0o700, exist_ok=True)
+        if not _trusted_cache_dir(os.path.dirname(cwasm_path)):
+            logger.warning(f"[WASM] 缓存目录 {os.path.dirname(cwasm_path)} 不可信，不写入预编译缓存")
+            return
+        tmp_path = f"{cwasm_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(module.serialize())
+        os.replace(tmp_path, cwasm_path)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"compile_ms": round(compile_ms, 2)}, f)
+    except Exception as e:
+        logger.warning(f"[WASM] 写入预编译缓存失败: {e}")
+
+
 def _get_cached_wasm_module(wasm_path: str):
-    """获取缓存的 WASM 模块，首次调用时加载"""
+    """获取缓存的 WASM 模块，首次调用时加载
+
+    优先从磁盘上的预编译产物加载，缓存键不匹配时回退到编译并写回缓存。
+    """
     global _wasm_engine, _wasm_module
     
     if _wasm_module is not None:
@@ -36,8 +140,16 @@ def _get_cached_wasm_module(wasm_path: str):
         try:
             with open(wasm_path, "rb") as f:
                 wasm_bytes = f.read()
-            _wasm_engine = Engine()
-            _wasm_module = Module(_wasm_engine, wasm_bytes)
+            engine = Engine()
+            cwasm_path, meta_path = _wasm_cache_paths(wasm_bytes, wasm_path)
+            module = _load_precompiled(engine, cwasm_path, meta_path)
+            if module is None:
+                start = time.perf_counter()
+                module = Module(engine, wasm_bytes)
+                compile_ms = (time.perf_counter() - start) * 1000
+                logger.info(f"[WASM] 编译 WASM 模块 {compile_ms:.1f}ms: {wasm_path}")
+                _save_precompiled(module, cwasm_path, meta_path, compile_ms)
+            _wasm_engine, _wasm_module = engine, module
             logger.info(f"[WASM] 已缓存 WASM 模块: {wasm_path}")
         except Exception as e:
             logger.error(f"[WASM] 加载 WASM 模块失败: {e}")
@@ -55,6 +167,130 @@ except Exception as e:
 # get_account_identifier 已移至 core.utils
 
 
+# ----------------------------------------------------------------------
+# 可复用的 WASM 求解器实例池
+# ----------------------------------------------------------------------
+class WasmSolver:
+    """持有独立 Store 与实例的求解器（同一时刻只能被一个线程使用）
+
+    wasm_solve 会释放传入的字符串，线性内存在多次求解之间被复用；
+    内存增长超过上限时由池丢弃并重建实例。
+    """
+
+    def __init__(self, engine: Engine, module: Module):
+        self.store = Store(engine)
+        instance = Linker(engine).instantiate(self.store, module)
+        exports = instance.exports(self.store)
+        try:
+            self._memory = exports["memory"]
+            self._add_to_stack = exports["__wbindgen_add_to_stack_pointer"]
+            self._alloc = exports["__wbindgen_export_0"]
+            self._wasm_solve = exports["wasm_solve"]
+        except KeyError as e:
+            raise RuntimeError(f"缺少 wasm 导出函数: {e}")
+        self.solves = 0
+
+    def memory_size(self) -> int:
+        return self._memory.data_len(self.store)
+
+    def _base_addr(self) -> int:
+        # 内存增长后基址可能变化，每次读写时重新获取
+        return ctypes.cast(self._memory.data_ptr(self.store), ctypes.c_void_p).value
+
+    def _write_string(self, text: str) -> tuple[int, int]:
+        data = text.encode("utf-8")
+        ptr_val = self._alloc(self.store, len(data), 1)
+        ptr = int(ptr_val.value) if hasattr(ptr_val, "value") else int(ptr_val)
+        ctypes.memmove(self._base_addr() + ptr, data, len(data))
+        return ptr, len(data)
+
+    def solve(self, challenge_str: str, prefix: str, difficulty: int) -> int | None:
+        store = self.store
+        # 1. 申请 16 字节栈空间
+        retptr = self._add_to_stack(store, -16)
+        try:
+            # 2. 编码 challenge 与 prefix 到 wasm 内存中
+            ptr_challenge, len_challenge = self._write_string(challenge_str)
+            ptr_prefix, len_prefix = self._write_string(prefix)
+            # 3. 调用 wasm_solve（注意：difficulty 以 float 形式传入）
+            self._wasm_solve(
+                store,
+                retptr,
+                ptr_challenge,
+                len_challenge,
+                ptr_prefix,
+                len_prefix,
+                float(difficulty),
+            )
+            # 4. 从 retptr 处读取 4 字节状态和 8 字节求解结果
+            result = ctypes.string_at(self._base_addr() + retptr, 16)
+        finally:
+            # 5. 恢复栈指针
+            self._add_to_stack(store, 16)
+        self.solves += 1
+        status = struct.unpack_from("<i", result, 0)[0]
+        if status == 0:
+            return None
+        return int(struct.unpack_from("<d", result, 8)[0])
+
+
+class WasmSolverPool:
+    """线程安全的求解器池：借出空闲实例，用完归还，按需新建"""
+
+    def __init__(self, max_idle: int = POW_SOLVER_POOL_SIZE, max_memory: int = POW_SOLVER_MAX_MEMORY):
+        self.max_idle = max_idle
+        self.max_memory = max_memory
+        self._idle = []
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.rebuilt = 0
+
+    def acquire(self, wasm_path: str = WASM_PATH) -> WasmSolver:
+        with self._lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+        engine, module = _get_cached_wasm_module(wasm_path)
+        solver = WasmSolver(engine, module)
+        with self._lock:
+            self.created += 1
+        return solver
+
+    def release(self, solver: WasmSolver, broken: bool = False):
+        """归还实例；求解出错或内存超限的实例直接丢弃"""
+        if broken or solver.memory_size() > self.max_memory:
+            with self._lock:
+                self.rebuilt += 1
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(solver)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "idle": len(self._idle),
+                "max_idle": self.max_idle,
+                "created": self.created,
+                "reused": self.reused,
+                "rebuilt": self.rebuilt,
+            }
+
+
+solver_pool = WasmSolverPool()
+
+# 启动时预先实例化一个求解器
+try:
+    solver_pool.release(solver_pool.acquire())
+except Exception as e:
+    logger.warning(f"[WASM] 预实例化求解器失败（将在首次使用时重试）: {e}")
+
+
 # ----------------------------------------------------------------------
 # 使用 WASM 模块计算 PoW 答案的辅助函数
 # ----------------------------------------------------------------------
@@ -76,82 +312,507 @@ def compute_pow_answer(
       - 从 wasm 内存中读取状态与求解结果，
       - 若状态非 0，则返回整数形式的答案，否则返回 None。
     
-    优化：使用缓存的 WASM 模块，避免每次请求都重新加载文件。
+    优化：从求解器池借用已实例化的 Store/实例，避免每次请求重新实例化。
     """
     if algorithm != "DeepSeekHashV1":
         raise ValueError(f"不支持的算法：{algorithm}")
     
     prefix = f"{salt}_{expire_at}_"
     
-    # 获取缓存的 WASM 模块（避免重复加载文件）
-    engine, module = _get_cached_wasm_module(wasm_path)
-    
-    # 每次调用创建新的 Store 和实例（必须的，因为 Store 不是线程安全的）
-    store = Store(engine)
-    linker = Linker(engine)
-    instance = linker.instantiate(store, module)
-    exports = instance.exports(store)
-    
+    solver = solver_pool.acquire(wasm_path)
     try:
-        memory = exports["memory"]
-        add_to_stack = exports["__wbindgen_add_to_stack_pointer"]
-        alloc = exports["__wbindgen_export_0"]
-        wasm_solve = exports["wasm_solve"]
-    except KeyError as e:
-        raise RuntimeError(f"缺少 wasm 导出函数: {e}")
-
-    def write_memory(offset: int, data: bytes):
-        size = len(data)
-        base_addr = ctypes.cast(memory.data_ptr(store), ctypes.c_void_p).value
-        ctypes.memmove(base_addr + offset, data, size)
-
-    def read_memory(offset: int, size: int) -> bytes:
-        base_addr = ctypes.cast(memory.data_ptr(store), ctypes.c_void_p).value
-        return ctypes.string_at(base_addr + offset, size)
-
-    def encode_string(text: str):
-        data = text.encode("utf-8")
-        length = len(data)
-        ptr_val = alloc(store, length, 1)
-        ptr = int(ptr_val.value) if hasattr(ptr_val, "value") else int(ptr_val)
-        write_memory(ptr, data)
-        return ptr, length
-
-    # 1. 申请 16 字节栈空间
-    retptr = add_to_stack(store, -16)
-    # 2. 编码 challenge 与 prefix 到 wasm 内存中
-    ptr_challenge, len_challenge = encode_string(challenge_str)
-    ptr_prefix, len_prefix = encode_string(prefix)
-    # 3. 调用 wasm_solve（注意：difficulty 以 float 形式传入）
-    wasm_solve(
-        store,
-        retptr,
-        ptr_challenge,
-        len_challenge,
-        ptr_prefix,
-        len_prefix,
-        float(difficulty),
+        answer = solver.solve(challenge_str, prefix, difficulty)
+    except Exception:
+        solver_pool.release(solver, broken=True)
+        raise
+    solver_pool.release(solver)
+    return answer
+
+
+# ----------------------------------------------------------------------
+# 多进程求解后端
+# ----------------------------------------------------------------------
+class PowQueueFullError(RuntimeError):
+    """求解队列已满"""
+
+
+def _available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _init_solver_worker(wasm_path: str):
+    """工作进程初始化：加载 WASM 模块并预先实例化求解器"""
+    solver_pool.release(solver_pool.acquire(wasm_path))
+
+
+def _timed_solve(args: tuple) -> tuple[int | None, float]:
+    """执行一次求解，返回 (answer, 求解耗时秒数)"""
+    start = time.perf_counter()
+    answer = compute_pow_answer(*args)
+    return answer, time.perf_counter() - start
+
+
+def _solver_mp_context():
+    """求解进程的启动方式：优先 forkserver（服务进程预先导入 core.pow，工作进程从它 fork），否则 spawn"""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["core.pow"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+_spawn_lock = threading.Lock()
+
+
+def _submit(executor: ProcessPoolExecutor, fn, *args):
+    """向求解进程池提交任务
+
+    进程池在提交时按需启动工作进程，而 multiprocessing 会让新进程重新执行主模块
+    （python app.py 启动时即整个应用：路由、账号调度器、共享账号池）。提交期间把 __main__
+    换成空模块，工作进程只导入 core.pow。
+    """
+    with _spawn_lock:
+        main_module = sys.modules["__main__"]
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            return executor.submit(fn, *args)
+        finally:
+            sys.modules["__main__"] = main_module
+
+
+def _solver_config() -> dict:
+    cfg = CONFIG.get("pow_solver", {}) or {}
+    default_backend = "thread" if IS_VERCEL else POW_SOLVER_BACKEND
+    backend = str(cfg.get("backend", default_backend)).lower()
+    workers = int(cfg.get("workers", 0) or 0) or _available_cores()
+    max_queue = int(cfg.get("max_queue", 0) or 0) or workers * POW_SOLVER_QUEUE_PER_WORKER
+    return {
+        "backend": backend if backend in ("process", "thread") else POW_SOLVER_BACKEND,
+        "workers": max(1, workers),
+        "max_queue": max(1, max_queue),
+    }
+
+
+class PowSolver:
+    """PoW 求解调度：process 后端按核数启动工作进程，thread 后端使用默认线程池
+
+    工作进程常驻并各自持有已加载的 WASM 模块；排队任务数超过上限时
+    solve 抛出 PowQueueFullError。进程池无法启动或崩溃时退回线程池。
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._executor_workers = 0
+        self._process_disabled = False
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.solved = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_solve_time = 0.0
+        self.total_wait_time = 0.0
+        self.last_solve_time = 0.0
+        self.max_solve_time = 0.0
+
+    def _get_executor(self, workers: int) -> ProcessPoolExecutor | None:
+        with self._lock:
+            if self._process_disabled:
+                return None
+            if self._executor is not None and self._executor_workers == workers:
+                return self._executor
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=False)
+            try:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=_solver_mp_context(),
+                    initializer=_init_solver_worker,
+                    initargs=(WASM_PATH,),
+                )
+            except Exception as e:
+                logger.warning(f"[PowSolver] 无法创建求解进程池，改用线程池: {e}")
+                self._executor = None
+                self._process_disabled = True
+                return None
+            self._executor_workers = workers
+            logger.info(f"[PowSolver] 求解进程池已创建, workers={workers}")
+            return self._executor
+
+    def _disable_process(self, reason: str):
+        with self._lock:
+            if self._process_disabled:
+                return
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._process_disabled = True
+        logger.error(f"[PowSolver] 求解进程池不可用，改用线程池: {reason}")
+
+    def warm_up(self):
+        """提前创建进程池并让每个工作进程完成初始化（不等待）"""
+        cfg = _solver_config()
+        if cfg["backend"] != "process" or self._executor is not None or self._process_disabled:
+            return
+        executor = self._get_executor(cfg["workers"])
+        if executor is None:
+            return
+        for _ in range(cfg["workers"]):
+            _submit(executor, _available_cores).add_done_callback(lambda f: f.exception())
+
+    async def solve(self, challenge: dict) -> int | None:
+        """求解挑战，返回答案；无解时返回 None"""
+        cfg = _solver_config()
+        if self.pending >= cfg["max_queue"]:
+            self.rejected += 1
+            raise PowQueueFullError(f"PoW 求解队列已满 ({self.pending}/{cfg['max_queue']})")
+
+        args = (
+            challenge["algorithm"],
+            challenge["challenge"],
+            challenge["salt"],
+            challenge.get("difficulty", 144000),
+            challenge.get("expire_at", 1680000000),
+            challenge["signature"],
+            challenge["target_path"],
+            WASM_PATH,
+        )
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            executor = self._get_executor(cfg["workers"]) if cfg["backend"] == "process" else None
+            if executor is not None:
+                try:
+                    answer, solve_time = await asyncio.wrap_future(_submit(executor, _timed_solve, args))
+                except BrokenProcessPool as e:
+                    self._disable_process(str(e))
+                    answer, solve_time = await asyncio.to_thread(_timed_solve, args)
+            else:
+                answer, solve_time = await asyncio.to_thread(_timed_solve, args)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+
+        elapsed = time.perf_counter() - start
+        self.solved += 1
+        self.total_solve_time += solve_time
+        self.total_wait_time += max(0.0, elapsed - solve_time)
+        self.last_solve_time = solve_time
+        self.max_solve_time = max(self.max_solve_time, solve_time)
+        logger.debug(
+            f"[PowSolver] 求解完成: 计算 {solve_time * 1000:.1f}ms, 排队 {(elapsed - solve_time) * 1000:.1f}ms"
+        )
+        return answer
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        cfg = _solver_config()
+        backend = cfg["backend"]
+        if backend == "process" and self._process_disabled:
+            backend = "thread"
+        return {
+            "backend": backend,
+            "workers": cfg["workers"] if backend == "process" else 0,
+            "max_queue": cfg["max_queue"],
+            "pending": self.pending,
+            "solved": self.solved,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "last_solve_ms": round(self.last_solve_time * 1000, 2),
+            "avg_solve_ms": round(self.total_solve_time * 1000 / self.solved, 2) if self.solved else 0.0,
+            "max_solve_ms": round(self.max_solve_time * 1000, 2),
+            "avg_wait_ms": round(self.total_wait_time * 1000 / self.solved, 2) if self.solved else 0.0,
+            "instances": solver_pool.stats(),
+        }
+
+
+pow_solver = PowSolver()
+
+
+# ----------------------------------------------------------------------
+# PoW 挑战获取与求解
+# ----------------------------------------------------------------------
+async def fetch_pow_challenge(headers: dict, session_key: str = "") -> tuple[int, dict]:
+    """向 DeepSeek 申请 PoW 挑战，返回 (HTTP 状态码, 响应 JSON)
+
+    请求异常直接抛出；JSON 解析失败时返回空字典。
+    """
+    resp = await get_upstream_session(session_key).post(
+        DEEPSEEK_CREATE_POW_URL,
+        headers=headers,
+        json={"target_path": "/api/v0/chat/completion"},
+        timeout=30,
     )
-    # 4. 从 retptr 处读取 4 字节状态和 8 字节求解结果
-    status_bytes = read_memory(retptr, 4)
-    if len(status_bytes) != 4:
-        add_to_stack(store, 16)
-        raise RuntimeError("读取状态字节失败")
-    status = struct.unpack("<i", status_bytes)[0]
-    value_bytes = read_memory(retptr + 8, 8)
-    if len(value_bytes) != 8:
-        add_to_stack(store, 16)
-        raise RuntimeError("读取结果字节失败")
-    value = struct.unpack("<d", value_bytes)[0]
-    # 5. 恢复栈指针
-    add_to_stack(store, 16)
-    if status == 0:
+    try:
+        data = resp.json()
+    except Exception as e:
+        logger.error(f"[fetch_pow_challenge] JSON解析异常: {e}")
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    return resp.status_code, data
+
+
+async def solve_pow_challenge(challenge: dict) -> str | None:
+    """求解挑战并编码为 x-ds-pow-response 请求头，求解失败返回 None
+
+    求解交给 pow_solver 在工作进程（或线程池）中执行，避免阻塞事件循环。
+    """
+    try:
+        answer = await pow_solver.solve(challenge)
+    except Exception as e:
+        logger.error(f"[solve_pow_challenge] PoW 答案计算异常: {e}")
         return None
-    return int(value)
+    if answer is None:
+        return None
+    pow_dict = {
+        "algorithm": challenge["algorithm"],
+        "challenge": challenge["challenge"],
+        "salt": challenge["salt"],
+        "answer": answer,
+        "signature": challenge["signature"],
+        "target_path": challenge["target_path"],
+    }
+    pow_str = json.dumps(pow_dict, separators=(",", ":"), ensure_ascii=False)
+    return base64.b64encode(pow_str.encode("utf-8")).decode("utf-8").rstrip()
+
+
+def _expire_seconds(expire_at) -> float:
+    """expire_at 可能是秒或毫秒时间戳，统一换算为秒"""
+    try:
+        value = float(expire_at)
+    except (TypeError, ValueError):
+        return 0.0
+    return value / 1000 if value > 1e11 else value
+
+
+# ----------------------------------------------------------------------
+# PoW 预取缓存 - 为活跃账号提前获取并求解挑战
+# ----------------------------------------------------------------------
+def _prefetch_config() -> dict:
+    """配置项（config.json 中的 pow_prefetch，均可省略）：
+    {"size": 1, "margin": 20, "interval": 2, "active_window": 300, "concurrency": 2}
+    size 为 0 时关闭预取；Vercel 环境默认关闭。
+    """
+    cfg = CONFIG.get("pow_prefetch", {}) or {}
+    default_size = 0 if IS_VERCEL else POW_PREFETCH_SIZE
+    return {
+        "size": max(0, int(cfg.get("size", default_size))),
+        "margin": float(cfg.get("margin", POW_PREFETCH_EXPIRE_MARGIN)),
+        "interval": float(cfg.get("interval", POW_PREFETCH_INTERVAL)),
+        "active_window": float(cfg.get("active_window", POW_PREFETCH_ACTIVE_WINDOW)),
+        "concurrency": max(1, int(cfg.get("concurrency", POW_PREFETCH_CONCURRENCY))),
+    }
+
+
+class PowCache:
+    """按账号缓存已求解的 PoW 请求头：{account_id: deque[(header, token, expire_ts)]}
+
+    只为最近使用过（active_window 内）的账号预取，距离过期不足 margin 秒的条目会被丢弃。
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self._active = {}  # {account_id: 最近一次取用时间}
+        self._filling = set()
+        self._task = None
+        self._loop = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+        self.solved = 0
+        self.failed = 0
+
+    def take(self, acc_id: str, token: str) -> str | None:
+        """取出一个未过期的 PoW 请求头，并把账号标记为活跃"""
+        self._active[acc_id] = time.time()
+        self.ensure_started()
+        entries = self._cache.get(acc_id)
+        margin = _prefetch_config()["margin"]
+        now = time.time()
+        while entries:
+            header, entry_token, expire_ts = entries.popleft()
+            if entry_token != token:
+                self.invalidated += 1
+                continue
+            if expire_ts - now < margin:
+                self.expired += 1
+                continue
+            self.hits += 1
+            return header
+        self.misses += 1
+        return None
+
+    def invalidate(self, acc_id: str):
+        entries = self._cache.pop(acc_id, None)
+        if entries:
+            self.invalidated += len(entries)
+
+    def ensure_started(self):
+        """在当前事件循环中启动后台预取任务（只启动一次）"""
+        if _prefetch_config()["size"] <= 0:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._filling.clear()
+        self._task = loop.create_task(self._prefetch_loop())
+        logger.info("[pow_cache] PoW 预取任务已启动")
 
+    async def _fill_account(self, account: dict, cfg: dict, sem: asyncio.Semaphore):
+        acc_id = get_account_identifier(account)
+        try:
+            async with sem:
+                entries = self._cache.setdefault(acc_id, deque())
+                now = time.time()
+                while entries and entries[0][2] - now < cfg["margin"]:
+                    entries.popleft()
+                    self.expired += 1
+                while len(entries) < cfg["size"]:
+                    token = account.get("token", "").strip()
+                    if not token:
+                        return
+                    headers = {**BASE_HEADERS, "authorization": f"Bearer {token}"}
+                    try:
+                        status_code, data = await fetch_pow_challenge(headers, acc_id)
+                    except Exception as e:
+                        logger.debug(f"[pow_cache] 账号 {acc_id} 预取挑战异常: {e}")
+                        self.failed += 1
+                        return
+                    if status_code != 200 or data.get("code") != 0:
+                        self.failed += 1
+                        return
+                    challenge = data["data"]["biz_data"]["challenge"]
+                    header = await solve_pow_challenge(challenge)
+                    if not header:
+                        self.failed += 1
+                        return
+                    if account.get("token", "").strip() != token:
+                        return
+                    self.solved += 1
+                    entries.append((header, token, _expire_seconds(challenge.get("expire_at"))))
+        finally:
+            self._filling.discard(acc_id)
+
+    async def _prefetch_round(self, cfg: dict):
+        """预取一轮：清理不再活跃的账号，为活跃且未熔断的账号补足缓存"""
+        from .auth import account_scheduler
+
+        now = time.time()
+        for acc_id, last_used in list(self._active.items()):
+            if now - last_used > cfg["active_window"]:
+                del self._active[acc_id]
+                self._cache.pop(acc_id, None)
+        sem = asyncio.Semaphore(cfg["concurrency"])
+        jobs = []
+        for account in CONFIG.get("accounts", []):
+            acc_id = get_account_identifier(account)
+            if acc_id not in self._active or acc_id in self._filling:
+                continue
+            # 熔断冷却中的账号不预取，避免持续请求被限流的账号
+            if account_scheduler.is_blocked(acc_id):
+                continue
+            self._filling.add(acc_id)
+            jobs.append(self._fill_account(account, cfg, sem))
+        if jobs:
+            await asyncio.gather(*jobs, return_exceptions=True)
+
+    async def _prefetch_loop(self):
+        while True:
+            cfg = _prefetch_config()
+            if cfg["size"] <= 0:
+                self._task = None
+                return
+            try:
+                await self._prefetch_round(cfg)
+            except Exception as e:
+                logger.warning(f"[pow_cache] 预取异常: {e}")
+            await asyncio.sleep(cfg["interval"])
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": _prefetch_config()["size"] > 0,
+            "active_accounts": len(self._active),
+            "cached": {acc_id: len(entries) for acc_id, entries in self._cache.items()},
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "expired": self.expired,
+            "invalidated": self.invalidated,
+            "solved": self.solved,
+            "failed": self.failed,
+        }
+
+
+pow_cache = PowCache()
+
+
+async def get_pow_once(request) -> tuple[str | None, int | None, str]:
+    """用当前账号获取一次 PoW（不做重试和账号切换）
+
+    配置模式下优先使用预取缓存中已求解的请求头。
+
+    Returns:
+        (pow_header, code, msg)，成功时 pow_header 非空
+    """
+    from .auth import get_auth_headers, get_session_key
+
+    pow_solver.warm_up()  # 首次调用时在请求挑战期间提前启动工作进程
+    if request.state.use_config_token:
+        cached = pow_cache.take(
+            get_account_identifier(request.state.account), request.state.deepseek_token
+        )
+        if cached:
+            return cached, 0, ""
+
+    try:
+        status_code, data = await fetch_pow_challenge(
+            get_auth_headers(request), get_session_key(request)
+        )
+    except Exception as e:
+        logger.error(f"[get_pow_response] 请求异常: {e}")
+        return None, None, str(e)
+    if status_code == 200 and data.get("code") == 0:
+        try:
+            challenge = data["data"]["biz_data"]["challenge"]
+        except (KeyError, TypeError):
+            challenge = None
+        if not challenge:
+            # 上游接受了请求但响应格式异常，不是对账号的拒绝，不返回错误码
+            logger.warning(f"[get_pow_response] 响应中缺少 PoW 挑战: {data}")
+            return None, None, "响应中缺少 PoW 挑战"
+        encoded = await solve_pow_challenge(challenge)
+        if encoded is None:
+            logger.warning("[get_pow_response] PoW 答案计算失败")
+            return None, 0, "PoW 答案计算失败"
+        return encoded, 0, ""
+    # 没有业务错误码时（如 403/429 返回的非 JSON 响应）用 HTTP 状态码代替，便于熔断与切换账号；
+    # HTTP 200 却没有业务错误码属于响应格式异常，不算上游拒绝
+    code = data.get("code") or (status_code if status_code != 200 else None)
+    msg = data.get("msg", "")
+    logger.warning(f"[get_pow_response] 获取 PoW 失败, code={code}, msg={msg}")
+    return None, code, msg
 
-def get_pow_response(request, max_attempts: int = 3):
+
+async def get_pow_response(request, max_attempts: int = 3):
     """获取 PoW 响应
+
+    获取失败时，配置模式下切换账号重试。
     
     Args:
         request: FastAPI 请求对象
@@ -160,94 +821,19 @@ def get_pow_response(request, max_attempts: int = 3):
     Returns:
         Base64 编码的 PoW 响应，如果失败返回 None
     """
-    from .auth import get_auth_headers, choose_new_account
-    from .deepseek import BASE_HEADERS, login_deepseek_via_account, DEEPSEEK_CREATE_POW_URL
-    
-    pow_url = DEEPSEEK_CREATE_POW_URL
-    
+    from .auth import switch_account
+
     attempts = 0
     while attempts < max_attempts:
-        headers = get_auth_headers(request)
-        try:
-            resp = requests.post(
-                pow_url,
-                headers=headers,
-                json={"target_path": "/api/v0/chat/completion"},
-                timeout=30,
-                impersonate="safari15_3",
-            )
-        except Exception as e:
-            logger.error(f"[get_pow_response] 请求异常: {e}")
-            attempts += 1
-            continue
-        try:
-            data = resp.json()
-        except Exception as e:
-            logger.error(f"[get_pow_response] JSON解析异常: {e}")
-            data = {}
-        if resp.status_code == 200 and data.get("code") == 0:
-            challenge = data["data"]["biz_data"]["challenge"]
-            difficulty = challenge.get("difficulty", 144000)
-            expire_at = challenge.get("expire_at", 1680000000)
-            try:
-                answer = compute_pow_answer(
-                    challenge["algorithm"],
-                    challenge["challenge"],
-                    challenge["salt"],
-                    difficulty,
-                    expire_at,
-                    challenge["signature"],
-                    challenge["target_path"],
-                    WASM_PATH,
-                )
-            except Exception as e:
-                logger.error(f"[get_pow_response] PoW 答案计算异常: {e}")
-                answer = None
-            if answer is None:
-                logger.warning("[get_pow_response] PoW 答案计算失败，重试中...")
-                resp.close()
-                attempts += 1
-                continue
-            pow_dict = {
-                "algorithm": challenge["algorithm"],
-                "challenge": challenge["challenge"],
-                "salt": challenge["salt"],
-                "answer": answer,
-                "signature": challenge["signature"],
-                "target_path": challenge["target_path"],
-            }
-            pow_str = json.dumps(pow_dict, separators=(",", ":"), ensure_ascii=False)
-            encoded = base64.b64encode(pow_str.encode("utf-8")).decode("utf-8").rstrip()
-            resp.close()
-            return encoded
-        else:
-            code = data.get("code")
-            logger.warning(
-                f"[get_pow_response] 获取 PoW 失败, code={code}, msg={data.get('msg')}"
-            )
-            resp.close()
-            if request.state.use_config_token:
-                current_id = get_account_identifier(request.state.account)
-                if not hasattr(request.state, "tried_accounts"):
-                    request.state.tried_accounts = []
-                if current_id not in request.state.tried_accounts:
-                    request.state.tried_accounts.append(current_id)
-                new_account = choose_new_account(request.state.tried_accounts)
-                if new_account is None:
-                    break
-                try:
-                    login_deepseek_via_account(new_account)
-                except Exception as e:
-                    logger.error(
-                        f"[get_pow_response] 账号 {get_account_identifier(new_account)} 登录失败：{e}"
-                    )
-                    attempts += 1
-                    continue
-                request.state.account = new_account
-                request.state.deepseek_token = new_account.get("token")
-            else:
-                attempts += 1
-                continue
-            attempts += 1
+        pow_resp, code, _ = await get_pow_once(request)
+        if pow_resp:
+            return pow_resp
+        attempts += 1
+        # 求解失败（code == 0）或请求异常时退避后用同一账号重试，上游拒绝时切换账号
+        if not code:
+            if attempts < max_attempts:
+                await asyncio.sleep(UPSTREAM_RETRY_BACKOFF * attempts)
+        elif request.state.use_config_token:
+            if not await switch_account(request, "get_pow_response"):
+                break
     return None
-
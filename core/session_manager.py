@@ -1,165 +1,172 @@
 # -*- coding: utf-8 -*-
 """会话管理模块 - 封装公共的会话创建和 PoW 获取逻辑"""
-from curl_cffi import requests as cffi_requests
+import asyncio
+import time
+
 from fastapi import HTTPException, Request
 
 from .config import logger
+from .constants import UPSTREAM_RETRY_BACKOFF
 from .utils import get_account_identifier
 from .models import get_model_config
 from .auth import (
     get_auth_headers,
-    choose_new_account,
+    get_session_key,
     release_account,
     refresh_account_token,
+    switch_account,
+    is_token_error,
+    report_upstream_result,
 )
-from .deepseek import (
-    DEEPSEEK_CREATE_SESSION_URL,
-    DEEPSEEK_CREATE_POW_URL,
-    login_deepseek_via_account,
-    call_completion_endpoint,
-)
-from .pow import get_pow_response
+from .key_limits import key_limiter
+from .deepseek import DEEPSEEK_CREATE_SESSION_URL
+from .pow import get_pow_once
+from .http_pool import get_upstream_session
+from .session_stock import session_stock
+
+
+async def _create_session_once(request: Request) -> tuple[str | None, int | None, str]:
+    """用当前账号创建一次会话（不做重试和账号切换）
+
+    配置模式下优先使用预热的会话。
+
+    Returns:
+        (session_id, code, msg)，成功时 session_id 非空；请求异常时 code 为 None
+    """
+    if request.state.use_config_token:
+        session_id = session_stock.take(
+            get_account_identifier(request.state.account), request.state.deepseek_token
+        )
+        if session_id:
+            return session_id, 0, ""
+
+    try:
+        resp = await get_upstream_session(get_session_key(request)).post(
+            DEEPSEEK_CREATE_SESSION_URL,
+            headers=get_auth_headers(request),
+            json={"agent": "chat"},
+        )
+    except Exception as e:
+        logger.error(f"[create_session] 请求异常: {e}")
+        return None, None, str(e)
+
+    try:
+        data = resp.json()
+    except Exception as e:
+        logger.error(f"[create_session] JSON解析异常: {e}")
+        data = {}
 
+    if resp.status_code == 200 and data.get("code") == 0:
+        return data["data"]["biz_data"]["id"], 0, ""
+    code = data.get("code", resp.status_code)
+    msg = data.get("msg", "")
+    logger.warning(f"[create_session] 创建会话失败, code={code}, msg={msg}")
+    return None, code, msg
+
+
+async def prepare_upstream_call(
+    request: Request, max_attempts: int = 3
+) -> tuple[str | None, str | None]:
+    """并发创建会话并获取 PoW
+
+    两者互不依赖，同时执行可省去一次上游往返和 PoW 求解的串行等待。
+    故障处理：
+    - 网络异常或 PoW 求解失败：保留已成功的一路，稍等片刻后用同一账号只重试失败的一路；
+    - token 失效：刷新当前账号 token 后两路重做；
+    - 其他上游错误：切换账号（释放旧账号）后两路重做。
 
-def create_session(request: Request, max_attempts: int = 3) -> str | None:
-    """创建 DeepSeek 会话
-    
     Args:
         request: FastAPI 请求对象
         max_attempts: 最大重试次数
-        
+
     Returns:
-        会话 ID，如果失败返回 None
+        (session_id, pow_resp)，失败的一项为 None
     """
+    session_id = pow_resp = None
     attempts = 0
-    token_refreshed = False  # 标记是否已尝试刷新 token
-    
+    token_refreshed = False
+    request.state.upstream_started = time.monotonic()
+
     while attempts < max_attempts:
-        headers = get_auth_headers(request)
-        try:
-            resp = cffi_requests.post(
-                DEEPSEEK_CREATE_SESSION_URL,
-                headers=headers,
-                json={"agent": "chat"},
-                impersonate="safari15_3",
-            )
-        except Exception as e:
-            logger.error(f"[create_session] 请求异常: {e}")
-            attempts += 1
+        legs = []
+        if not session_id:
+            legs.append(_create_session_once(request))
+        if not pow_resp:
+            legs.append(get_pow_once(request))
+        results = await asyncio.gather(*legs)
+
+        session_failure = pow_failure = None
+        if not session_id:
+            session_id, code, msg = results.pop(0)
+            if not session_id:
+                session_failure = (code, msg)
+        if not pow_resp:
+            pow_resp, code, msg = results.pop(0)
+            if not pow_resp:
+                pow_failure = (code, msg)
+
+        if session_id and pow_resp:
+            return session_id, pow_resp
+
+        # 上游明确拒绝（有错误码）时才计入账号健康度，并换 token 或换账号；
+        # 本地故障（PoW 求解失败、求解队列已满）和网络异常与账号无关，退避后原账号重试
+        rejections = [f for f in (session_failure, pow_failure) if f and f[0]]
+        attempts += 1
+        if not rejections:
+            if attempts < max_attempts:
+                await asyncio.sleep(UPSTREAM_RETRY_BACKOFF * attempts)
             continue
-        
-        try:
-            data = resp.json()
-        except Exception as e:
-            logger.error(f"[create_session] JSON解析异常: {e}")
-            data = {}
-        
-        if resp.status_code == 200 and data.get("code") == 0:
-            session_id = data["data"]["biz_data"]["id"]
-            resp.close()
-            return session_id
-        else:
-            code = data.get("code")
-            msg = data.get("msg", "")
-            logger.warning(
-                f"[create_session] 创建会话失败, code={code}, msg={msg}"
-            )
-            resp.close()
-            
-            # 配置模式下尝试处理 token 问题
-            if request.state.use_config_token:
-                # token 无效（认证失败）时，先尝试刷新当前账号的 token
-                if code in [40001, 40002, 40003] or "token" in msg.lower() or "unauthorized" in msg.lower():
-                    if not token_refreshed:
-                        logger.info("[create_session] 检测到 token 可能过期，尝试刷新")
-                        if refresh_account_token(request):
-                            token_refreshed = True
-                            continue  # 使用新 token 重试
-                        else:
-                            logger.warning("[create_session] token 刷新失败，尝试切换账号")
-                
-                # token 刷新失败或其他错误，尝试切换账号
-                current_id = get_account_identifier(request.state.account)
-                if not hasattr(request.state, "tried_accounts"):
-                    request.state.tried_accounts = []
-                if current_id not in request.state.tried_accounts:
-                    request.state.tried_accounts.append(current_id)
-                new_account = choose_new_account(request.state.tried_accounts)
-                if new_account is None:
-                    break
-                try:
-                    login_deepseek_via_account(new_account)
-                except Exception as e:
-                    logger.error(
-                        f"[create_session] 账号 {get_account_identifier(new_account)} 登录失败：{e}"
-                    )
-                    attempts += 1
+        report_upstream_result(request, False, rejections[0][0])
+        if request.state.use_config_token:
+            if any(is_token_error(code, msg) for code, msg in rejections) and not token_refreshed:
+                logger.info("[prepare_upstream_call] 检测到 token 可能过期，尝试刷新")
+                if await refresh_account_token(request):
+                    token_refreshed = True
+                    session_id = pow_resp = None  # 新 token 下两路都要重做
                     continue
-                request.state.account = new_account
-                request.state.deepseek_token = new_account.get("token")
-                token_refreshed = False  # 新账号重置刷新标记
-            else:
-                attempts += 1
-                continue
-        attempts += 1
-    return None
+                logger.warning("[prepare_upstream_call] token 刷新失败，尝试切换账号")
 
+            if not await switch_account(request, "prepare_upstream_call"):
+                break
+            token_refreshed = False
+            session_id = pow_resp = None  # 新账号下两路都要重做
+            request.state.upstream_started = time.monotonic()
 
-def get_pow(request: Request, max_attempts: int = 3) -> str | None:
-    """获取 PoW 响应的包装函数
-    
-    Args:
-        request: FastAPI 请求对象
-        max_attempts: 最大重试次数
-        
-    Returns:
-        Base64 编码的 PoW 响应，如果失败返回 None
-    """
-    return get_pow_response(request, max_attempts)
-
-
-def prepare_completion_request(
-    request: Request,
-    session_id: str,
-    prompt: str,
-    thinking_enabled: bool = False,
-    search_enabled: bool = False,
-    max_attempts: int = 3,
-):
-    """准备并执行对话补全请求
-    
-    Args:
-        request: FastAPI 请求对象
-        session_id: 会话 ID
-        prompt: 处理后的提示词
-        thinking_enabled: 是否启用思考模式
-        search_enabled: 是否启用搜索
-        max_attempts: 最大重试次数
-        
-    Returns:
-        DeepSeek 响应对象，如果失败返回 None
+    return session_id, pow_resp
+
+
+# get_model_config 已移至 core.models
+
+
+def take_account_lease(request: Request) -> tuple | None:
+    """把账号租约从请求转交给响应生成器
+
+    转交后路由的 cleanup_account 不再归还账号，生成器结束时调用 release_account(*lease)。
     """
-    pow_resp = get_pow(request, max_attempts)
-    if not pow_resp:
+    if not getattr(request.state, "use_config_token", False):
         return None
-    
-    headers = {**get_auth_headers(request), "x-ds-pow-response": pow_resp}
-    payload = {
-        "chat_session_id": session_id,
-        "parent_message_id": None,
-        "prompt": prompt,
-        "ref_file_ids": [],
-        "thinking_enabled": thinking_enabled,
-        "search_enabled": search_enabled,
-    }
-    
-    return call_completion_endpoint(payload, headers, max_attempts)
+    lease_id = getattr(request.state, "lease_id", None)
+    if lease_id is None:
+        return None
+    request.state.lease_id = None
+    return request.state.account, lease_id
 
 
-# get_model_config 已移至 core.models
+def take_key_slot(request: Request) -> str | None:
+    """把调用方 key 的并发槽位从请求转交给响应生成器，生成器结束时调用 release_key_slot"""
+    key = getattr(request.state, "key_slot", None)
+    request.state.key_slot = None
+    return key
+
+
+def release_key_slot(key: str | None):
+    if key:
+        key_limiter.leave(key)
 
 
 def cleanup_account(request: Request):
-    """清理账号资源（将账号放回队列）"""
-    if getattr(request.state, "use_config_token", False) and hasattr(request.state, "account"):
-        release_account(request.state.account)
+    """清理账号资源（按租约将账号放回队列并归还 key 并发槽位，重复调用不会重复释放）"""
+    lease = take_account_lease(request)
+    if lease is not None:
+        release_account(*lease)
+    release_key_slot(take_key_slot(request))
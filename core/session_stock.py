@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""会话预热模块 - 为每个账号预先创建少量 chat_session_id
+
+请求到来时直接从库存中取出会话，省去关键路径上的一次 create_session 往返；
+库存为空时由 _create_session_once 回退到即时创建。
+
+配置项（config.json 中的 session_prewarm，均可省略）：
+    {"size": 2, "ttl": 600, "interval": 5, "concurrency": 4, "active_window": 300}
+size 为 0 时关闭预热；Vercel 环境没有常驻进程，默认关闭。
+只为最近 active_window 秒内取用过会话、且未被熔断的账号补货，空闲账号不占用上游配额。
+"""
+import asyncio
+import time
+from collections import deque
+
+from .config import CONFIG, IS_VERCEL, logger
+from .constants import (
+    BASE_HEADERS,
+    DEEPSEEK_CREATE_SESSION_URL,
+    SESSION_PREWARM_SIZE,
+    SESSION_PREWARM_TTL,
+    SESSION_PREWARM_INTERVAL,
+    SESSION_PREWARM_CONCURRENCY,
+    SESSION_PREWARM_ACTIVE_WINDOW,
+)
+from .http_pool import get_upstream_session
+from .utils import get_account_identifier
+
+
+def _prewarm_config() -> dict:
+    cfg = CONFIG.get("session_prewarm", {}) or {}
+    default_size = 0 if IS_VERCEL else SESSION_PREWARM_SIZE
+    return {
+        "size": max(0, int(cfg.get("size", default_size))),
+        "ttl": float(cfg.get("ttl", SESSION_PREWARM_TTL)),
+        "interval": float(cfg.get("interval", SESSION_PREWARM_INTERVAL)),
+        "concurrency": max(1, int(cfg.get("concurrency", SESSION_PREWARM_CONCURRENCY))),
+        "active_window": float(cfg.get("active_window", SESSION_PREWARM_ACTIVE_WINDOW)),
+    }
+
+
+class ChatSessionStock:
+    """按账号保存预创建的会话：{account_id: deque[(session_id, token, created_at)]}"""
+
+    def __init__(self):
+        self._stock = {}
+        self._active = {}  # {account_id: 最近一次取用时间}
+        self._filling = set()  # 正在补货的账号，避免重复创建
+        self._task = None
+        self._loop = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+        self.created = 0
+        self.failed = 0
+
+    # ------------------------------------------------------------------
+    # 取用与失效
+    # ------------------------------------------------------------------
+    def take(self, acc_id: str, token: str) -> str | None:
+        """取出一个可用会话，并把账号标记为活跃；过期或 token 已变化的会话直接丢弃"""
+        self._active[acc_id] = time.time()
+        self.ensure_started()
+        stock = self._stock.get(acc_id)
+        now = time.time()
+        ttl = _prewarm_config()["ttl"]
+        while stock:
+            session_id, session_token, created_at = stock.popleft()
+            if session_token != token:
+                self.invalidated += 1
+                continue
+            if now - created_at > ttl:
+                self.expired += 1
+                continue
+            self.hits += 1
+            return session_id
+        self.misses += 1
+        return None
+
+    def invalidate(self, acc_id: str):
+        """账号 token 失效或变更时清空库存"""
+        stock = self._stock.pop(acc_id, None)
+        if stock:
+            self.invalidated += len(stock)
+
+    def clear(self):
+        self._stock.clear()
+
+    # ------------------------------------------------------------------
+    # 后台补货
+    # ------------------------------------------------------------------
+    def ensure_started(self):
+        """在当前事件循环中启动后台补货任务（只启动一次）"""
+        if _prewarm_config()["size"] <= 0:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._filling.clear()
+        self._task = loop.create_task(self._fill_loop())
+        logger.info("[session_stock] 会话预热任务已启动")
+
+    async def _create(self, acc_id: str, token: str) -> str | None:
+        headers = {**BASE_HEADERS, "authorization": f"Bearer {token}"}
+        try:
+            resp = await get_upstream_session(acc_id).post(
+                DEEPSEEK_CREATE_SESSION_URL,
+                headers=headers,
+                json={"agent": "chat"},
+                timeout=15,
+            )
+            data = resp.json()
+        except Exception as e:
+            logger.debug(f"[session_stock] 账号 {acc_id} 预创建会话异常: {e}")
+            return None
+        if resp.status_code == 200 and data.get("code") == 0:
+            return data["data"]["biz_data"]["id"]
+        logger.debug(
+            f"[session_stock] 账号 {acc_id} 预创建会话失败, code={data.get('code')}, msg={data.get('msg')}"
+        )
+        return None
+
+    async def probe(self, acc_id: str, token: str) -> bool:
+        """创建一个会话以探测账号是否可用；预热开启时把会话放入库存"""
+        session_id = await self._create(acc_id, token)
+        if not session_id:
+            return False
+        if _prewarm_config()["size"] > 0:
+            self.created += 1
+            self._stock.setdefault(acc_id, deque()).append((session_id, token, time.time()))
+        return True
+
+    async def _fill_account(self, account: dict, cfg: dict, sem: asyncio.Semaphore):
+        acc_id = get_account_identifier(account)
+        try:
+            async with sem:
+                stock = self._stock.setdefault(acc_id, deque())
+                now = time.time()
+                while stock and (now - stock[0][2] > cfg["ttl"]):
+                    stock.popleft()
+                    self.expired += 1
+                while len(stock) < cfg["size"]:
+                    token = account.get("token", "").strip()
+                    if not token:
+                        return
+                    session_id = await self._create(acc_id, token)
+                    if not session_id:
+                        self.failed += 1
+                        return
+                    # 创建期间 token 可能已被刷新
+                    if account.get("token", "").strip() != token:
+                        return
+                    self.created += 1
+                    stock.append((session_id, token, time.time()))
+        finally:
+            self._filling.discard(acc_id)
+
+    async def _fill_round(self, cfg: dict):
+        """补货一轮：清理不再活跃的账号，为活跃且未熔断的账号补足库存"""
+        from .auth import account_scheduler
+
+        now = time.time()
+        for acc_id, last_used in list(self._active.items()):
+            if now - last_used > cfg["active_window"]:
+                del self._active[acc_id]
+                self.invalidate(acc_id)
+        sem = asyncio.Semaphore(cfg["concurrency"])
+        jobs = []
+        for account in CONFIG.get("accounts", []):
+            acc_id = get_account_identifier(account)
+            if acc_id not in self._active or acc_id in self._filling:
+                continue
+            # 熔断冷却中的账号不补货，避免持续请求被限流的账号
+            if account_scheduler.is_blocked(acc_id):
+                continue
+            if not account.get("token", "").strip():
+                continue
+            self._filling.add(acc_id)
+            jobs.append(self._fill_account(account, cfg, sem))
+        if jobs:
+            await asyncio.gather(*jobs, return_exceptions=True)
+
+    async def _fill_loop(self):
+        while True:
+            cfg = _prewarm_config()
+            if cfg["size"] <= 0:
+                self._task = None
+                return
+            try:
+                await self._fill_round(cfg)
+            except Exception as e:
+                logger.warning(f"[session_stock] 补货异常: {e}")
+            await asyncio.sleep(cfg["interval"])
+
+    # ------------------------------------------------------------------
+    # 监控
+    # ------------------------------------------------------------------
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": _prewarm_config()["size"] > 0,
+            "active_accounts": len(self._active),
+            "stock": {acc_id: len(stock) for acc_id, stock in self._stock.items()},
+            "total": sum(len(stock) for stock in self._stock.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "expired": self.expired,
+            "invalidated": self.invalidated,
+            "created": self.created,
+            "failed": self.failed,
+        }
+
+
+session_stock = ChatSessionStock()
@@ -2,14 +2,17 @@
 """DeepSeek SSE 流解析模块
 
 这个模块包含解析 DeepSeek SSE 响应的公共逻辑，供 openai.py、claude.py 和 accounts.py 共用。
-合并了原 sse_parser.py 和 stream_parser.py 的功能。
+合并了原 sse_parser.py 和 stream_parser.py 的功能；各路由统一通过 DeepSeekStreamDecoder
+（或其异步封装 iter_deepseek_events）读取上游响应。
 """
+import asyncio
 import json
 import re
-from typing import List, Tuple, Optional, Dict, Any, Generator
+from typing import List, Tuple, Optional, Dict, Any, AsyncIterator
 
 from .config import logger
 from .constants import SKIP_PATTERNS
+from .deepseek import close_response
 
 # 预编译正则表达式
 _TOOL_CALL_PATTERN = re.compile(r'\{\s*["\']tool_calls["\']\s*:\s*\[(.*?)\]\s*\}', re.DOTALL)
@@ -20,39 +23,10 @@ _CITATION_PATTERN = re.compile(r"^\[citation:")
 # 基础解析函数
 # ----------------------------------------------------------------------
 
-def parse_deepseek_sse_line(raw_line: bytes) -> Optional[Dict[str, Any]]:
-    """解析 DeepSeek SSE 行
-    
-    Args:
-        raw_line: 原始字节行
-        
-    Returns:
-        解析后的 chunk 字典，如果解析失败或应跳过则返回 None
-    """
-    try:
-        line = raw_line.decode("utf-8")
-    except Exception as e:
-        logger.warning(f"[parse_deepseek_sse_line] 解码失败: {e}")
-        return None
-    
-    if not line or not line.startswith("data:"):
-        return None
-    
-    data_str = line[5:].strip()
-    
-    if data_str == "[DONE]":
-        return {"type": "done"}
-    
-    try:
-        chunk = json.loads(data_str)
-        return chunk
-    except json.JSONDecodeError as e:
-        logger.warning(f"[parse_deepseek_sse_line] JSON解析失败: {e}")
-        return None
-
-
 def should_skip_chunk(chunk_path: str) -> bool:
     """判断是否应该跳过这个 chunk（状态相关，不是内容）"""
+    if not chunk_path:
+        return False  # 大多数增量内容没有路径
     if chunk_path == "response/search_status":
         return True
     return any(kw in chunk_path for kw in SKIP_PATTERNS)
@@ -258,95 +232,177 @@ def parse_sse_chunk_for_content(
     return (contents, False, new_fragment_type)
 
 
-def extract_content_from_chunk(chunk: Dict[str, Any]) -> Tuple[str, str, bool]:
-    """从 DeepSeek chunk 中提取内容（简化版本，兼容旧接口）
-    
-    Args:
-        chunk: 解析后的 chunk 字典
-        
-    Returns:
-        (content, content_type, is_finished) 元组
-        content_type 为 "thinking" 或 "text"
-        is_finished 为 True 表示响应结束
+# ----------------------------------------------------------------------
+# 增量解码器
+# ----------------------------------------------------------------------
+
+_JSON_DECODER = json.JSONDecoder()
+
+# 解码器产出的事件类型，事件为 (event_type, data)
+EVENT_THINKING = "thinking"  # 思考内容增量，data 为文本
+EVENT_TEXT = "text"  # 回复内容增量，data 为文本
+EVENT_SEARCH = "search"  # 搜索结果，data 为 [{"url": ..., "title": ..., ...}]
+EVENT_FINISHED = "finished"  # 响应结束，data 为 ""
+EVENT_CONTENT_FILTER = "content_filter"  # 上游触发内容过滤，data 为 ""
+
+
+def _search_results(path: str, value: Any) -> List[Dict[str, Any]]:
+    """提取 chunk 中的搜索结果项（顶层列表或 BATCH 内 search_results 路径下的列表）"""
+    if not isinstance(value, list):
+        return []
+    results = [item for item in value if isinstance(item, dict) and is_search_result(item)]
+    if not results and path == "response":
+        for item in value:
+            if isinstance(item, dict) and "search_results" in item.get("p", ""):
+                results.extend(_search_results("", item.get("v")))
+    return results
+
+
+class DeepSeekStreamDecoder:
+    """DeepSeek 流响应的增量解码器
+
+    按任意边界切分的原始字节依次传给 feed，返回解出的事件列表；上游结束后调用 close
+    处理最后一行不完整的数据。跨 chunk 的半行和当前 fragment 类型都保存在解码器里，
+    各路由只需要按事件类型处理。收到结束信号或内容过滤后 finished 为 True，
+    之后的数据都被忽略；无论上游以何种方式结束，最后一个事件总是 finished 或 content_filter。
     """
-    if chunk.get("type") == "done":
-        return "", "text", True
-    
-    # 检测内容审核/敏感词阻止
-    if "error" in chunk or chunk.get("code") == "content_filter":
-        logger.warning(f"[extract_content_from_chunk] 检测到内容过滤: {chunk}")
-        return "", "text", True
-    
-    if "v" not in chunk:
-        return "", "text", False
-    
-    v_value = chunk["v"]
-    ptype = "text"
-    
-    # 检查路径确定类型
-    path = chunk.get("p", "")
-    if path == "response/search_status":
-        return "", "text", False  # 跳过搜索状态
-    elif path == "response/thinking_content":
-        ptype = "thinking"
-    elif path == "response/content":
-        ptype = "text"
-    
-    if isinstance(v_value, str):
-        if v_value == "FINISHED":
-            return "", ptype, True
-        return v_value, ptype, False
-    elif isinstance(v_value, list):
-        for item in v_value:
-            if isinstance(item, dict):
-                if item.get("p") == "status" and item.get("v") == "FINISHED":
-                    return "", ptype, True
-        return "", ptype, False
-    
-    return "", ptype, False
+
+    def __init__(self, thinking_enabled: bool = False):
+        self.thinking_enabled = thinking_enabled
+        self.fragment_type = "thinking" if thinking_enabled else "text"
+        self.finished = False
+        self._buffer = bytearray()  # 还没有遇到换行的半行数据，跨 feed 复用
+
+    def feed(self, data: bytes) -> List[Tuple[str, Any]]:
+        """输入一段原始字节，返回其中完整行解出的事件
+
+        分帧在字节上进行：每次输入只用 rfind 找一次最后的换行，之前的完整行通过 memoryview
+        一次解码成字符串再按行切分，不为每一行单独复制 bytes、单独解码。
+        换行符不会出现在 UTF-8 多字节字符内部，按它截断后整段解码是安全的。
+        """
+        if self.finished:
+            return []
+        buf = self._buffer
+        buf += data
+        last = buf.rfind(b"\n")
+        if last < 0:
+            return []
+        with memoryview(buf) as view:
+            # 个别非法字节只影响所在的那一行
+            text = str(view[:last], "utf-8", "replace")
+        del buf[:last + 1]
+        events: List[Tuple[str, Any]] = []
+        for line in text.split("\n"):
+            if line.startswith("data:"):
+                self._decode_data(line, events)
+                if self.finished:
+                    buf.clear()
+                    break
+        return events
+
+    def close(self) -> List[Tuple[str, Any]]:
+        """上游流结束：解码剩余的半行，尚未结束时补一个 finished 事件"""
+        events: List[Tuple[str, Any]] = []
+        buf = self._buffer
+        if not self.finished and buf.startswith(b"data:"):
+            self._decode_data(buf.decode("utf-8", "replace"), events)
+        buf.clear()
+        if not self.finished:
+            self.finished = True
+            events.append((EVENT_FINISHED, ""))
+        return events
+
+    def _decode_data(self, line: str, events: List[Tuple[str, Any]]):
+        """解码一行 data: 数据"""
+        try:
+            # JSONDecoder.decode 自行跳过首尾空白（含行尾的 \r），不必先 strip
+            chunk = _JSON_DECODER.decode(line[5:])
+        except ValueError as e:
+            if line[5:].strip() == "[DONE]":
+                self.finished = True
+                events.append((EVENT_FINISHED, ""))
+            else:
+                logger.warning(f"[DeepSeekStreamDecoder] JSON解析失败: {e}")
+            return
+        if not isinstance(chunk, dict):
+            return
+
+        # 检测内容审核/敏感词阻止
+        if "error" in chunk or chunk.get("code") == "content_filter":
+            logger.warning(f"[DeepSeekStreamDecoder] 检测到内容过滤: {chunk}")
+            self.finished = True
+            events.append((EVENT_CONTENT_FILTER, ""))
+            return
+
+        results = _search_results(chunk.get("p", ""), chunk.get("v"))
+        if results:
+            events.append((EVENT_SEARCH, results))
+
+        contents, is_finished, self.fragment_type = parse_sse_chunk_for_content(
+            chunk, self.thinking_enabled, self.fragment_type
+        )
+        for content, content_type in contents:
+            if content:
+                events.append((EVENT_THINKING if content_type == "thinking" else EVENT_TEXT, content))
+        if is_finished:
+            self.finished = True
+            events.append((EVENT_FINISHED, ""))
 
 
 # ----------------------------------------------------------------------
-# 响应收集函数
+# 异步流水线
 # ----------------------------------------------------------------------
 
-def collect_deepseek_response(response: Any) -> Tuple[str, str]:
-    """收集 DeepSeek 流响应的完整内容
-    
-    Args:
-        response: DeepSeek 流响应对象
-        
-    Returns:
-        (reasoning_content, text_content) 元组
+KEEPALIVE = object()  # with_keepalive 在上游静默时产出的占位符
+
+
+async def iter_deepseek_events(
+    response: Any, thinking_enabled: bool = False
+) -> AsyncIterator[Tuple[str, Any]]:
+    """用 DeepSeekStreamDecoder 解码流响应，按到达顺序产出事件
+
+    产出 finished 或 content_filter 事件后结束，并关闭响应。
     """
-    thinking_parts: List[str] = []
-    text_parts: List[str] = []
-    
+    decoder = DeepSeekStreamDecoder(thinking_enabled)
     try:
-        for raw_line in response.iter_lines():
-            chunk = parse_deepseek_sse_line(raw_line)
-            if not chunk:
+        async for data in response.aiter_content():
+            for event in decoder.feed(data):
+                yield event
+            if decoder.finished:
+                return
+        for event in decoder.close():
+            yield event
+    finally:
+        await close_response(response)
+
+
+async def with_keepalive(source: AsyncIterator, interval: float) -> AsyncIterator:
+    """转发 source 的每一项；超过 interval 秒没有新数据时产出 KEEPALIVE
+
+    等待由事件循环的定时器驱动，数据到达后立即转发，不做轮询。
+    """
+    iterator = source.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait((pending,), timeout=interval)
+            if not done:
+                yield KEEPALIVE
                 continue
-            
-            content, content_type, is_finished = extract_content_from_chunk(chunk)
-            
-            if is_finished:
-                break
-            
-            if content:
-                if content_type == "thinking":
-                    thinking_parts.append(content)
-                else:
-                    text_parts.append(content)
-    except Exception as e:
-        logger.error(f"[collect_deepseek_response] 收集响应失败: {e}")
+            task, pending = pending, None
+            try:
+                item = task.result()
+            except StopAsyncIteration:
+                return
+            yield item
     finally:
-        try:
-            response.close()
-        except Exception:
-            pass
-    
-    return "".join(thinking_parts), "".join(text_parts)
+        if pending is not None:
+            # 正在等待的读取随任务取消而结束，source 自己的 finally 负责清理
+            pending.cancel()
+        elif hasattr(iterator, "aclose"):
+            await iterator.aclose()
 
 
 # ----------------------------------------------------------------------
@@ -397,6 +453,73 @@ def parse_tool_calls(text: str, tools_requested: List[Dict]) -> List[Dict[str, A
     return detected_tools
 
 
+_TOOL_CALL_START = re.compile(r'\{\s*["\']tool_calls["\']\s*:')
+
+
+def _may_start_tool_call(text: str) -> bool:
+    """以 { 开头的文本是否可能是 {"tool_calls": 的开头（内容还不完整时也返回 True）"""
+    rest = text[1:].lstrip()
+    if not rest:
+        return True
+    quote = rest[0]
+    if quote not in "\"'":
+        return False
+    target = "tool_calls" + quote
+    word = rest[1:]
+    if len(word) <= len(target):
+        return target.startswith(word)
+    if not word.startswith(target):
+        return False
+    tail = word[len(target):].lstrip()
+    return not tail or tail[0] == ":"
+
+
+class ToolCallSieve:
+    """流式输出时筛出可能是工具调用的文本
+
+    普通文本原样放行；遇到可能是 {"tool_calls": ...} 开头的 { 时暂存后续内容，
+    确认是工具调用后一直缓冲到结束，由调用方用 parse_tool_calls 解析；
+    确认不是时把暂存内容作为普通文本放行。
+    """
+
+    def __init__(self):
+        self.pending = ""  # 暂存的疑似工具调用文本
+        self.capturing = False  # 已确认进入工具调用 JSON，缓冲到结束
+
+    def feed(self, text: str) -> str:
+        """输入一段文本，返回可以立即输出的部分"""
+        if self.capturing:
+            self.pending += text
+            return ""
+        text = self.pending + text
+        self.pending = ""
+        emit = []
+        start = 0
+        while True:
+            brace = text.find("{", start)
+            if brace < 0:
+                emit.append(text[start:])
+                break
+            emit.append(text[start:brace])
+            candidate = text[brace:]
+            if _TOOL_CALL_START.match(candidate):
+                self.pending = candidate
+                self.capturing = True
+                break
+            if _may_start_tool_call(candidate):
+                self.pending = candidate
+                break
+            emit.append("{")
+            start = brace + 1
+        return "".join(emit)
+
+    def flush(self) -> str:
+        """流结束时取出暂存的文本"""
+        text, self.pending = self.pending, ""
+        self.capturing = False
+        return text
+
+
 # ----------------------------------------------------------------------
 # 引用过滤
 # ----------------------------------------------------------------------
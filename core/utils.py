@@ -1,5 +1,20 @@
 # -*- coding: utf-8 -*-
 """公共工具函数模块"""
+import asyncio
+import hashlib
+import json
+import math
+import threading
+from collections import OrderedDict
+
+from .config import (
+    get_tokenizer,
+    get_tokenizer_backend,
+    peek_tokenizer,
+    tokenizer_resolved,
+    logger,
+)
+from .constants import TOKEN_CACHE_SIZE, TOKEN_MESSAGE_OVERHEAD, TOKEN_STREAM_SEGMENT
 
 
 def get_account_identifier(account: dict) -> str:
@@ -27,3 +42,239 @@ def estimate_tokens(text) -> int:
         )
     else:
         return max(1, len(str(text)) // 4)
+
+
+# ----------------------------------------------------------------------
+# Token 计数服务
+# ----------------------------------------------------------------------
+def _heuristic_count(text: str) -> int:
+    """没有 tokenizer 时的估算：按 DeepSeek 官方换算比例，
+    英文字符约 0.3 token，中文等非 ASCII 字符约 0.6 token"""
+    if not text:
+        return 0
+    non_ascii = len(text) - len(text.encode("ascii", "ignore"))
+    return max(1, math.ceil((len(text) - non_ascii) * 0.3 + non_ascii * 0.6))
+
+
+def _content_text(content) -> str:
+    """提取消息内容中参与计数的文本（兼容字符串和内容块列表）"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for block in content:
+            if not isinstance(block, dict):
+                parts.append(str(block))
+            elif block.get("type") == "text":
+                parts.append(block.get("text", ""))
+            elif block.get("type") == "tool_result":
+                parts.append(_content_text(block.get("content", "")))
+            elif block.get("type") in ("image", "image_url"):
+                continue
+            else:
+                parts.append(json.dumps(block, ensure_ascii=False))
+        return "\n".join(parts)
+    if content is None:
+        return ""
+    return str(content)
+
+
+class TokenCounter:
+    """基于 tokenizer 的 token 计数服务
+
+    - 按内容哈希做 LRU 缓存，重复的 system prompt 和历史消息不再重复编码；
+    - 一次请求中的所有文本合并为一个批次编码；
+    - tokenizer 在后台线程中加载，加载完成前以及不可用（heuristic 或加载失败）时回退到估算。
+    """
+
+    def __init__(self, cache_size: int = TOKEN_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # {content_hash: token_count}
+        self._lock = threading.Lock()
+        self._loading = None  # 后台加载 tokenizer 的 future
+        self._loop = None
+        self.hits = 0
+        self.misses = 0
+
+    def warm_up(self):
+        """在当前事件循环的线程池中加载 tokenizer（只启动一次）"""
+        if tokenizer_resolved():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._loading is not None and not self._loading.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._loading = loop.run_in_executor(None, get_tokenizer)
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def count_batch(self, texts: list) -> list:
+        """同步计数（可能占用 CPU，异步代码中请使用 acount_batch）"""
+        tokenizer = get_tokenizer()
+        if tokenizer is None:
+            return [_heuristic_count(t) for t in texts]
+
+        counts = [0] * len(texts)
+        pending = {}  # {key: [index, ...]}，同一批次中的重复文本只编码一次
+        with self._lock:
+            for i, text in enumerate(texts):
+                if not text:
+                    continue
+                key = self._key(text)
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+                    counts[i] = cached
+                    self.hits += 1
+                else:
+                    pending.setdefault(key, []).append(i)
+                    self.misses += 1
+        if not pending:
+            return counts
+
+        keys = list(pending)
+        try:
+            encoded = tokenizer.encode_batch([texts[pending[k][0]] for k in keys])
+        except Exception as e:
+            logger.warning(f"[TokenCounter] tokenizer 编码失败，改用估算: {e}")
+            for indexes in pending.values():
+                for i in indexes:
+                    counts[i] = _heuristic_count(texts[i])
+            return counts
+
+        with self._lock:
+            for key, ids in zip(keys, encoded):
+                for i in pending[key]:
+                    counts[i] = len(ids)
+                self._cache[key] = len(ids)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return counts
+
+    def count(self, text: str) -> int:
+        return self.count_batch([text])[0]
+
+    async def acount_batch(self, texts: list) -> list:
+        """在线程池中计数，避免阻塞事件循环；tokenizer 尚未加载完成时使用估算"""
+        if peek_tokenizer() is None:
+            self.warm_up()
+            return [_heuristic_count(t) for t in texts]
+        return await asyncio.to_thread(self.count_batch, texts)
+
+    async def acount(self, text: str) -> int:
+        return (await self.acount_batch([text]))[0]
+
+    async def count_messages(self, messages: list, system=None, tools: list = None) -> int:
+        """计算一次请求的输入 token 数（所有文本一次批量编码）"""
+        texts = []
+        if system:
+            texts.append(_content_text(system))
+        for message in messages or []:
+            if isinstance(message, dict):
+                texts.append(_content_text(message.get("content", "")))
+        for tool in tools or []:
+            if not isinstance(tool, dict):
+                continue
+            func = tool.get("function", tool)
+            schema = func.get("parameters", func.get("input_schema", {}))
+            texts.append(func.get("name", ""))
+            texts.append(func.get("description", ""))
+            texts.append(json.dumps(schema, ensure_ascii=False))
+        counts = await self.acount_batch(texts)
+        return sum(counts) + TOKEN_MESSAGE_OVERHEAD * len(messages or [])
+
+    def stream(self) -> "StreamTokenCounter":
+        return StreamTokenCounter(self)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": get_tokenizer_backend() if peek_tokenizer() is not None else "heuristic",
+            "ready": tokenizer_resolved(),
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class StreamTokenCounter:
+    """流式输出的增量计数
+
+    文本按片段追加，攒够一段后在空白处切开并计数，结束时只需计数剩余尾部，
+    避免在流结束时一次性对整段输出编码。在事件循环中时每段交给线程池编码，
+    由 atotal 汇总；tokenizer 尚未加载完成时该段使用估算。
+    """
+
+    def __init__(self, counter: TokenCounter):
+        self._counter = counter
+        self._pending = []
+        self._pending_len = 0
+        self._jobs = []  # 线程池中编码的片段
+        self.tokens = 0
+
+    def feed(self, text: str):
+        if not text:
+            return
+        self._pending.append(text)
+        self._pending_len += len(text)
+        if self._pending_len >= TOKEN_STREAM_SEGMENT:
+            self._flush(final=False)
+
+    def _flush(self, final: bool):
+        text = "".join(self._pending)
+        cut = len(text)
+        if not final:
+            # 在最后一个空白处切开，避免把一个词拆到两段里
+            boundary = max(text.rfind(" "), text.rfind("\n"))
+            if boundary > 0:
+                cut = boundary
+        head, tail = text[:cut], text[cut:]
+        if head:
+            self._count(head)
+        self._pending = [tail] if tail else []
+        self._pending_len = len(tail)
+
+    def _count(self, text: str):
+        tokenizer = peek_tokenizer()
+        if tokenizer is None:
+            self._counter.warm_up()
+            self.tokens += _heuristic_count(text)
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.tokens += _tokenize_uncached(tokenizer, text)  # 不在事件循环中，直接编码
+            return
+        self._jobs.append(loop.run_in_executor(None, _tokenize_uncached, tokenizer, text))
+
+    def total(self) -> int:
+        """已输出内容的 token 总数（事件循环之外使用）"""
+        if self._pending:
+            self._flush(final=True)
+        return self.tokens
+
+    async def atotal(self) -> int:
+        """已输出内容的 token 总数，等待线程池中的片段编码完成"""
+        if self._pending:
+            self._flush(final=True)
+        if self._jobs:
+            jobs, self._jobs = self._jobs, []
+            self.tokens += sum(await asyncio.gather(*jobs))
+        return self.tokens
+
+
+def _tokenize_uncached(tokenizer, text: str) -> int:
+    """流式片段各不相同，直接编码而不进入缓存"""
+    try:
+        return len(tokenizer.encode(text))
+    except Exception:
+        return _heuristic_count(text)
+
+
+token_counter = TokenCounter()
@@ -7,17 +7,19 @@ import base64
 from fastapi import APIRouter, HTTPException, Request, Depends
 from fastapi.responses import JSONResponse
 
-from core.config import CONFIG, save_config, logger, WASM_PATH
-from core.auth import init_account_queue, get_account_identifier
+from core.config import CONFIG, save_config, logger
+from core.auth import init_account_queue, get_account_identifier, login_account
+from core.http_pool import get_upstream_session
 from core.deepseek import (
-    login_deepseek_via_account, 
+    close_response,
     DEEPSEEK_CREATE_SESSION_URL, 
+    DEEPSEEK_CREATE_POW_URL,
     DEEPSEEK_COMPLETION_URL, 
     BASE_HEADERS,
 )
-from core.pow import compute_pow_answer
+from core.pow import pow_solver
 from core.models import get_model_config
-from core.sse_parser import parse_sse_chunk_for_content
+from core.sse_parser import iter_deepseek_events, EVENT_THINKING, EVENT_TEXT
 
 from .auth import verify_admin
 
@@ -33,7 +35,6 @@ async def test_account_api(account: dict, model: str = "deepseek-chat", message:
     如果提供 message，会发送实际请求并返回 AI 回复；
     否则只快速测试创建会话。
     """
-    from curl_cffi import requests as cffi_requests
     import time
     
     acc_id = get_account_identifier(account)
@@ -52,14 +53,13 @@ async def test_account_api(account: dict, model: str = "deepseek-chat", message:
         code = data.get("code")
         return status_code in {401, 403} or code in {40001, 40002, 40003} or "token" in msg or "unauthorized" in msg
 
-    def _create_session(token: str) -> dict:
+    async def _create_session(token: str) -> dict:
         headers = {**BASE_HEADERS, "authorization": f"Bearer {token}"}
         try:
-            session_resp = cffi_requests.post(
+            session_resp = await get_upstream_session(acc_id).post(
                 DEEPSEEK_CREATE_SESSION_URL,
                 headers=headers,
                 json={"agent": "chat"},
-                impersonate="safari15_3",
                 timeout=15,
             )
         except Exception as e:
@@ -69,8 +69,6 @@ async def test_account_api(account: dict, model: str = "deepseek-chat", message:
             session_data = session_resp.json()
         except Exception:
             session_data = {}
-        finally:
-            session_resp.close()
 
         if session_resp.status_code == 200 and session_data.get("code") == 0:
             return {
@@ -90,15 +88,15 @@ async def test_account_api(account: dict, model: str = "deepseek-chat", message:
         token = account.get("token", "").strip()
         session_result = None
         if token:
-            session_result = _create_session(token)
+            session_result = await _create_session(token)
 
         if not token or (session_result and not session_result["success"] and _is_token_invalid(session_result["status_code"], session_result["data"])):
+            # 保留失效的 token 交给 login_account 比对，共享池中的同一个 token 不会被复用
             try:
-                account["token"] = ""
-                login_deepseek_via_account(account)
-                token = account.get("token", "")
-                session_result = _create_session(token)
+                token = await login_account(account)
+                session_result = await _create_session(token)
             except Exception as e:
+                account["token"] = ""
                 result["message"] = f"登录失败: {str(e)}"
                 return result
 
@@ -115,13 +113,11 @@ async def test_account_api(account: dict, model: str = "deepseek-chat", message:
             result["response_time"] = round((time.time() - start_time) * 1000)
             return result
         
-        pow_url = "https://chat.deepseek.com/api/v0/chat/create_pow_challenge"
-        pow_resp = cffi_requests.post(
-            pow_url,
+        pow_resp = await get_upstream_session(acc_id).post(
+            DEEPSEEK_CREATE_POW_URL,
             headers=headers,
             json={"target_path": "/api/v0/chat/completion"},
             timeout=30,
-            impersonate="safari15_3",
         )
         
         pow_data = pow_resp.json()
@@ -131,16 +127,7 @@ async def test_account_api(account: dict, model: str = "deepseek-chat", message:
         
         challenge = pow_data["data"]["biz_data"]["challenge"]
         try:
-            answer = compute_pow_answer(
-                challenge["algorithm"],
-                challenge["challenge"],
-                challenge["salt"],
-                challenge.get("difficulty", 144000),
-                challenge.get("expire_at", 1680000000),
-                challenge["signature"],
-                challenge["target_path"],
-                WASM_PATH,
-            )
+            answer = await pow_solver.solve(challenge)
         except Exception as e:
             result["message"] = f"PoW 计算失败: {str(e)}"
             return result
@@ -171,57 +158,26 @@ async def test_account_api(account: dict, model: str = "deepseek-chat", message:
         
         completion_headers = {**headers, "x-ds-pow-response": pow_header}
         
-        completion_resp = cffi_requests.post(
+        completion_resp = await get_upstream_session(acc_id).post(
             DEEPSEEK_COMPLETION_URL,
             headers=completion_headers,
             json=payload,
-            impersonate="safari15_3",
             timeout=60,
             stream=True,
         )
         
         if completion_resp.status_code != 200:
             result["message"] = f"请求失败: HTTP {completion_resp.status_code}"
+            await close_response(completion_resp)
             return result
         
         thinking_parts = []
         content_parts = []
-        current_fragment_type = "thinking" if thinking_enabled else "text"
-        
-        for line in completion_resp.iter_lines():
-            if not line:
-                continue
-            try:
-                line_str = line.decode("utf-8")
-            except:
-                continue
-            
-            if not line_str.startswith("data:"):
-                continue
-            
-            data_str = line_str[5:].strip()
-            if data_str == "[DONE]":
-                break
-            
-            try:
-                chunk = json.loads(data_str)
-                # 使用共享的解析函数
-                contents, is_finished, current_fragment_type = parse_sse_chunk_for_content(
-                    chunk, thinking_enabled, current_fragment_type
-                )
-                
-                if is_finished:
-                    break
-                
-                for content, ctype in contents:
-                    if ctype == "thinking":
-                        thinking_parts.append(content)
-                    else:
-                        content_parts.append(content)
-            except:
-                continue
-        
-        completion_resp.close()
+        async for event_type, content in iter_deepseek_events(completion_resp, thinking_enabled):
+            if event_type == EVENT_THINKING:
+                thinking_parts.append(content)
+            elif event_type == EVENT_TEXT:
+                content_parts.append(content)
         
         result["success"] = True
         result["response_time"] = round((time.time() - start_time) * 1000)
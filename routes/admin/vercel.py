@@ -101,7 +101,7 @@ async def sync_to_vercel(request: Request, _: bool = Depends(verify_admin)):
                 if not acc.get("token", "").strip():
                     try:
                         logger.info(f"[sync_to_vercel] 自动验证账号: {acc_id}")
-                        login_deepseek_via_account(acc)
+                        await login_deepseek_via_account(acc)
                         validated_count += 1
                     except Exception as e:
                         logger.warning(f"[sync_to_vercel] 账号 {acc_id} 验证失败: {e}")
@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 """Claude API 路由"""
+import asyncio
 import json
 import random
 import time
 
-from curl_cffi import requests as cffi_requests
 from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import JSONResponse, StreamingResponse
 
@@ -12,23 +12,33 @@ from core.config import CONFIG, logger
 from core.auth import (
     determine_mode_and_token,
     get_auth_headers,
+    get_session_key,
+    release_account,
+    report_upstream_result,
+    charge_key_tokens,
 )
-from core.deepseek import call_completion_endpoint
+from core.deepseek import call_completion_endpoint, close_response
 from core.session_manager import (
-    create_session,
-    get_pow,
+    prepare_upstream_call,
     cleanup_account,
+    take_account_lease,
+    take_key_slot,
+    release_key_slot,
 )
 from core.models import get_model_config, get_claude_models_response
 from core.sse_parser import (
-    parse_deepseek_sse_line,
-    parse_sse_chunk_for_content,
-    extract_content_from_chunk,
-    collect_deepseek_response,
+    iter_deepseek_events,
+    with_keepalive,
+    should_filter_citation,
     parse_tool_calls,
+    ToolCallSieve,
+    KEEPALIVE,
+    EVENT_THINKING,
+    EVENT_TEXT,
+    EVENT_CONTENT_FILTER,
 )
-from core.constants import STREAM_IDLE_TIMEOUT
-from core.utils import estimate_tokens
+from core.constants import KEEP_ALIVE_TIMEOUT, STREAM_IDLE_TIMEOUT
+from core.utils import token_counter
 from core.messages import (
     messages_prepare,
     convert_claude_to_deepseek,
@@ -47,11 +57,11 @@ async def call_claude_via_openai(request: Request, claude_payload: dict):
     deepseek_payload = convert_claude_to_deepseek(claude_payload)
 
     try:
-        session_id = create_session(request)
+        # 会话创建与 PoW 并发进行，任一失败时按需刷新 token 或切换账号
+        session_id, pow_resp = await prepare_upstream_call(request)
         if not session_id:
             raise HTTPException(status_code=401, detail="invalid token.")
 
-        pow_resp = get_pow(request)
         if not pow_resp:
             raise HTTPException(
                 status_code=401,
@@ -68,6 +78,9 @@ async def call_claude_via_openai(request: Request, claude_payload: dict):
             thinking_enabled = False
             search_enabled = False
 
+        # 解码上游响应时据此判断无路径内容的类型、过滤搜索引用
+        request.state.thinking_enabled = thinking_enabled
+        request.state.search_enabled = search_enabled
         final_prompt = messages_prepare(messages)
 
         headers = {**get_auth_headers(request), "x-ds-pow-response": pow_resp}
@@ -80,7 +93,19 @@ async def call_claude_via_openai(request: Request, claude_payload: dict):
             "search_enabled": search_enabled,
         }
 
-        deepseek_resp = call_completion_endpoint(payload, headers, max_attempts=3)
+        failed_statuses = []
+        deepseek_resp = await call_completion_endpoint(
+            payload,
+            headers,
+            max_attempts=3,
+            session_key=get_session_key(request),
+            failed_statuses=failed_statuses,
+        )
+        report_upstream_result(
+            request,
+            deepseek_resp is not None,
+            failed_statuses[-1] if failed_statuses else None,
+        )
         return deepseek_resp
 
     except Exception as e:
@@ -104,10 +129,10 @@ def list_claude_models():
 async def claude_messages(request: Request):
     try:
         try:
-            determine_mode_and_token(request)
+            await determine_mode_and_token(request)
         except HTTPException as exc:
             return JSONResponse(
-                status_code=exc.status_code, content={"error": exc.detail}
+                status_code=exc.status_code, content={"error": exc.detail}, headers=exc.headers
             )
         except Exception as exc:
             logger.error(f"[claude_messages] determine_mode_and_token 异常: {exc}")
@@ -189,12 +214,18 @@ Remember: Output ONLY the JSON, no other text. The response must start with {{ a
             }
             payload["messages"].insert(0, system_message)
 
+        # 输入 token 计数与上游请求并行进行
+        input_tokens_task = asyncio.create_task(
+            token_counter.count_messages(
+                normalized_messages, system=req_data.get("system"), tools=tools_requested
+            )
+        )
         deepseek_resp = await call_claude_via_openai(request, payload)
         if not deepseek_resp:
             raise HTTPException(status_code=500, detail="Failed to get Claude response.")
 
         if deepseek_resp.status_code != 200:
-            deepseek_resp.close()
+            await close_response(deepseek_resp)
             return JSONResponse(
                 status_code=500,
                 content={"error": {"type": "api_error", "message": "Failed to get response"}},
@@ -203,63 +234,51 @@ Remember: Output ONLY the JSON, no other text. The response must start with {{ a
         # 流式响应或普通响应
         if bool(req_data.get("stream", False)):
 
-            def claude_sse_stream():
-                # 使用导入的常量（不再本地定义）
+            account_lease = take_account_lease(request)  # 账号由流式生成器结束时归还
+            key_slot = take_key_slot(request)
+
+            async def claude_sse_stream():
+                block = {"index": -1, "type": None}  # 当前打开的内容块
+
+                def sse(event: dict) -> str:
+                    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+                def switch_block(block_type: str):
+                    """切换到指定类型的内容块，返回需要发送的事件"""
+                    events = []
+                    if block["type"] == block_type:
+                        return events
+                    if block["type"] is not None:
+                        events.append(sse({"type": "content_block_stop", "index": block["index"]}))
+                    block["type"] = block_type
+                    if block_type is not None:
+                        block["index"] += 1
+                        start = {"type": "thinking", "thinking": ""} if block_type == "thinking" else {"type": "text", "text": ""}
+                        events.append(sse({"type": "content_block_start", "index": block["index"], "content_block": start}))
+                    return events
+
+                def delta(block_type: str, text: str) -> list:
+                    events = switch_block(block_type)
+                    if block_type == "thinking":
+                        payload = {"type": "thinking_delta", "thinking": text}
+                    else:
+                        payload = {"type": "text_delta", "text": text}
+                    events.append(sse({"type": "content_block_delta", "index": block["index"], "delta": payload}))
+                    return events
+
                 try:
                     message_id = f"msg_{int(time.time())}_{random.randint(1000, 9999)}"
-                    input_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
-                    output_tokens = 0
+                    output_counter = token_counter.stream()
                     full_response_text = ""
                     last_content_time = time.time()
                     has_content = False
+                    thinking_enabled = getattr(request.state, "thinking_enabled", False)
+                    search_enabled = getattr(request.state, "search_enabled", False)
+                    # 只有请求了工具时才需要筛出工具调用 JSON，其余文本逐段转发
+                    sieve = ToolCallSieve() if has_tools else None
 
-
-                    for line in deepseek_resp.iter_lines():
-                        current_time = time.time()
-                        
-                        # 智能超时检测
-                        if has_content and (current_time - last_content_time) > STREAM_IDLE_TIMEOUT:
-                            logger.warning(f"[claude_sse_stream] 智能超时: 已有内容但 {STREAM_IDLE_TIMEOUT}s 无新数据，强制结束")
-                            break
-                        
-                        if not line:
-                            continue
-                        try:
-                            line_str = line.decode("utf-8")
-                        except Exception:
-                            continue
-
-                        if line_str.startswith("data:"):
-                            data_str = line_str[5:].strip()
-                            if data_str == "[DONE]":
-                                break
-
-                            try:
-                                chunk = json.loads(data_str)
-                                
-                                # 检测内容审核/敏感词阻止
-                                if "error" in chunk or chunk.get("code") == "content_filter":
-                                    logger.warning(f"[claude_sse_stream] 检测到内容过滤: {chunk}")
-                                    break
-                                
-                                if "v" in chunk and isinstance(chunk["v"], str):
-                                    content = chunk["v"]
-                                    # 检查是否是 FINISHED 状态
-                                    if content == "FINISHED":
-                                        break
-                                    full_response_text += content
-                                    if content:
-                                        has_content = True
-                                        last_content_time = current_time
-                                elif "v" in chunk and isinstance(chunk["v"], list):
-                                    for item in chunk["v"]:
-                                        if item.get("p") == "status" and item.get("v") == "FINISHED":
-                                            break
-                            except (json.JSONDecodeError, KeyError):
-                                continue
-
-                    # 发送Claude格式的事件
-                    message_start = {
+                    input_tokens = await input_tokens_task
+                    yield sse({
                         "type": "message_start",
                         "message": {
                             "id": message_id,
@@ -271,36 +290,82 @@ Remember: Output ONLY the JSON, no other text. The response must start with {{ a
                             "stop_sequence": None,
                             "usage": {"input_tokens": input_tokens, "output_tokens": 0},
                         },
-                    }
-                    yield f"data: {json.dumps(message_start)}\n\n"
-
-                    # 检查工具调用
-                    # 使用公共函数检测工具调用
-                    detected_tools = parse_tool_calls(full_response_text, tools_requested)
+                    })
 
-                    content_index = 0
+                    events = with_keepalive(
+                        iter_deepseek_events(deepseek_resp, thinking_enabled), KEEP_ALIVE_TIMEOUT
+                    )
+                    try:
+                        async for item in events:
+                            if item is KEEPALIVE:
+                                # 智能超时检测
+                                if has_content and time.time() - last_content_time > STREAM_IDLE_TIMEOUT:
+                                    logger.warning(f"[claude_sse_stream] 智能超时: 已有内容但 {STREAM_IDLE_TIMEOUT}s 无新数据，强制结束")
+                                    break
+                                continue
+                            event_type, content = item
+                            if event_type == EVENT_CONTENT_FILTER:
+                                break
+                            if event_type not in (EVENT_THINKING, EVENT_TEXT):
+                                continue
+                            if event_type == EVENT_THINKING and not thinking_enabled:
+                                continue
+                            if should_filter_citation(content, search_enabled):
+                                continue
+                            has_content = True
+                            last_content_time = time.time()
+                            output_counter.feed(content)
+                            if event_type == EVENT_THINKING:
+                                for event in delta("thinking", content):
+                                    yield event
+                                continue
+                            full_response_text += content
+                            if sieve is not None:
+                                content = sieve.feed(content)
+                            if content:
+                                for event in delta("text", content):
+                                    yield event
+                    finally:
+                        await events.aclose()
+
+                    # 缓冲的疑似工具调用：解析成功时作为 tool_use 块发送，否则按普通文本补发
+                    detected_tools = []
+                    if sieve is not None:
+                        buffered = sieve.flush()
+                        if buffered:
+                            detected_tools = parse_tool_calls(full_response_text, tools_requested)
+                            if not detected_tools:
+                                for event in delta("text", buffered):
+                                    yield event
+                    for event in switch_block(None):
+                        yield event
+
+                    output_tokens = await output_counter.atotal()
+                    stop_reason = "end_turn"
                     if detected_tools:
                         stop_reason = "tool_use"
-                        for tool_info in detected_tools:
-                            tool_use_id = f"toolu_{int(time.time())}_{random.randint(1000, 9999)}_{content_index}"
-                            tool_name = tool_info["name"]
-                            tool_input = tool_info["input"]
-
-                            yield f"data: {json.dumps({'type': 'content_block_start', 'index': content_index, 'content_block': {'type': 'tool_use', 'id': tool_use_id, 'name': tool_name, 'input': tool_input}})}\n\n"
-                            yield f"data: {json.dumps({'type': 'content_block_stop', 'index': content_index})}\n\n"
-
-                            content_index += 1
-                            output_tokens += len(str(tool_input)) // 4
-                    else:
-                        stop_reason = "end_turn"
-                        if full_response_text:
-                            yield f"data: {json.dumps({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})}\n\n"
-                            yield f"data: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': full_response_text}})}\n\n"
-                            yield f"data: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
-                            output_tokens += len(full_response_text) // 4
-
-                    yield f"data: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': {'output_tokens': output_tokens}})}\n\n"
-                    yield f"data: {json.dumps({'type': 'message_stop'})}\n\n"
+                        for i, tool_info in enumerate(detected_tools):
+                            tool_use_id = f"toolu_{int(time.time())}_{random.randint(1000, 9999)}_{i}"
+                            block["index"] += 1
+                            yield sse({
+                                "type": "content_block_start",
+                                "index": block["index"],
+                                "content_block": {
+                                    "type": "tool_use",
+                                    "id": tool_use_id,
+                                    "name": tool_info["name"],
+                                    "input": tool_info["input"],
+                                },
+                            })
+                            yield sse({"type": "content_block_stop", "index": block["index"]})
+
+                    charge_key_tokens(request, input_tokens + output_tokens)
+                    yield sse({
+                        "type": "message_delta",
+                        "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                        "usage": {"output_tokens": output_tokens},
+                    })
+                    yield sse({"type": "message_stop"})
 
                 except Exception as e:
                     logger.error(f"[claude_sse_stream] 异常: {e}")
@@ -310,11 +375,10 @@ Remember: Output ONLY the JSON, no other text. The response must start with {{ a
                     }
                     yield f"data: {json.dumps(error_event)}\n\n"
                 finally:
-                    try:
-                        deepseek_resp.close()
-                    except Exception:
-                        pass
-                    cleanup_account(request)
+                    await close_response(deepseek_resp)
+                    if account_lease:
+                        release_account(*account_lease)
+                    release_key_slot(key_slot)
 
             return StreamingResponse(
                 claude_sse_stream(),
@@ -324,54 +388,24 @@ Remember: Output ONLY the JSON, no other text. The response must start with {{ a
         else:
             # 非流式响应处理
             try:
-                final_content = ""
-                final_reasoning = ""
-
-                for line in deepseek_resp.iter_lines():
-                    if not line:
+                thinking_enabled = getattr(request.state, "thinking_enabled", False)
+                search_enabled = getattr(request.state, "search_enabled", False)
+                think_list = []
+                text_list = []
+                async for event_type, content in iter_deepseek_events(deepseek_resp, thinking_enabled):
+                    if event_type == EVENT_CONTENT_FILTER:
+                        break
+                    if event_type not in (EVENT_THINKING, EVENT_TEXT):
                         continue
-                    try:
-                        line_str = line.decode("utf-8")
-                    except Exception as e:
-                        logger.warning(f"[claude_messages] 行解码失败: {e}")
+                    if should_filter_citation(content, search_enabled):
                         continue
-
-                    if line_str.startswith("data:"):
-                        data_str = line_str[5:].strip()
-                        if data_str == "[DONE]":
-                            break
-
-                        try:
-                            chunk = json.loads(data_str)
-                            if "v" in chunk:
-                                v_value = chunk["v"]
-                                if "p" in chunk and chunk.get("p") == "response/search_status":
-                                    continue
-                                ptype = "text"
-                                if "p" in chunk and chunk.get("p") == "response/thinking_content":
-                                    ptype = "thinking"
-                                elif "p" in chunk and chunk.get("p") == "response/content":
-                                    ptype = "text"
-                                if isinstance(v_value, str):
-                                    if ptype == "thinking":
-                                        final_reasoning += v_value
-                                    else:
-                                        final_content += v_value
-                                elif isinstance(v_value, list):
-                                    for item in v_value:
-                                        if item.get("p") == "status" and item.get("v") == "FINISHED":
-                                            break
-                        except json.JSONDecodeError as e:
-                            logger.warning(f"[claude_messages] JSON解析失败: {e}")
-                            continue
-                        except Exception as e:
-                            logger.warning(f"[claude_messages] chunk处理失败: {e}")
-                            continue
-
-                try:
-                    deepseek_resp.close()
-                except Exception as e:
-                    logger.warning(f"[claude_messages] 关闭响应异常: {e}")
+                    if event_type == EVENT_THINKING:
+                        if thinking_enabled:
+                            think_list.append(content)
+                    else:
+                        text_list.append(content)
+                final_reasoning = "".join(think_list)
+                final_content = "".join(text_list)
 
                 # 检查工具调用
                 detected_tools = parse_tool_calls(final_content, tools_requested)
@@ -386,11 +420,18 @@ Remember: Output ONLY the JSON, no other text. The response must start with {{ a
                     "stop_reason": "tool_use" if detected_tools else "end_turn",
                     "stop_sequence": None,
                     "usage": {
-                        "input_tokens": len(str(normalized_messages)) // 4,
-                        "output_tokens": (len(final_content) + len(final_reasoning)) // 4,
+                        "input_tokens": await input_tokens_task,
+                        "output_tokens": sum(
+                            await token_counter.acount_batch([final_content, final_reasoning])
+                        ),
                     },
                 }
 
+                charge_key_tokens(
+                    request,
+                    claude_response["usage"]["input_tokens"] + claude_response["usage"]["output_tokens"],
+                )
+
                 if final_reasoning:
                     claude_response["content"].append({"type": "thinking", "thinking": final_reasoning})
 
@@ -414,10 +455,7 @@ Remember: Output ONLY the JSON, no other text. The response must start with {{ a
 
             except Exception as e:
                 logger.error(f"[claude_messages] 非流式响应处理异常: {e}")
-                try:
-                    deepseek_resp.close()
-                except Exception as close_e:
-                    logger.warning(f"[claude_messages] 关闭响应异常2: {close_e}")
+                await close_response(deepseek_resp)
                 return JSONResponse(
                     status_code=500,
                     content={"error": {"type": "api_error", "message": "Response processing error"}},
@@ -427,6 +465,7 @@ Remember: Output ONLY the JSON, no other text. The response must start with {{ a
         return JSONResponse(
             status_code=exc.status_code,
             content={"error": {"type": "invalid_request_error", "message": exc.detail}},
+            headers=exc.headers,
         )
     except Exception as exc:
         logger.error(f"[claude_messages] 未知异常: {exc}")
@@ -445,9 +484,9 @@ Remember: Output ONLY the JSON, no other text. The response must start with {{ a
 async def claude_count_tokens(request: Request):
     try:
         try:
-            determine_mode_and_token(request)
+            await determine_mode_and_token(request)
         except HTTPException as exc:
-            return JSONResponse(status_code=exc.status_code, content={"error": exc.detail})
+            return JSONResponse(status_code=exc.status_code, content={"error": exc.detail}, headers=exc.headers)
         except Exception as exc:
             logger.error(f"[claude_count_tokens] determine_mode_and_token 异常: {exc}")
             return JSONResponse(status_code=500, content={"error": "Claude authentication failed."})
@@ -462,36 +501,9 @@ async def claude_count_tokens(request: Request):
                 status_code=400, detail="Request must include 'model' and 'messages'."
             )
 
-        input_tokens = 0
-
-        if system:
-            input_tokens += estimate_tokens(system)
-
-        for message in messages:
-            content = message.get("content", "")
-            input_tokens += 2  # 角色标记
-
-            if isinstance(content, list):
-                for content_block in content:
-                    if isinstance(content_block, dict):
-                        if content_block.get("type") == "text":
-                            input_tokens += estimate_tokens(content_block.get("text", ""))
-                        elif content_block.get("type") == "tool_result":
-                            input_tokens += estimate_tokens(content_block.get("content", ""))
-                        else:
-                            input_tokens += estimate_tokens(str(content_block))
-                    else:
-                        input_tokens += estimate_tokens(str(content_block))
-            else:
-                input_tokens += estimate_tokens(content)
-
-        tools = req_data.get("tools", [])
-        if tools:
-            for tool in tools:
-                input_tokens += estimate_tokens(tool.get("name", ""))
-                input_tokens += estimate_tokens(tool.get("description", ""))
-                input_schema = tool.get("input_schema", {})
-                input_tokens += estimate_tokens(json.dumps(input_schema, ensure_ascii=False))
+        input_tokens = await token_counter.count_messages(
+            messages, system=system, tools=req_data.get("tools", [])
+        )
 
         response = {"input_tokens": max(1, input_tokens)}
         return JSONResponse(content=response, status_code=200)
@@ -500,6 +512,7 @@ async def claude_count_tokens(request: Request):
         return JSONResponse(
             status_code=exc.status_code,
             content={"error": {"type": "invalid_request_error", "message": exc.detail}},
+            headers=exc.headers,
         )
     except Exception as exc:
         logger.error(f"[claude_count_tokens] 未知异常: {exc}")
@@ -507,3 +520,5 @@ async def claude_count_tokens(request: Request):
             status_code=500,
             content={"error": {"type": "api_error", "message": "Internal Server Error"}},
         )
+    finally:
+        cleanup_account(request)
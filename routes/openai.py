@@ -1,13 +1,10 @@
 # -*- coding: utf-8 -*-
 """OpenAI 兼容路由"""
+import asyncio
 import json
-import queue
 import random
-import re
-import threading
 import time
 
-from curl_cffi import requests as cffi_requests
 from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import JSONResponse, StreamingResponse
 
@@ -15,40 +12,42 @@ from core.config import CONFIG, logger
 from core.auth import (
     determine_mode_and_token,
     get_auth_headers,
+    get_session_key,
     release_account,
+    report_upstream_result,
+    charge_key_tokens,
 )
-from core.deepseek import call_completion_endpoint
+from core.deepseek import call_completion_endpoint, close_response
 from core.session_manager import (
-    create_session,
-    get_pow,
+    prepare_upstream_call,
     cleanup_account,
+    take_account_lease,
+    take_key_slot,
+    release_key_slot,
 )
 from core.models import get_model_config, get_openai_models_response
 from core.sse_parser import (
-    parse_deepseek_sse_line,
-    parse_sse_chunk_for_content,
-    extract_content_from_chunk,
-    extract_content_recursive,
     should_filter_citation,
     parse_tool_calls,
     format_openai_tool_calls,
+    iter_deepseek_events,
+    with_keepalive,
+    KEEPALIVE,
+    EVENT_THINKING,
+    EVENT_TEXT,
+    EVENT_CONTENT_FILTER,
 )
 from core.constants import (
     KEEP_ALIVE_TIMEOUT,
     STREAM_IDLE_TIMEOUT,
     MAX_KEEPALIVE_COUNT,
+    NONSTREAM_KEEPALIVE,
 )
 from core.messages import messages_prepare
+from core.utils import token_counter
 
 router = APIRouter()
 
-# 预编译正则表达式（性能优化）
-_CITATION_PATTERN = re.compile(r"^\[citation:")
-
-
-
-
-
 
 # ----------------------------------------------------------------------
 # 路由：/v1/models
@@ -67,10 +66,10 @@ async def chat_completions(request: Request):
     try:
         # 处理 token 相关逻辑，若登录失败则直接返回错误响应
         try:
-            determine_mode_and_token(request)
+            await determine_mode_and_token(request)
         except HTTPException as exc:
             return JSONResponse(
-                status_code=exc.status_code, content={"error": exc.detail}
+                status_code=exc.status_code, content={"error": exc.detail}, headers=exc.headers
             )
         except Exception as exc:
             logger.error(f"[chat_completions] determine_mode_and_token 异常: {exc}")
@@ -148,11 +147,15 @@ IMPORTANT: If calling tools, output ONLY the JSON. The response must start with
         
         # 使用 messages_prepare 函数构造最终 prompt（使用带工具提示的消息）
         final_prompt = messages_prepare(messages_with_tools)
-        session_id = create_session(request)
+        # 输入 token 计数与上游请求并行进行
+        prompt_tokens_task = asyncio.create_task(
+            token_counter.count_messages(messages_with_tools)
+        )
+        # 会话创建与 PoW 并发进行，任一失败时按需刷新 token 或切换账号
+        session_id, pow_resp = await prepare_upstream_call(request)
         if not session_id:
             raise HTTPException(status_code=401, detail="invalid token.")
         
-        pow_resp = get_pow(request)
         if not pow_resp:
             raise HTTPException(
                 status_code=401,
@@ -169,7 +172,19 @@ IMPORTANT: If calling tools, output ONLY the JSON. The response must start with
             "search_enabled": search_enabled,
         }
 
-        deepseek_resp = call_completion_endpoint(payload, headers, max_attempts=3)
+        failed_statuses = []
+        deepseek_resp = await call_completion_endpoint(
+            payload,
+            headers,
+            max_attempts=3,
+            session_key=get_session_key(request),
+            failed_statuses=failed_statuses,
+        )
+        report_upstream_result(
+            request,
+            deepseek_resp is not None,
+            failed_statuses[-1] if failed_statuses else None,
+        )
         if not deepseek_resp:
             raise HTTPException(status_code=500, detail="Failed to get completion.")
         created_time = int(time.time())
@@ -178,265 +193,141 @@ IMPORTANT: If calling tools, output ONLY the JSON. The response must start with
         # 流式响应（SSE）或普通响应
         if bool(req_data.get("stream", False)):
             if deepseek_resp.status_code != 200:
-                deepseek_resp.close()
+                status_code = deepseek_resp.status_code
+                await close_response(deepseek_resp)
                 return JSONResponse(
-                    content=deepseek_resp.content, status_code=deepseek_resp.status_code
+                    content={"error": "Failed to get completion."}, status_code=status_code
                 )
 
-            def sse_stream():
-                # 使用导入的常量（不再本地定义）
+            account_lease = take_account_lease(request)  # 账号由流式生成器结束时归还
+            key_slot = take_key_slot(request)
+
+            async def sse_stream():
                 try:
                     final_text = ""
                     final_thinking = ""
+                    text_counter = token_counter.stream()
+                    thinking_counter = token_counter.stream()
                     first_chunk_sent = False
-                    result_queue = queue.Queue()
-                    last_send_time = time.time()
                     last_content_time = time.time()  # 最后收到有效内容的时间
                     keepalive_count = 0  # 连续 keepalive 计数
                     has_content = False  # 是否收到过内容
-
-                    def process_data():
-                        """处理 DeepSeek SSE 数据流 - 使用 sse_parser 模块"""
-                        nonlocal has_content
-                        current_fragment_type = "thinking" if thinking_enabled else "text"
-                        logger.info(f"[sse_stream] 开始处理数据流, session_id={session_id}")
-                        
-                        try:
-                            for raw_line in deepseek_resp.iter_lines():
-                                # 解码行
-                                try:
-                                    line = raw_line.decode("utf-8")
-                                except Exception as e:
-                                    logger.warning(f"[sse_stream] 解码失败: {e}")
-                                    result_queue.put({"choices": [{"index": 0, "delta": {"content": "解码失败，请稍候再试", "type": "text"}}]})
-                                    result_queue.put(None)
-                                    break
-                                
-                                if not line:
-                                    continue
-                                    
-                                if not line.startswith("data:"):
-                                    continue
-                                    
-                                data_str = line[5:].strip()
-                                if data_str == "[DONE]":
-                                    result_queue.put(None)
-                                    break
-                                    
-                                try:
-                                    chunk = json.loads(data_str)
-                                    
-                                    # 检测内容审核/敏感词阻止
-                                    if "error" in chunk or chunk.get("code") == "content_filter":
-                                        logger.warning(f"[sse_stream] 检测到内容过滤: {chunk}")
-                                        result_queue.put({"choices": [{"index": 0, "finish_reason": "content_filter"}]})
-                                        result_queue.put(None)
-                                        return
-                                    
-                                    # 使用 sse_parser 模块解析内容
-                                    contents, is_finished, new_fragment_type = parse_sse_chunk_for_content(
-                                        chunk, thinking_enabled, current_fragment_type
-                                    )
-                                    current_fragment_type = new_fragment_type
-                                    
-                                    if is_finished:
-                                        result_queue.put({"choices": [{"index": 0, "finish_reason": "stop"}]})
-                                        result_queue.put(None)
-                                        return
-                                    
-                                    # 处理提取的内容
-                                    for content_text, content_type in contents:
-                                        if content_text:
-                                            has_content = True
-                                            unified_chunk = {
-                                                "choices": [{
-                                                    "index": 0,
-                                                    "delta": {"content": content_text, "type": content_type}
-                                                }],
-                                                "model": "",
-                                                "chunk_token_usage": len(content_text) // 4,
-                                                "created": 0,
-                                                "message_id": -1,
-                                                "parent_id": -1
-                                            }
-                                            result_queue.put(unified_chunk)
-                                            
-                                except Exception as e:
-                                    logger.warning(f"[sse_stream] 无法解析: {data_str[:100]}, 错误: {e}")
-                                    result_queue.put({"choices": [{"index": 0, "delta": {"content": "解析失败，请稍候再试", "type": "text"}}]})
-                                    result_queue.put(None)
-                                    break
-                                    
-                        except Exception as e:
-                            logger.warning(f"[sse_stream] 错误: {e}")
-                            result_queue.put({"choices": [{"index": 0, "delta": {"content": "服务器错误，请稍候再试", "type": "text"}}]})
-                            result_queue.put(None)
-                        finally:
-                            deepseek_resp.close()
-
-
-                    process_thread = threading.Thread(target=process_data)
-                    process_thread.start()
-
-                    while True:
-                        current_time = time.time()
-                        
-                        # 智能超时检测：如果已有内容且长时间无新数据，强制结束
-                        if has_content and (current_time - last_content_time) > STREAM_IDLE_TIMEOUT:
-                            logger.warning(f"[sse_stream] 智能超时: 已有内容但 {STREAM_IDLE_TIMEOUT}s 无新数据，强制结束")
-                            break
-                        
-                        # 连续 keepalive 检测：如果已有内容且连续多次 keepalive，强制结束
-                        if has_content and keepalive_count >= MAX_KEEPALIVE_COUNT:
-                            logger.warning(f"[sse_stream] 智能超时: 连续 {MAX_KEEPALIVE_COUNT} 次 keepalive，强制结束")
-                            break
-                        
-                        if current_time - last_send_time >= KEEP_ALIVE_TIMEOUT:
-                            yield ": keep-alive\n\n"
-                            last_send_time = current_time
-                            keepalive_count += 1
-                            continue
-                            
-                        try:
-                            chunk = result_queue.get(timeout=0.05)
-                            keepalive_count = 0  # 重置 keepalive 计数
-                            
-                            if chunk is None:
-                                prompt_tokens = len(final_prompt) // 4
-                                thinking_tokens = len(final_thinking) // 4
-                                completion_tokens = len(final_text) // 4
-                                usage = {
-                                    "prompt_tokens": prompt_tokens,
-                                    "completion_tokens": thinking_tokens + completion_tokens,
-                                    "total_tokens": prompt_tokens + thinking_tokens + completion_tokens,
-                                    "completion_tokens_details": {"reasoning_tokens": thinking_tokens},
-                                }
-                                
-                                # 检测工具调用
-                                detected_tools = []
-                                finish_reason = "stop"
-                                if has_tools:
-                                    detected_tools = parse_tool_calls(final_text, [{"name": t.get("function", t).get("name")} for t in tools_requested])
-                                    if detected_tools:
-                                        finish_reason = "tool_calls"
-                                
-                                if detected_tools:
-                                    # 发送工具调用响应
-                                    tool_calls_data = format_openai_tool_calls(detected_tools)
-                                    tool_chunk = {
-                                        "id": completion_id,
-                                        "object": "chat.completion.chunk",
-                                        "created": created_time,
-                                        "model": model,
-                                        "choices": [{"delta": {"tool_calls": tool_calls_data}, "index": 0}],
-                                    }
-                                    yield f"data: {json.dumps(tool_chunk, ensure_ascii=False)}\n\n"
-                                
-                                finish_chunk = {
-                                    "id": completion_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created_time,
-                                    "model": model,
-                                    "choices": [{"delta": {}, "index": 0, "finish_reason": finish_reason}],
-                                    "usage": usage,
-                                }
-                                yield f"data: {json.dumps(finish_chunk, ensure_ascii=False)}\n\n"
-                                yield "data: [DONE]\n\n"
-                                last_send_time = current_time
+                    finish_reason = "stop"
+                    logger.info(f"[sse_stream] 开始处理数据流, session_id={session_id}")
+
+                    # 上游每解码出一段内容就立即转发；静默超过 KEEP_ALIVE_TIMEOUT 时由定时器触发保活
+                    events = with_keepalive(
+                        iter_deepseek_events(deepseek_resp, thinking_enabled), KEEP_ALIVE_TIMEOUT
+                    )
+                    try:
+                        async for item in events:
+                            if item is KEEPALIVE:
+                                if has_content:
+                                    keepalive_count += 1
+                                    # 智能超时：已有内容但长时间无新数据，或连续多次 keepalive，强制结束
+                                    if time.time() - last_content_time > STREAM_IDLE_TIMEOUT:
+                                        logger.warning(f"[sse_stream] 智能超时: 已有内容但 {STREAM_IDLE_TIMEOUT}s 无新数据，强制结束")
+                                        break
+                                    if keepalive_count >= MAX_KEEPALIVE_COUNT:
+                                        logger.warning(f"[sse_stream] 智能超时: 连续 {MAX_KEEPALIVE_COUNT} 次 keepalive，强制结束")
+                                        break
+                                yield ": keep-alive\n\n"
+                                continue
+
+                            keepalive_count = 0
+                            etype, ctext = item
+                            if etype == EVENT_CONTENT_FILTER:
+                                finish_reason = "content_filter"
                                 break
-                                
-                            new_choices = []
-                            for choice in chunk.get("choices", []):
-                                delta = choice.get("delta", {})
-                                ctype = delta.get("type")
-                                ctext = delta.get("content", "")
-                                if choice.get("finish_reason") == "backend_busy":
-                                    ctext = "服务器繁忙，请稍候再试"
-                                if choice.get("finish_reason") == "content_filter":
-                                    # 内容过滤，正常结束
-                                    pass
-                                if search_enabled and ctext.startswith("[citation:"):
-                                    ctext = ""
-                                if ctype == "thinking":
-                                    if thinking_enabled:
-                                        final_thinking += ctext
-                                else:
-                                    # 非 thinking 内容都作为普通文本处理（包括 ctype=None 或 "text"）
-                                    final_text += ctext
-                                delta_obj = {}
-                                if not first_chunk_sent:
-                                    delta_obj["role"] = "assistant"
-                                    first_chunk_sent = True
-                                if ctype == "thinking":
-                                    if thinking_enabled:
-                                        delta_obj["reasoning_content"] = ctext
-                                else:
-                                    # 非 thinking 内容都作为 content 输出
-                                    if ctext:
-                                        delta_obj["content"] = ctext
-                                if delta_obj:
-                                    new_choices.append({"delta": delta_obj, "index": choice.get("index", 0)})
-                                    
-                            if new_choices:
-                                last_content_time = current_time  # 更新最后内容时间
-                                out_chunk = {
-                                    "id": completion_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created_time,
-                                    "model": model,
-                                    "choices": new_choices,
-                                }
-                                yield f"data: {json.dumps(out_chunk, ensure_ascii=False)}\n\n"
-                                last_send_time = current_time
-                        except queue.Empty:
-                            continue
-                            
-                    # 如果是超时退出，也发送结束标记
-                    if has_content:
-                        prompt_tokens = len(final_prompt) // 4
-                        thinking_tokens = len(final_thinking) // 4
-                        completion_tokens = len(final_text) // 4
-                        usage = {
-                            "prompt_tokens": prompt_tokens,
-                            "completion_tokens": thinking_tokens + completion_tokens,
-                            "total_tokens": prompt_tokens + thinking_tokens + completion_tokens,
-                            "completion_tokens_details": {"reasoning_tokens": thinking_tokens},
-                        }
-                        
-                        # 检测工具调用
-                        detected_tools = []
-                        finish_reason = "stop"
-                        if has_tools:
-                            detected_tools = parse_tool_calls(final_text, [{"name": t.get("function", t).get("name")} for t in tools_requested])
-                            if detected_tools:
-                                finish_reason = "tool_calls"
-                        
-                        if detected_tools:
-                            tool_calls_data = format_openai_tool_calls(detected_tools)
-                            tool_chunk = {
+                            if etype not in (EVENT_THINKING, EVENT_TEXT):
+                                continue
+                            if should_filter_citation(ctext, search_enabled):
+                                continue
+                            delta_obj = {}
+                            if etype == EVENT_THINKING:
+                                if not thinking_enabled:
+                                    continue
+                                final_thinking += ctext
+                                thinking_counter.feed(ctext)
+                                delta_obj["reasoning_content"] = ctext
+                            else:
+                                # 非 thinking 内容都作为普通文本处理
+                                final_text += ctext
+                                text_counter.feed(ctext)
+                                delta_obj["content"] = ctext
+                            if not first_chunk_sent:
+                                delta_obj = {"role": "assistant", **delta_obj}
+                                first_chunk_sent = True
+                            has_content = True
+                            last_content_time = time.time()
+                            out_chunk = {
                                 "id": completion_id,
                                 "object": "chat.completion.chunk",
                                 "created": created_time,
                                 "model": model,
-                                "choices": [{"delta": {"tool_calls": tool_calls_data}, "index": 0}],
+                                "choices": [{"delta": delta_obj, "index": 0}],
                             }
-                            yield f"data: {json.dumps(tool_chunk, ensure_ascii=False)}\n\n"
-                        
-                        finish_chunk = {
+                            yield f"data: {json.dumps(out_chunk, ensure_ascii=False)}\n\n"
+                    except Exception as e:
+                        logger.warning(f"[sse_stream] 错误: {e}")
+                        error_chunk = {
+                            "id": completion_id,
+                            "object": "chat.completion.chunk",
+                            "created": created_time,
+                            "model": model,
+                            "choices": [{"delta": {"content": "服务器错误，请稍候再试"}, "index": 0}],
+                        }
+                        yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
+                    finally:
+                        await events.aclose()
+
+                    prompt_tokens = await prompt_tokens_task
+                    thinking_tokens = await thinking_counter.atotal()
+                    completion_tokens = await text_counter.atotal()
+                    usage = {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": thinking_tokens + completion_tokens,
+                        "total_tokens": prompt_tokens + thinking_tokens + completion_tokens,
+                        "completion_tokens_details": {"reasoning_tokens": thinking_tokens},
+                    }
+                    charge_key_tokens(request, usage["total_tokens"])
+
+                    # 检测工具调用
+                    detected_tools = []
+                    if has_tools:
+                        detected_tools = parse_tool_calls(final_text, [{"name": t.get("function", t).get("name")} for t in tools_requested])
+                        if detected_tools:
+                            finish_reason = "tool_calls"
+
+                    if detected_tools:
+                        tool_calls_data = format_openai_tool_calls(detected_tools)
+                        tool_chunk = {
                             "id": completion_id,
                             "object": "chat.completion.chunk",
                             "created": created_time,
                             "model": model,
-                            "choices": [{"delta": {}, "index": 0, "finish_reason": finish_reason}],
-                            "usage": usage,
+                            "choices": [{"delta": {"tool_calls": tool_calls_data}, "index": 0}],
                         }
-                        yield f"data: {json.dumps(finish_chunk, ensure_ascii=False)}\n\n"
-                        yield "data: [DONE]\n\n"
-                        
+                        yield f"data: {json.dumps(tool_chunk, ensure_ascii=False)}\n\n"
+
+                    finish_chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created_time,
+                        "model": model,
+                        "choices": [{"delta": {}, "index": 0, "finish_reason": finish_reason}],
+                        "usage": usage,
+                    }
+                    yield f"data: {json.dumps(finish_chunk, ensure_ascii=False)}\n\n"
+                    yield "data: [DONE]\n\n"
+
                 except Exception as e:
                     logger.error(f"[sse_stream] 异常: {e}")
                 finally:
-                    cleanup_account(request)
+                    await close_response(deepseek_resp)
+                    if account_lease:
+                        release_account(*account_lease)
+                    release_key_slot(key_slot)
 
             return StreamingResponse(
                 sse_stream(),
@@ -444,161 +335,104 @@ IMPORTANT: If calling tools, output ONLY the JSON. The response must start with
                 headers={"Content-Type": "text/event-stream"},
             )
         else:
-            # 非流式响应处理
-            think_list = []
-            text_list = []
-            result = None
-
-            data_queue = queue.Queue()
-
-            def collect_data():
-                nonlocal result
-                current_fragment_type = "thinking" if thinking_enabled else "text"
+            # 非流式响应：等待解析流水线结束后一次性返回
+            async def collect_result() -> dict:
+                think_list = []
+                text_list = []
+                finish_reason = "stop"
                 try:
-                    for raw_line in deepseek_resp.iter_lines():
-                        chunk = parse_deepseek_sse_line(raw_line)
-                        if not chunk:
-                            continue
-                        if chunk.get("type") == "done":
-                            data_queue.put(None)
-                            break
-                        try:
-                            contents, is_finished, new_fragment_type = parse_sse_chunk_for_content(
-                                chunk, thinking_enabled, current_fragment_type
-                            )
-                            current_fragment_type = new_fragment_type
-                            if is_finished:
-                                final_reasoning = "".join(think_list)
-                                final_content = "".join(text_list)
-                                prompt_tokens = len(final_prompt) // 4
-                                reasoning_tokens = len(final_reasoning) // 4
-                                completion_tokens = len(final_content) // 4
-
-                                # 检测工具调用
-                                detected_tools = []
-                                finish_reason = "stop"
-                                if has_tools:
-                                    detected_tools = parse_tool_calls(final_content, [{"name": t.get("function", t).get("name")} for t in tools_requested])
-                                    if detected_tools:
-                                        finish_reason = "tool_calls"
-
-                                # 构建 message 对象
-                                message_obj = {
-                                    "role": "assistant",
-                                    "content": final_content if not detected_tools else None,
-                                }
-                                # 只有启用思考模式时才包含 reasoning_content
-                                if thinking_enabled and final_reasoning:
-                                    message_obj["reasoning_content"] = final_reasoning
-                                # 添加工具调用
-                                if detected_tools:
-                                    tool_calls_data = format_openai_tool_calls(detected_tools)
-                                    message_obj["tool_calls"] = tool_calls_data
-                                    message_obj["content"] = None
-
-                                result = {
-                                    "id": completion_id,
-                                    "object": "chat.completion",
-                                    "created": created_time,
-                                    "model": model,
-                                    "choices": [{
-                                        "index": 0,
-                                        "message": message_obj,
-                                        "finish_reason": finish_reason,
-                                    }],
-                                    "usage": {
-                                        "prompt_tokens": prompt_tokens,
-                                        "completion_tokens": reasoning_tokens + completion_tokens,
-                                        "total_tokens": prompt_tokens + reasoning_tokens + completion_tokens,
-                                        "completion_tokens_details": {"reasoning_tokens": reasoning_tokens},
-                                    },
-                                }
-                                data_queue.put("DONE")
-                                return
-
-                            for content_text, content_type in contents:
-                                if should_filter_citation(content_text, search_enabled):
-                                    continue
-                                if content_type == "thinking":
-                                    think_list.append(content_text)
-                                else:
-                                    text_list.append(content_text)
-                        except Exception as e:
-                            logger.warning(f"[collect_data] 无法解析: {chunk}, 错误: {e}")
-                            text_list.append("解析失败，请稍候再试")
-                            data_queue.put(None)
+                    async for event_type, content_text in iter_deepseek_events(
+                        deepseek_resp, thinking_enabled
+                    ):
+                        if event_type == EVENT_CONTENT_FILTER:
+                            finish_reason = "content_filter"
                             break
+                        if event_type not in (EVENT_THINKING, EVENT_TEXT):
+                            continue
+                        if should_filter_citation(content_text, search_enabled):
+                            continue
+                        if event_type == EVENT_THINKING:
+                            think_list.append(content_text)
+                        else:
+                            text_list.append(content_text)
                 except Exception as e:
-                    logger.warning(f"[collect_data] 错误: {e}")
+                    logger.warning(f"[collect_result] 错误: {e}")
                     text_list.append("处理失败，请稍候再试")
-                    data_queue.put(None)
-                finally:
-                    deepseek_resp.close()
-                    if result is None:
-                        final_content = "".join(text_list)
-                        final_reasoning = "".join(think_list)
-                        prompt_tokens = len(final_prompt) // 4
-                        reasoning_tokens = len(final_reasoning) // 4
-                        completion_tokens = len(final_content) // 4
-                        
-                        # 检测工具调用
-                        detected_tools = []
-                        finish_reason = "stop"
-                        if has_tools:
-                            detected_tools = parse_tool_calls(final_content, [{"name": t.get("function", t).get("name")} for t in tools_requested])
-                            if detected_tools:
-                                finish_reason = "tool_calls"
-                        
-                        # 构建 message 对象
-                        message_obj = {
-                            "role": "assistant",
-                            "content": final_content if not detected_tools else None,
-                        }
-                        # 只有启用思考模式时才包含 reasoning_content
-                        if thinking_enabled and final_reasoning:
-                            message_obj["reasoning_content"] = final_reasoning
-                        # 添加工具调用
-                        if detected_tools:
-                            tool_calls_data = format_openai_tool_calls(detected_tools)
-                            message_obj["tool_calls"] = tool_calls_data
-                            message_obj["content"] = None
-                        
-                        result = {
-                            "id": completion_id,
-                            "object": "chat.completion",
-                            "created": created_time,
-                            "model": model,
-                            "choices": [{
-                                "index": 0,
-                                "message": message_obj,
-                                "finish_reason": finish_reason,
-                            }],
-                            "usage": {
-                                "prompt_tokens": prompt_tokens,
-                                "completion_tokens": reasoning_tokens + completion_tokens,
-                                "total_tokens": prompt_tokens + reasoning_tokens + completion_tokens,
-                            },
-                        }
-                    data_queue.put("DONE")
-
-            collect_thread = threading.Thread(target=collect_data)
-            collect_thread.start()
 
-            def generate():
-                last_send_time = time.time()
-                while True:
-                    current_time = time.time()
-                    if current_time - last_send_time >= KEEP_ALIVE_TIMEOUT:
-                        yield ""
-                        last_send_time = current_time
-                    if not collect_thread.is_alive() and result is not None:
-                        yield json.dumps(result)
-                        break
-                    time.sleep(0.1)
+                final_reasoning = "".join(think_list)
+                final_content = "".join(text_list)
+                prompt_tokens = await prompt_tokens_task
+                reasoning_tokens, completion_tokens = await token_counter.acount_batch(
+                    [final_reasoning, final_content]
+                )
+                charge_key_tokens(request, prompt_tokens + reasoning_tokens + completion_tokens)
+
+                # 检测工具调用
+                detected_tools = []
+                if has_tools:
+                    detected_tools = parse_tool_calls(final_content, [{"name": t.get("function", t).get("name")} for t in tools_requested])
+                    if detected_tools:
+                        finish_reason = "tool_calls"
+
+                # 构建 message 对象
+                message_obj = {
+                    "role": "assistant",
+                    "content": final_content if not detected_tools else None,
+                }
+                # 只有启用思考模式时才包含 reasoning_content
+                if thinking_enabled and final_reasoning:
+                    message_obj["reasoning_content"] = final_reasoning
+                # 添加工具调用
+                if detected_tools:
+                    message_obj["tool_calls"] = format_openai_tool_calls(detected_tools)
+
+                return {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created_time,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": message_obj,
+                        "finish_reason": finish_reason,
+                    }],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": reasoning_tokens + completion_tokens,
+                        "total_tokens": prompt_tokens + reasoning_tokens + completion_tokens,
+                        "completion_tokens_details": {"reasoning_tokens": reasoning_tokens},
+                    },
+                }
+
+            if not CONFIG.get("nonstream_keepalive", NONSTREAM_KEEPALIVE):
+                # 账号和 key 槽位由外层 finally 中的 cleanup_account 归还
+                return JSONResponse(content=await collect_result(), status_code=200)
+
+            # 兼容空闲连接会被中间代理断开的部署：等待期间每隔 KEEP_ALIVE_TIMEOUT 输出空白保活，
+            # 空白位于 JSON 之前，不影响客户端解析
+            account_lease = take_account_lease(request)  # 账号由生成器结束时归还
+            key_slot = take_key_slot(request)
+
+            async def generate():
+                collect_task = asyncio.create_task(collect_result())
+                try:
+                    while True:
+                        done, _ = await asyncio.wait({collect_task}, timeout=KEEP_ALIVE_TIMEOUT)
+                        if done:
+                            break
+                        yield "\n"
+                    yield json.dumps(collect_task.result(), ensure_ascii=False)
+                finally:
+                    if not collect_task.done():
+                        collect_task.cancel()
+                    await close_response(deepseek_resp)
+                    if account_lease:
+                        release_account(*account_lease)
+                    release_key_slot(key_slot)
 
             return StreamingResponse(generate(), media_type="application/json")
     except HTTPException as exc:
-        return JSONResponse(status_code=exc.status_code, content={"error": exc.detail})
+        return JSONResponse(status_code=exc.status_code, content={"error": exc.detail}, headers=exc.headers)
     except Exception as exc:
         logger.error(f"[chat_completions] 未知异常: {exc}")
         return JSONResponse(status_code=500, content={"error": "Internal Server Error"})
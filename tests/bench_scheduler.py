@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+账号调度器基准测试
+
+测量 10k 账号下 acquire/release 的吞吐量，并与原先的线性扫描实现对比。
+
+用法：python3 tests/bench_scheduler.py [账号数]
+"""
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_accounts(n: int) -> list:
+    """一半账号已有 token，一半需要登录，交错排列"""
+    return [
+        {"email": f"user{i}@example.com", "password": "p", "token": f"t{i}" if i % 2 == 0 else ""}
+        for i in range(n)
+    ]
+
+
+class LinearScheduler:
+    """原实现：列表线性扫描 + 列表成员判断"""
+
+    def __init__(self, accounts: list):
+        from core.utils import get_account_identifier
+
+        self._id = get_account_identifier
+        self.queue = sorted(accounts, key=lambda a: 0 if a.get("token", "").strip() else 1)
+        self.in_use = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, exclude_ids=()):
+        with self.lock:
+            for i in range(len(self.queue)):
+                acc = self.queue[i]
+                acc_id = self._id(acc)
+                if acc_id and acc_id not in exclude_ids and acc.get("token", "").strip():
+                    self.in_use[acc_id] = self.queue.pop(i)
+                    return acc
+            for i in range(len(self.queue)):
+                acc = self.queue[i]
+                acc_id = self._id(acc)
+                if acc_id and acc_id not in exclude_ids:
+                    self.in_use[acc_id] = self.queue.pop(i)
+                    return acc
+            return None
+
+    def release(self, account: dict):
+        acc_id = self._id(account)
+        with self.lock:
+            if acc_id in self.in_use:
+                del self.in_use[acc_id]
+                self.queue.append(account)
+
+
+def bench(name: str, scheduler, rounds: int, held: int, exclude):
+    """先占用 held 个账号模拟并发请求，再循环 acquire/release"""
+    holding = [scheduler.acquire() for _ in range(held)]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = scheduler.acquire(exclude)
+        account = result[1] if isinstance(result, tuple) else result
+        scheduler.release(account)
+    elapsed = time.perf_counter() - start
+    for result in holding:
+        scheduler.release(result[1] if isinstance(result, tuple) else result)
+    print(f"  {name:<10} {rounds / elapsed:>12,.0f} ops/s  ({elapsed * 1e6 / rounds:.2f} µs/op)")
+
+
+def main():
+    from core.auth import AccountScheduler
+
+    logging.getLogger("ds2api").setLevel(logging.WARNING)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    accounts = make_accounts(n)
+    # 已尝试账号列表：故障转移时通常只有少量几个
+    exclude = [f"user{i}@example.com" for i in range(0, 6, 2)]
+
+    print(f"账号数: {n}, 已占用: {n // 2 - 1}, 排除: {len(exclude)}")
+    linear = LinearScheduler(accounts)
+    bench("linear", linear, 2_000, n // 2 - 1, exclude)
+
+    indexed = AccountScheduler()
+    indexed.reset(accounts)
+    bench("indexed", indexed, 200_000, n // 2 - 1, set(exclude))
+
+
+if __name__ == "__main__":
+    main()
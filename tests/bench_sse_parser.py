@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSE 解码器基准测试
+
+构造一段典型的 DeepSeek 流响应（思考 + 回复，每个 chunk 一两个字），按网络读取大小切块后
+交给 DeepSeekStreamDecoder，测量每秒解出的事件数，并与原先先按行解码成字符串再解析的实现对比。
+
+用法：python3 tests/bench_sse_parser.py [内容 chunk 数] [读取块大小]
+"""
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_body(n: int) -> bytes:
+    """前一半为思考内容，后一半为回复内容，中间夹一次搜索结果"""
+    lines = [
+        b"event: ready",
+        b'data: {"request_message_id": 1, "response_message_id": 2}',
+        b'data: {"v": {"response": {"message_id": 2, "fragments": []}}}',
+        b'data: {"p": "response/fragments", "o": "APPEND", "v": [{"type": "THINK", "content": "\xe5\xa5\xbd"}]}',
+    ]
+    words = ["思考", " the", "，", " answer", "是", " 42", "。", "\n"]
+    for i in range(n):
+        if i == n // 2:
+            lines.append(
+                b'data: {"p": "response/search_results", "v": [{"url": "https://example.com", "title": "Example"}]}'
+            )
+            lines.append(
+                b'data: {"p": "response/fragments", "o": "APPEND", "v": [{"type": "RESPONSE", "content": "A"}]}'
+            )
+            continue
+        path = "response/fragments/-1/content" if i % 5 == 0 else ""
+        chunk = {"p": path, "o": "APPEND", "v": words[i % len(words)]} if path else {"v": words[i % len(words)]}
+        lines.append(b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8"))
+    lines.append(b'data: {"p": "response/fragments/-1/status", "v": "FINISHED"}')
+    lines.append(b'data: {"p": "response/status", "o": "SET", "v": "FINISHED"}')
+    return b"\n\n".join(lines) + b"\n\n"
+
+
+def split(body: bytes, size: int) -> list:
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+class LineParser:
+    """原实现：按行切分后逐行 decode 成字符串，再 json.loads 并解析 chunk"""
+
+    def __init__(self, thinking_enabled: bool):
+        self.thinking_enabled = thinking_enabled
+        self.fragment_type = "thinking" if thinking_enabled else "text"
+        self.buffer = b""
+
+    def feed(self, data: bytes) -> list:
+        from core.sse_parser import parse_sse_chunk_for_content
+
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        events = []
+        for raw_line in lines:
+            line = raw_line.decode("utf-8")
+            if not line.startswith("data:"):
+                continue
+            data_str = line[5:].strip()
+            if data_str == "[DONE]":
+                break
+            chunk = json.loads(data_str)
+            contents, _, self.fragment_type = parse_sse_chunk_for_content(
+                chunk, self.thinking_enabled, self.fragment_type
+            )
+            events.extend((content_type, content) for content, content_type in contents if content)
+        return events
+
+    def close(self) -> list:
+        return []
+
+
+def bench(name: str, factory, blocks: list, rounds: int, repeat: int = 3):
+    """重复 repeat 次取最快的一次，减少机器抖动的影响"""
+    elapsed = float("inf")
+    for _ in range(repeat):
+        events = 0
+        start = time.perf_counter()
+        for _ in range(rounds):
+            decoder = factory()
+            for block in blocks:
+                events += len(decoder.feed(block))
+            events += len(decoder.close())
+        elapsed = min(elapsed, time.perf_counter() - start)
+    print(
+        f"  {name:<10} {events / elapsed:>12,.0f} events/s  "
+        f"({elapsed * 1e6 / events:.2f} µs/event, {events // rounds} events/round)"
+    )
+
+
+def main():
+    from core.sse_parser import DeepSeekStreamDecoder
+
+    logging.getLogger("ds2api").setLevel(logging.WARNING)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    body = make_body(n)
+    blocks = split(body, size)
+    rounds = max(1, 100_000 // n)
+
+    print(f"内容 chunk 数: {n}, 响应大小: {len(body):,} 字节, 读取块大小: {size}, 轮数: {rounds}")
+    bench("line", lambda: LineParser(True), blocks, rounds)
+    bench("decoder", lambda: DeepSeekStreamDecoder(True), blocks, rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ DS2API 账号池测试
 测试账号登录和轮换功能
 """
 import argparse
+import asyncio
 import json
 import os
 import sys
@@ -36,7 +37,7 @@ def test_account_login(account: dict) -> AccountTestResult:
     print("-" * 40)
     
     try:
-        login_deepseek_via_account(account)
+        asyncio.run(login_deepseek_via_account(account))
         token = account.get("token", "")
         
         if token:
@@ -33,6 +33,44 @@ class TestConfig(unittest.TestCase):
         self.assertIsInstance(WASM_PATH, str)
         self.assertIsInstance(CONFIG_PATH, str)
 
+    def test_tokenizer_lazy_loading(self):
+        """tokenizer 按配置后端按需加载，heuristic 或加载失败时返回 None"""
+        from unittest import mock
+        from core import config
+
+        with mock.patch.dict(config.CONFIG, {"tokenizer": {"backend": "heuristic"}}):
+            self.assertEqual(config.get_tokenizer_backend(), "heuristic")
+            self.assertIsNone(config.get_tokenizer())
+
+        with mock.patch.dict(config.CONFIG, {"tokenizer": {"backend": "unknown"}}):
+            self.assertEqual(config.get_tokenizer_backend(), "fast")
+
+        with mock.patch.dict(config.CONFIG, {"tokenizer": {"backend": "fast"}}), \
+                mock.patch.object(config, "chat_tokenizer_dir", "/nonexistent"), \
+                mock.patch.object(config, "_tokenizer", None), \
+                mock.patch.object(config, "_tokenizer_backend", None):
+            self.assertIsNone(config.get_tokenizer())
+
+
+    def test_save_config_writes_in_place(self):
+        """配置原地写回：单文件挂载和符号链接保持不变"""
+        import tempfile
+        from unittest import mock
+        from core import config
+
+        with tempfile.TemporaryDirectory() as tmp:
+            target = os.path.join(tmp, "real.json")
+            link = os.path.join(tmp, "config.json")
+            with open(target, "w", encoding="utf-8") as f:
+                f.write("{}")
+            os.symlink(target, link)
+            with mock.patch.object(config, "CONFIG_PATH", link), \
+                    mock.patch.object(config, "_config_from_env", lambda: False):
+                config.save_config({"keys": ["k"]})
+            self.assertTrue(os.path.islink(link))
+            with open(target, encoding="utf-8") as f:
+                self.assertEqual(json.load(f), {"keys": ["k"]})
+
 
 class TestMessages(unittest.TestCase):
     """消息处理模块测试"""
@@ -156,6 +194,175 @@ class TestPow(unittest.TestCase):
         self.assertIs(engine1, engine2)
         self.assertIs(module1, module2)
 
+    def test_wasm_precompiled_cache(self):
+        """预编译产物写入后可以直接加载，损坏的缓存返回 None"""
+        import tempfile
+        from unittest import mock
+        from core import pow as pow_module
+        from core.config import WASM_PATH
+
+        engine, module = pow_module._get_cached_wasm_module(WASM_PATH)
+        with open(WASM_PATH, "rb") as f:
+            wasm_bytes = f.read()
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch.object(pow_module, "WASM_CACHE_DIR", cache_dir):
+            cwasm_path, meta_path = pow_module._wasm_cache_paths(wasm_bytes, WASM_PATH)
+            self.assertTrue(cwasm_path.startswith(cache_dir))
+            self.assertIsNone(pow_module._load_precompiled(engine, cwasm_path, meta_path))
+
+            pow_module._save_precompiled(module, cwasm_path, meta_path, 10.0)
+            loaded = pow_module._load_precompiled(engine, cwasm_path, meta_path)
+            self.assertIsNotNone(loaded)
+            self.assertIn("wasm_solve", [e.name for e in loaded.exports])
+
+            # 已加载的模块映射着原文件，这里换成新文件而不是原地改写
+            # 其他用户可写的缓存目录中的产物不加载
+            os.chmod(cache_dir, 0o777)
+            self.assertIsNone(pow_module._load_precompiled(engine, cwasm_path, meta_path))
+            os.chmod(cache_dir, 0o700)
+
+            os.remove(cwasm_path)
+            with open(cwasm_path, "wb") as f:
+                f.write(b"corrupted")
+            self.assertIsNone(pow_module._load_precompiled(engine, cwasm_path, meta_path))
+
+    def test_submit_hides_main_module(self):
+        """提交求解任务（按需启动工作进程）期间隐藏主模块，工作进程不会重新执行入口脚本"""
+        from core import pow as pow_module
+
+        main_module = sys.modules["__main__"]
+        seen = []
+
+        class FakeExecutor:
+            def submit(self, fn, *args):
+                seen.append(sys.modules["__main__"])
+                return fn(*args)
+
+        self.assertEqual(pow_module._submit(FakeExecutor(), len, "abc"), 3)
+        self.assertIsNot(seen[0], main_module)
+        self.assertIsNone(getattr(seen[0], "__file__", None))
+        self.assertIs(sys.modules["__main__"], main_module)
+
+    def test_solver_pool_reuse_and_rebuild(self):
+        """求解器实例被复用，内存超限的实例用完后丢弃"""
+        from core.pow import WasmSolverPool
+
+        pool = WasmSolverPool(max_idle=2)
+        solver = pool.acquire()
+        self.assertIsNone(solver.solve("0" * 64, "salt_1_", 1000))
+        pool.release(solver)
+        self.assertIs(pool.acquire(), solver)
+        self.assertEqual(solver.solves, 1)
+
+        pool.max_memory = 0
+        pool.release(solver)
+        self.assertIsNot(pool.acquire(), solver)
+        stats = pool.stats()
+        self.assertEqual(stats["created"], 2)
+        self.assertEqual(stats["reused"], 1)
+        self.assertEqual(stats["rebuilt"], 1)
+
+    def test_pow_solver_rejects_when_queue_full(self):
+        """排队任务超过上限时拒绝新任务，并记录求解耗时"""
+        import asyncio
+        from unittest import mock
+        from core.config import CONFIG
+        from core.pow import PowSolver, PowQueueFullError
+
+        challenge = {
+            "algorithm": "DeepSeekHashV1", "challenge": "0" * 64, "salt": "s",
+            "difficulty": 1000, "expire_at": 1, "signature": "x", "target_path": "/p",
+        }
+        solver = PowSolver()
+
+        async def run():
+            return await asyncio.gather(
+                *[solver.solve(challenge) for _ in range(3)], return_exceptions=True
+            )
+
+        with mock.patch.dict(CONFIG, {"pow_solver": {"backend": "thread", "max_queue": 1}}):
+            results = asyncio.run(run())
+            stats = solver.stats()
+
+        self.assertIsNone(results[0])
+        self.assertTrue(all(isinstance(r, PowQueueFullError) for r in results[1:]))
+        self.assertEqual(stats["backend"], "thread")
+        self.assertEqual(stats["solved"], 1)
+        self.assertEqual(stats["rejected"], 2)
+        self.assertGreater(stats["last_solve_ms"], 0)
+
+    def test_pow_cache_expiry(self):
+        """PoW 缓存丢弃即将过期和 token 不匹配的条目"""
+        import time
+        from collections import deque
+        from core.pow import PowCache
+
+        cache = PowCache()
+        now = time.time()
+        cache._cache["a@example.com"] = deque([
+            ("stale", "tok", now + 1),
+            ("other-token", "old", now + 600),
+            ("fresh", "tok", now + 600),
+        ])
+
+        self.assertEqual(cache.take("a@example.com", "tok"), "fresh")
+        self.assertIsNone(cache.take("a@example.com", "tok"))
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["expired"], 1)
+        self.assertEqual(stats["invalidated"], 1)
+
+    def test_expire_seconds(self):
+        """expire_at 支持秒和毫秒"""
+        from core.pow import _expire_seconds
+
+        self.assertEqual(_expire_seconds(1700000000), 1700000000)
+        self.assertEqual(_expire_seconds(1700000000000), 1700000000)
+        self.assertEqual(_expire_seconds(None), 0.0)
+
+    def test_get_pow_once_status_fallback(self):
+        """PoW 接口返回非 JSON 的 403/429 时以 HTTP 状态码作为错误码，200 但缺少挑战时不返回错误码"""
+        import asyncio
+        from types import SimpleNamespace
+        from unittest import mock
+        from core import pow as pow_module
+
+        request = SimpleNamespace(state=SimpleNamespace(
+            use_config_token=False, account=None, deepseek_token="tok",
+        ))
+        cases = ((429, {}, 429), (403, {"code": 40003}, 40003), (200, {"code": 0}, None), (200, {}, None))
+        for status, data, expected in cases:
+            fetch = mock.AsyncMock(return_value=(status, data))
+            with mock.patch.object(pow_module, "fetch_pow_challenge", fetch), \
+                    mock.patch.object(pow_module.pow_solver, "warm_up", lambda: None):
+                header, code, _ = asyncio.run(pow_module.get_pow_once(request))
+            self.assertIsNone(header)
+            self.assertEqual(code, expected)
+
+    def test_prefetch_skips_blocked_accounts(self):
+        """PoW 预取跳过熔断中的活跃账号"""
+        import asyncio
+        import time
+        from unittest import mock
+        from core import pow as pow_module
+        from core.auth import account_scheduler
+
+        cache = pow_module.PowCache()
+        cache._active = {"a": time.time(), "b": time.time()}
+        filled = []
+
+        async def fill(account, cfg, sem):
+            filled.append(account["email"])
+
+        accounts = [{"email": "a", "token": "ta"}, {"email": "b", "token": "tb"}]
+        with mock.patch.dict(pow_module.CONFIG, {"accounts": accounts}), \
+                mock.patch.object(cache, "_fill_account", fill), \
+                mock.patch.object(account_scheduler, "is_blocked", lambda acc_id: acc_id == "a"):
+            asyncio.run(cache._prefetch_round(pow_module._prefetch_config()))
+        self.assertEqual(filled, ["b"])
+
     def test_get_account_identifier(self):
         """测试账号标识获取"""
         from core.utils import get_account_identifier
@@ -173,6 +380,118 @@ class TestPow(unittest.TestCase):
         self.assertEqual(get_account_identifier(account3), "test@example.com")
 
 
+class TestUpstreamSessionPool(unittest.TestCase):
+    """上游会话池测试"""
+
+    def test_reuse_same_key(self):
+        """同一账号复用同一个会话"""
+        import asyncio
+        from core.http_pool import UpstreamSessionPool
+
+        async def run():
+            pool = UpstreamSessionPool(max_size=4, idle_timeout=60)
+            s1 = pool.get("a@example.com")
+            s2 = pool.get("a@example.com")
+            s3 = pool.get("b@example.com")
+            stats = pool.stats()
+            await pool.close_all()
+            return s1, s2, s3, stats
+
+        s1, s2, s3, stats = asyncio.run(run())
+        self.assertIs(s1, s2)
+        self.assertIsNot(s1, s3)
+        self.assertEqual(stats["created"], 2)
+        self.assertEqual(stats["reused"], 1)
+
+    def test_capacity_eviction(self):
+        """超过容量时淘汰最久未使用的会话"""
+        import asyncio
+        from core.http_pool import UpstreamSessionPool
+
+        async def run():
+            pool = UpstreamSessionPool(max_size=2, idle_timeout=60)
+            first = pool.get("a")
+            pool.get("b")
+            pool.get("c")
+            again = pool.get("a")
+            stats = pool.stats()
+            await asyncio.sleep(0)
+            await pool.close_all()
+            return first, again, stats
+
+        first, again, stats = asyncio.run(run())
+        self.assertIsNot(first, again)
+        self.assertEqual(stats["sessions"], 2)
+        self.assertGreaterEqual(stats["evicted"], 2)
+
+
+class TestSessionStock(unittest.TestCase):
+    """会话预热库存测试"""
+
+    def test_take_checks_token_and_ttl(self):
+        """token 变化或过期的会话不会被取出"""
+        import time
+        from collections import deque
+        from core.session_stock import ChatSessionStock, SESSION_PREWARM_TTL
+
+        stock = ChatSessionStock()
+        now = time.time()
+        stock._stock["a@example.com"] = deque([
+            ("old-token-session", "old", now),
+            ("expired-session", "tok", now - SESSION_PREWARM_TTL - 1),
+            ("good-session", "tok", now),
+        ])
+
+        self.assertEqual(stock.take("a@example.com", "tok"), "good-session")
+        self.assertIsNone(stock.take("a@example.com", "tok"))
+
+        stats = stock.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["expired"], 1)
+        self.assertEqual(stats["invalidated"], 1)
+
+    def test_invalidate(self):
+        """invalidate 清空账号库存"""
+        import time
+        from collections import deque
+        from core.session_stock import ChatSessionStock
+
+        stock = ChatSessionStock()
+        stock._stock["a@example.com"] = deque([("s1", "tok", time.time())])
+        stock.invalidate("a@example.com")
+        self.assertIsNone(stock.take("a@example.com", "tok"))
+
+    def test_fill_only_active_unblocked_accounts(self):
+        """只为最近取用过且未熔断的账号补货，不再活跃的账号清空库存"""
+        import asyncio
+        import time
+        from collections import deque
+        from unittest.mock import patch
+        from core import session_stock as stock_module
+        from core.auth import account_scheduler
+
+        accounts = [{"email": f"{name}@example.com", "password": "p", "token": "tok"} for name in "abc"]
+        stock = stock_module.ChatSessionStock()
+        stock._active = {"a@example.com": time.time(), "b@example.com": time.time(), "c@example.com": 0}
+        stock._stock["c@example.com"] = deque([("old", "tok", time.time())])
+        created = []
+
+        async def create(acc_id, token):
+            created.append(acc_id)
+            return f"s{len(created)}"
+
+        cfg = {**stock_module._prewarm_config(), "size": 1}
+        with patch.dict(stock_module.CONFIG, {"accounts": accounts}), \
+                patch.object(stock, "_create", create), \
+                patch.object(account_scheduler, "is_blocked", lambda acc_id: acc_id == "b@example.com"):
+            asyncio.run(stock._fill_round(cfg))
+
+        self.assertEqual(created, ["a@example.com"])
+        self.assertNotIn("c@example.com", stock._active)
+        self.assertEqual(stock.stats()["stock"], {"a@example.com": 1})
+
+
 class TestSessionManager(unittest.TestCase):
     """会话管理器模块测试"""
 
@@ -210,6 +529,75 @@ class TestSessionManager(unittest.TestCase):
         self.assertIsNone(thinking)
         self.assertIsNone(search)
 
+    def test_prepare_upstream_call_failover(self):
+        """切换账号后会话和 PoW 两路都用新账号重做"""
+        import asyncio
+        from types import SimpleNamespace
+        from unittest import mock
+        from core import session_manager
+
+        request = SimpleNamespace(state=SimpleNamespace(
+            use_config_token=True, account={"email": "a"}, deepseek_token="ta",
+        ))
+        calls = []
+
+        async def create_once(req):
+            calls.append(("session", req.state.account["email"]))
+            if req.state.account["email"] == "a":
+                return None, 40301, "rate limited"
+            return "sid-b", 0, ""
+
+        async def pow_once(req):
+            calls.append(("pow", req.state.account["email"]))
+            return f"pow-{req.state.account['email']}", 0, ""
+
+        async def switch(req, caller):
+            req.state.account = {"email": "b"}
+            req.state.deepseek_token = "tb"
+            return True
+
+        with mock.patch.object(session_manager, "_create_session_once", create_once), \
+                mock.patch.object(session_manager, "get_pow_once", pow_once), \
+                mock.patch.object(session_manager, "switch_account", switch):
+            result = asyncio.run(session_manager.prepare_upstream_call(request))
+
+        self.assertEqual(result, ("sid-b", "pow-b"))
+        self.assertIn(("session", "b"), calls)
+        self.assertIn(("pow", "b"), calls)
+
+    def test_prepare_upstream_call_local_failure(self):
+        """PoW 本地求解失败不上报账号健康度，退避后用同一账号重试"""
+        import asyncio
+        from types import SimpleNamespace
+        from unittest import mock
+        from core import session_manager
+
+        request = SimpleNamespace(state=SimpleNamespace(
+            use_config_token=True, account={"email": "a"}, deepseek_token="ta",
+        ))
+        pow_results = iter([(None, 0, "solver busy"), (None, None, "timeout"), ("pow-a", 0, "")])
+
+        async def create_once(req):
+            return "sid-a", 0, ""
+
+        async def pow_once(req):
+            return next(pow_results)
+
+        sleep = mock.AsyncMock()
+        switch = mock.AsyncMock()
+        report = mock.Mock()
+        with mock.patch.object(session_manager, "_create_session_once", create_once), \
+                mock.patch.object(session_manager, "get_pow_once", pow_once), \
+                mock.patch.object(session_manager, "switch_account", switch), \
+                mock.patch.object(session_manager, "report_upstream_result", report), \
+                mock.patch.object(session_manager.asyncio, "sleep", sleep):
+            result = asyncio.run(session_manager.prepare_upstream_call(request))
+
+        self.assertEqual(result, ("sid-a", "pow-a"))
+        self.assertEqual(sleep.await_count, 2)
+        switch.assert_not_awaited()
+        report.assert_not_called()
+
 
 class TestAuth(unittest.TestCase):
     """认证模块测试"""
@@ -222,6 +610,494 @@ class TestAuth(unittest.TestCase):
         keys = CONFIG.get("keys", [])
         self.assertIsInstance(keys, list)
 
+    def test_scheduler_round_robin(self):
+        """有 token 的账号优先，释放后放回队尾，排除列表中的账号被跳过"""
+        from core.auth import AccountScheduler
+
+        scheduler = AccountScheduler()
+        scheduler.reset([
+            {"email": "a", "token": "ta"},
+            {"email": "b", "token": ""},
+            {"email": "c", "token": "tc"},
+            {"email": "a", "token": "dup"},
+            {"token": "no-id"},
+        ])
+        self.assertEqual(scheduler.available_count(), 3)
+
+        acc_id, account, needs_login, _ = scheduler.acquire()
+        self.assertEqual((acc_id, needs_login), ("a", False))
+        self.assertTrue(scheduler.release(account))
+        self.assertFalse(scheduler.release(account))
+
+        self.assertEqual(scheduler.acquire({"c"})[0], "a")
+        self.assertEqual(scheduler.acquire()[0], "c")
+        self.assertEqual(scheduler.acquire()[:3:2], ("b", True))
+        self.assertIsNone(scheduler.acquire())
+        self.assertEqual(sorted(scheduler.snapshot()["in_use_accounts"]), ["a", "b", "c"])
+
+    def test_scheduler_concurrency_slots(self):
+        """账号按槽位并发使用，优先选择负载最低的账号"""
+        from unittest import mock
+        from core.auth import AccountScheduler
+        from core.config import CONFIG
+
+        scheduler = AccountScheduler()
+        with mock.patch.dict(CONFIG, {"account_max_concurrency": 2}):
+            scheduler.reset([
+                {"email": "a", "token": "ta"},
+                {"email": "b", "token": "tb", "max_concurrency": 1},
+            ])
+
+        a = scheduler.acquire()
+        self.assertEqual(a[0], "a")
+        self.assertEqual(scheduler.acquire()[0], "b")
+        self.assertEqual(scheduler.acquire()[0], "a")
+        self.assertIsNone(scheduler.acquire())
+
+        snapshot = scheduler.snapshot()
+        self.assertEqual(snapshot["slots"]["a"], {"in_use": 2, "max": 2})
+        self.assertEqual((snapshot["slots_in_use"], snapshot["slots_total"]), (3, 3))
+
+        self.assertTrue(scheduler.release(a[1]))
+        self.assertEqual(scheduler.snapshot()["slots"]["a"]["in_use"], 1)
+        self.assertEqual(scheduler.acquire()[0], "a")
+
+    def test_scheduler_token_cleared_while_queued(self):
+        """排队期间 token 被清除的账号转入待登录队列"""
+        from core.auth import AccountScheduler
+
+        scheduler = AccountScheduler()
+        first = {"email": "a", "token": "ta"}
+        scheduler.reset([first, {"email": "b", "token": "tb"}])
+        first["token"] = ""
+
+        self.assertEqual(scheduler.acquire()[0], "b")
+        self.assertEqual(scheduler.acquire()[::2], ("a", True))
+
+    def test_scheduler_wait_queue_handoff(self):
+        """所有账号都忙时排队，释放的账号按先后顺序直接交给等待者"""
+        import asyncio
+        from core.auth import AccountScheduler
+
+        scheduler = AccountScheduler()
+        scheduler.reset([{"email": "a", "token": "ta"}])
+
+        async def run():
+            held = await scheduler.acquire_wait(1, 8)
+            first = asyncio.create_task(scheduler.acquire_wait(1, 8))
+            second = asyncio.create_task(scheduler.acquire_wait(1, 8))
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.wait_queue_status()["waiting"], 2)
+
+            scheduler.release(held[1])
+            got = await first
+            self.assertEqual(got[0], "a")
+            self.assertFalse(second.done())
+            scheduler.release(got[1])
+            self.assertEqual((await second)[0], "a")
+
+        asyncio.run(run())
+        status = scheduler.wait_queue_status()
+        self.assertEqual((status["waiting"], status["served"]), (0, 2))
+
+    def test_scheduler_wait_queue_timeout_and_limit(self):
+        """等待超时返回 None 并归还后到的槽位；队列满时直接拒绝"""
+        import asyncio
+        from core.auth import AccountScheduler
+
+        scheduler = AccountScheduler()
+        scheduler.reset([{"email": "a", "token": "ta"}])
+
+        async def run():
+            held = await scheduler.acquire_wait(1, 1)
+            waiter = asyncio.create_task(scheduler.acquire_wait(0.05, 1))
+            await asyncio.sleep(0)
+            self.assertIsNone(await scheduler.acquire_wait(1, 1))
+            self.assertIsNone(await waiter)
+            scheduler.release(held[1])
+            self.assertEqual(scheduler.available_count(), 1)
+
+        asyncio.run(run())
+        status = scheduler.wait_queue_status()
+        self.assertEqual((status["timeouts"], status["rejected"]), (1, 1))
+        self.assertIsNone(asyncio.run(AccountScheduler().acquire_wait(1, 8)))
+
+    def test_scheduler_priority_classes(self):
+        """interactive 优先拿到释放的账号，batch 保留最低份额；同类按权重公平排队"""
+        import asyncio
+        from unittest import mock
+        from core import auth
+
+        scheduler = auth.AccountScheduler()
+        scheduler.reset([{"email": "a", "token": "ta"}])
+        order, results = [], []
+
+        async def wait(key, priority, weight=1.0):
+            results.append(await scheduler.acquire_wait(5, 64, key=key, priority=priority, weight=weight))
+            order.append(key)
+
+        async def run():
+            held = await scheduler.acquire_wait(1, 64)
+            tasks = [asyncio.create_task(wait("b", "batch")) for _ in range(2)]
+            tasks += [asyncio.create_task(wait("heavy", "interactive", 2)) for _ in range(4)]
+            tasks += [asyncio.create_task(wait("light", "interactive")) for _ in range(2)]
+            await asyncio.sleep(0)
+            for served in range(len(tasks)):
+                scheduler.release(held[1], held[3])
+                while len(results) == served:
+                    await asyncio.sleep(0)
+                held = results[-1]
+            scheduler.release(held[1], held[3])
+
+        with mock.patch.dict(auth.CONFIG, {"account_queue": {"batch_share": 0.25}}):
+            asyncio.run(run())
+        # 每 4 次交付中 batch 分得 1 次；interactive 内 heavy 权重为 2，交付次数是 light 的两倍
+        self.assertEqual(order, ["heavy", "heavy", "light", "b", "heavy", "heavy", "light", "b"])
+        classes = scheduler.wait_queue_status()["classes"]
+        self.assertEqual(classes["batch"]["queued"], 2)
+        self.assertEqual(classes["interactive"]["requests"], 7)
+        self.assertGreater(classes["batch"]["avg_wait_ms"], 0)
+
+    def test_scheduler_least_latency(self):
+        """least_latency 策略在两个候选中选择健康分更好的账号，未探测的账号优先"""
+        from unittest.mock import patch
+        from core.auth import AccountScheduler
+
+        scheduler = AccountScheduler()
+        scheduler.reset([{"email": e, "token": "t"} for e in ("slow", "fast", "flaky")])
+        scheduler.record_upstream("slow", True, 4.0)
+        scheduler.record_upstream("fast", True, 0.5)
+        scheduler.record_upstream("flaky", True, 0.5)
+        scheduler.record_upstream("flaky", False)
+
+        health = scheduler.health["fast"]
+        scheduler.record_upstream("fast", True, 1.5)
+        self.assertAlmostEqual(health.ttfb, 0.8)
+        self.assertEqual(scheduler.health["flaky"].error_rate, 0.3)
+
+        with patch.dict("core.auth.CONFIG", {"account_strategy": "least_latency"}):
+            picks = []
+            for _ in range(4):
+                acc_id, account, _, _ = scheduler.acquire()
+                picks.append(acc_id)
+                scheduler.release(account)
+            self.assertEqual(picks.count("slow"), 0)
+            self.assertEqual(scheduler.snapshot()["strategy"], "least_latency")
+
+            scheduler.record_login("fast", False)
+            scheduler.reset([{"email": e, "token": "t"} for e in ("fast", "new")])
+            self.assertEqual(scheduler.acquire()[0], "new")
+            self.assertNotIn("slow", scheduler.snapshot()["health"])
+
+        # 默认轮询策略不受健康分影响
+        scheduler.reset([{"email": e, "token": "t"} for e in ("slow", "fast")])
+        self.assertEqual(scheduler.acquire()[0], "slow")
+
+    def test_report_upstream_result_ignores_local_failures(self):
+        """没有错误码的失败（本地 PoW 失败、网络异常）不计入账号健康度"""
+        import time
+        from types import SimpleNamespace
+        from unittest.mock import patch
+        from core.auth import AccountScheduler, report_upstream_result
+
+        scheduler = AccountScheduler()
+        request = SimpleNamespace(state=SimpleNamespace(
+            use_config_token=True, account={"email": "a"}, upstream_started=time.monotonic()
+        ))
+        with patch("core.auth.account_scheduler", scheduler):
+            report_upstream_result(request, False)
+            self.assertNotIn("a", scheduler.health)
+            report_upstream_result(request, False, 500)
+            self.assertEqual(scheduler.health["a"].error_rate, 1.0)
+            self.assertEqual(scheduler.health["a"].ttfb, 0.0)
+            report_upstream_result(request, True)
+            self.assertGreater(scheduler.health["a"].ttfb, 0.0)
+
+    def test_scheduler_circuit_breaker(self):
+        """连续失败或限流状态码熔断账号，冷却后探测成功才恢复调度"""
+        import asyncio
+        from unittest.mock import AsyncMock, patch
+        from core.auth import AccountScheduler, BreakerProber
+
+        scheduler = AccountScheduler()
+        accounts = [{"email": "a", "token": "ta"}, {"email": "b", "token": "tb"}]
+        with patch.dict("core.auth.CONFIG", {"account_breaker": {"cooldown": 0}}):
+            scheduler.reset(accounts)
+            held = scheduler.acquire()
+            self.assertFalse(scheduler.record_upstream("a", False, code=500))
+            scheduler.record_upstream("a", True, 0.1)  # 成功后连续失败计数清零
+            self.assertFalse(scheduler.record_upstream("a", False))
+            self.assertFalse(scheduler.record_upstream("a", False))
+            self.assertTrue(scheduler.record_upstream("a", False))
+
+            # 熔断账号释放后不再放回队列
+            scheduler.release(held[1])
+            second = scheduler.acquire()
+            self.assertEqual(second[0], "b")
+            self.assertIsNone(scheduler.acquire())
+            self.assertEqual(scheduler.snapshot()["breakers"]["a"]["state"], "open")
+
+            # 熔断状态跨重载保留
+            scheduler.reset(accounts)
+            self.assertTrue(scheduler.record_upstream("b", False, code=429))
+            self.assertIsNone(scheduler.acquire())
+
+            # 第一次探测失败的账号继续熔断，下一轮探测成功后恢复
+            prober = BreakerProber(scheduler)
+            results = iter([False, True, True])
+            with patch("core.auth.session_stock.probe", AsyncMock(side_effect=lambda *_: next(results))):
+                for acc_id, account in scheduler.due_probes():
+                    asyncio.run(prober.probe(acc_id, account))
+                self.assertEqual(len(scheduler.snapshot()["blocked_accounts"]), 1)
+                for acc_id, account in scheduler.due_probes():
+                    asyncio.run(prober.probe(acc_id, account))
+
+        self.assertEqual(prober.stats()["recovered"], 2)
+        self.assertEqual([b.trips for b in scheduler.breakers.values()], [1, 1])
+        scheduler.release(second[1], second[3])  # 重载前借出的租约仍然有效
+        self.assertEqual(sorted(scheduler.acquire()[0] for _ in range(2)), ["a", "b"])
+
+
+    def test_scheduler_leases(self):
+        """按租约归还账号：重复归还无效，租约跨重载保留，超时租约被回收并计数"""
+        from unittest.mock import patch
+        from core.auth import AccountScheduler
+
+        scheduler = AccountScheduler()
+        accounts = [{"email": "a", "token": "ta", "max_concurrency": 2}]
+        scheduler.reset(accounts)
+        first = scheduler.acquire(owner="/v1/chat/completions@1.2.3.4")
+        second = scheduler.acquire()
+        self.assertNotEqual(first[3], second[3])
+        self.assertEqual(scheduler.snapshot()["leases"]["items"][0]["owner"], "/v1/chat/completions@1.2.3.4")
+
+        self.assertTrue(scheduler.release(first[1], first[3]))
+        self.assertFalse(scheduler.release(first[1], first[3]))
+        self.assertEqual(scheduler.snapshot()["slots"]["a"]["in_use"], 1)
+
+        # 重载配置（新的账号字典）后未归还的租约仍然占用槽位
+        scheduler.reset([dict(accounts[0])])
+        self.assertEqual(scheduler.snapshot()["slots"]["a"]["in_use"], 1)
+        self.assertEqual(scheduler.acquire()[0], "a")
+        self.assertIsNone(scheduler.acquire())
+
+        with patch("core.auth.time.monotonic", return_value=scheduler.leases[second[3]].expires_at + 1):
+            reaped = scheduler.reap_expired()
+        self.assertEqual(len(reaped), 2)
+        self.assertFalse(scheduler.release(second[1], second[3]))
+        leases = scheduler.snapshot()["leases"]
+        self.assertEqual((leases["active"], leases["leaked"], leases["stale_releases"]), (0, 2, 2))
+        self.assertEqual(scheduler.acquire()[0], "a")
+
+    def test_shared_account_pool(self):
+        """共享账号池：多个调度器不会超额占用同一账号，token 在调度器之间同步"""
+        import tempfile
+        from core.account_pool import SqlitePoolBackend
+        from core.auth import AccountScheduler
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "pool.sqlite3")
+            first = AccountScheduler(SqlitePoolBackend(path))
+            second = AccountScheduler(SqlitePoolBackend(path))
+            first.reset([{"email": "a", "token": "ta"}, {"email": "b", "token": ""}])
+            second.reset([{"email": "a", "token": "ta"}, {"email": "b", "token": ""}])
+
+            held = first.acquire()
+            self.assertEqual(held[0], "a")
+            # a 的唯一槽位已被另一个调度器占用，只能选需要登录的 b
+            login = second.acquire()
+            self.assertEqual(login[::2], ("b", True))
+            self.assertIsNone(second.acquire())
+            self.assertEqual(second.backend.stats()["conflicts"], 2)
+
+            first.release(held[1], held[3])
+            self.assertEqual(second.acquire()[0], "a")
+
+            second.release(login[1], login[3])
+            first.backend.put_token("b", "tb")
+            self.assertEqual(first.sync_shared(), ["b"])
+            self.assertEqual(first.acquire()[::2], ("b", False))
+            first.backend.drop_token("b", "tb")
+            self.assertEqual(second.backend.get_token("b"), "")
+
+    def test_shared_pool_file_permissions(self):
+        """共享账号池文件保存明文 token，目录和文件只允许当前用户访问"""
+        import stat
+        import tempfile
+        from core.account_pool import SqlitePoolBackend
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "pool", "pool.sqlite3")
+            SqlitePoolBackend(path).put_token("a", "ta")
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode), 0o700)
+            for name in (path, f"{path}-wal", f"{path}-shm"):
+                self.assertEqual(stat.S_IMODE(os.stat(name).st_mode), 0o600, name)
+
+    def test_shared_pool_reserve_outside_lock(self):
+        """共享账号池的登记在账号池执行器中进行，不持有调度器锁；其他 worker 已占满时换账号"""
+        import asyncio
+        import tempfile
+        from unittest.mock import patch
+        from core.account_pool import SqlitePoolBackend
+        from core.auth import AccountScheduler
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "pool.sqlite3")
+            first = AccountScheduler(SqlitePoolBackend(path))
+            second = AccountScheduler(SqlitePoolBackend(path))
+            accounts = [{"email": "a", "token": "ta"}, {"email": "b", "token": "tb"}]
+            first.reset(accounts)
+            second.reset([dict(account) for account in accounts])
+            held = first.acquire()
+
+            locked = []
+            reserve = second.backend.reserve
+
+            def checked_reserve(*args):
+                locked.append(second._lock.locked())
+                return reserve(*args)
+
+            with patch.object(second.backend, "reserve", checked_reserve):
+                result = asyncio.run(second.acquire_wait(0, 8))
+
+            self.assertEqual(result[0], "b")
+            self.assertEqual(locked, [False, False])
+            self.assertEqual(second.snapshot()["leases"]["granted"], 1)
+            self.assertEqual(second.snapshot()["available_accounts"], ["a"])
+            first.release(held[1], held[3])
+            second.release(result[1], result[3])
+
+    def test_login_single_flight(self):
+        """同一账号的并发登录只发出一次请求，配置写回不阻塞事件循环"""
+        import asyncio
+        from unittest import mock
+        from core import deepseek
+
+        class FakeResp:
+            text = "ok"
+
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return {"code": 0, "data": {"biz_code": 0, "biz_data": {"user": {"token": "new"}}}}
+
+        posts = []
+
+        async def post(*args, **kwargs):
+            posts.append(kwargs["json"]["email"])
+            await asyncio.sleep(0.01)
+            return FakeResp()
+
+        session = mock.Mock(post=post)
+        first = {"email": "a@x.com", "password": "p", "token": ""}
+        reloaded = dict(first)  # 配置重载后同一账号的另一个字典
+
+        async def run():
+            return await asyncio.gather(
+                deepseek.login_deepseek_via_account(first),
+                deepseek.login_deepseek_via_account(reloaded),
+            )
+
+        with mock.patch.object(deepseek, "get_upstream_session", return_value=session), \
+                mock.patch.object(deepseek, "save_config_async", mock.AsyncMock()) as save:
+            self.assertEqual(asyncio.run(run()), ["new", "new"])
+        self.assertEqual(posts, ["a@x.com"])
+        self.assertEqual(save.await_count, 1)
+        self.assertEqual((first["token"], reloaded["token"]), ("new", "new"))
+
+    def test_token_refresher(self):
+        """后台登录没有 token 的空闲账号，登录后账号进入可用队列"""
+        import asyncio
+        from unittest import mock
+        from core import auth
+
+        scheduler = auth.AccountScheduler()
+        accounts = [{"email": "a", "token": ""}, {"email": "b", "token": ""}]
+        scheduler.reset(accounts)
+        refresher = auth.TokenRefresher(scheduler)
+
+        async def login(account):
+            if account["email"] == "b":
+                raise RuntimeError("bad password")
+            account["token"] = "ta"
+            return "ta"
+
+        with mock.patch.object(auth, "login_deepseek_via_account", login), \
+                mock.patch.object(auth, "account_scheduler", scheduler):
+            asyncio.run(refresher.refresh_once())
+
+        self.assertEqual(refresher.stats()["logins"], 1)
+        self.assertEqual(refresher.stats()["failures"], 1)
+        self.assertEqual(scheduler.acquire()[::2], ("a", False))
+        # 登录失败的账号被熔断，不再分配给请求
+        self.assertIsNone(scheduler.acquire())
+
+    def test_breaker_probe_login_publishes_token(self):
+        """探测前登录经过 login_account：token 写入共享池并记录登录结果"""
+        import asyncio
+        from unittest import mock
+        from core import auth
+
+        scheduler = auth.AccountScheduler()
+        scheduler.backend = mock.Mock(get_token=mock.Mock(return_value=""))
+        account = {"email": "a", "token": ""}
+
+        async def login(acc):
+            acc["token"] = "ta"
+            return "ta"
+
+        with mock.patch.object(auth, "login_deepseek_via_account", login), \
+                mock.patch.object(auth, "account_scheduler", scheduler), \
+                mock.patch.object(auth.session_stock, "probe", mock.AsyncMock(return_value=True)):
+            self.assertTrue(asyncio.run(auth.BreakerProber(scheduler).probe("a", account)))
+
+        scheduler.backend.put_token.assert_called_once_with("a", "ta")
+        self.assertEqual(scheduler.health["a"].samples, 1)
+
+    def test_key_limiter(self):
+        """按 key 限制请求速率、并发数和 token 额度，超限时返回带 Retry-After 的 429"""
+        from unittest import mock
+        from fastapi import HTTPException
+        from core import key_limits
+        from core.key_limits import KeyLimiter, _key_id
+
+        policies = {
+            "*": {"rpm": 2},
+            "busy": {"concurrency": 1},
+            "metered": {"rpm": 0, "token_budget": 100, "budget_window": 100},
+        }
+        limiter = KeyLimiter()
+        with mock.patch.dict(key_limits.CONFIG, {"key_policies": policies}):
+            limiter.admit("k")
+            limiter.admit("k")
+            with self.assertRaises(HTTPException) as ctx:
+                limiter.admit("k")
+            self.assertEqual(ctx.exception.status_code, 429)
+            self.assertEqual(ctx.exception.headers["Retry-After"], "30")
+
+            # 并发槽位归还后才能再次放行
+            limiter.admit("busy")
+            with self.assertRaises(HTTPException):
+                limiter.admit("busy")
+            limiter.leave("busy")
+            limiter.admit("busy")
+
+            limiter.admit("metered")
+            limiter.charge("metered", 150)
+            with self.assertRaises(HTTPException) as ctx:
+                limiter.admit("metered")
+            self.assertEqual(ctx.exception.headers["Retry-After"], "51")
+
+        stats = limiter.stats()
+        self.assertNotIn("busy", stats)  # 统计中不出现原始 key
+        self.assertEqual(stats[_key_id("k")]["rejected"]["rate"], 1)
+        self.assertEqual(stats[_key_id("busy")]["active"], 1)
+        self.assertEqual(stats[_key_id("busy")]["rejected"]["concurrency"], 1)
+        self.assertEqual(stats[_key_id("metered")]["tokens"], 150)
+        self.assertEqual(stats[_key_id("metered")]["rejected"]["budget"], 1)
+        self.assertEqual(_key_id("sk-0123456789abcdef")[:7], "sk-0...")
+
 
 class TestRegexPatterns(unittest.TestCase):
     """正则表达式测试"""
@@ -450,10 +1326,168 @@ class TestStreamParsing(unittest.TestCase):
         self.assertFalse(check_response_started(think_fragment))   # THINK 不触发
         self.assertTrue(check_response_started(response_fragment))  # RESPONSE 触发
 
+    def test_stream_decoder(self):
+        """解码器按任意字节边界输入都产出相同的事件，结束后忽略后续数据"""
+        from core.sse_parser import DeepSeekStreamDecoder
+
+        body = (
+            b'event: ready\ndata: {"request_message_id": 1}\n\n'
+            b'data: {"p": "response/fragments", "o": "APPEND", "v": [{"type": "THINK", "content": "\xe6\x80\x9d"}]}\n\n'
+            b'data: {"v": " more"}\r\n\r\n'
+            b'data: {"p": "response/search_results", "v": [{"url": "https://a", "title": "A"}]}\n\n'
+            b'data: {"p": "response/fragments", "o": "APPEND", "v": [{"type": "RESPONSE", "content": "Hi"}]}\n\n'
+            b'data: {"p": "response/status", "v": "FINISHED"}\n\n'
+            b'data: {"v": "ignored"}\n\n'
+        )
+        expected = [
+            ("thinking", "思"),
+            ("thinking", " more"),
+            ("search", [{"url": "https://a", "title": "A"}]),
+            ("text", "Hi"),
+            ("finished", ""),
+        ]
+        for size in (1, 7, len(body)):
+            decoder = DeepSeekStreamDecoder(thinking_enabled=True)
+            events = []
+            for i in range(0, len(body), size):
+                events.extend(decoder.feed(body[i:i + size]))
+            events.extend(decoder.close())
+            self.assertEqual(events, expected, size)
+
+        # 上游没有结束信号时，close 解码最后半行并补上 finished
+        decoder = DeepSeekStreamDecoder()
+        self.assertEqual(decoder.feed(b'data: {"v": "a"}\ndata: {"v": "b"}'), [("text", "a")])
+        self.assertEqual(decoder.close(), [("text", "b"), ("finished", "")])
+
+        # 非法字节只影响所在的行
+        decoder = DeepSeekStreamDecoder()
+        self.assertEqual(
+            decoder.feed(b'data: {"v": "\xff"}\ndata: {"v": "ok"}\ndata: [DONE]\n'),
+            [("text", "\ufffd"), ("text", "ok"), ("finished", "")],
+        )
+
+        decoder = DeepSeekStreamDecoder()
+        self.assertEqual(
+            decoder.feed(b'data: not json\ndata: {"code": "content_filter"}\ndata: {"v": "x"}\n'),
+            [("content_filter", "")],
+        )
+        self.assertEqual(decoder.close(), [])
+
+    def test_async_event_pipeline(self):
+        """异步流水线逐段产出事件，上游静默时由定时器产出 KEEPALIVE，提前结束时关闭上游"""
+        import asyncio
+        from core.sse_parser import KEEPALIVE, iter_deepseek_events, with_keepalive
+
+        class FakeResponse:
+            closed = False
+
+            def __init__(self, lines, delay=0.0):
+                self.lines = lines
+                self.delay = delay
+
+            async def aiter_content(self):
+                for line in self.lines:
+                    yield line + b"\n\n"
+                    await asyncio.sleep(self.delay)
+
+            async def aclose(self):
+                self.closed = True
+
+        lines = [
+            b'data: {"p": "response/fragments", "o": "APPEND", "v": [{"type": "THINK", "content": "hmm"}]}',
+            b'data: {"v": " more"}',
+            b'data: {"p": "response/fragments", "o": "APPEND", "v": [{"type": "RESPONSE", "content": "Hi"}]}',
+            b'data: {"p": "response/status", "v": "FINISHED"}',
+            b'data: {"v": "ignored"}',
+        ]
+
+        async def collect(response, interval):
+            return [item async for item in with_keepalive(iter_deepseek_events(response, True), interval)]
+
+        response = FakeResponse(lines)
+        items = asyncio.run(collect(response, 1))
+        self.assertEqual(
+            items, [("thinking", "hmm"), ("thinking", " more"), ("text", "Hi"), ("finished", "")]
+        )
+        self.assertTrue(response.closed)
+
+        slow = FakeResponse(lines[:2], delay=0.05)
+        self.assertEqual(asyncio.run(collect(slow, 0.02))[:2], [("thinking", "hmm"), KEEPALIVE])
+
+        filtered = FakeResponse([b'data: {"v": "a"}', b'data: {"code": "content_filter"}'])
+        self.assertEqual(asyncio.run(collect(filtered, 1)), [("thinking", "a"), ("content_filter", "")])
+
+        async def stop_early():
+            events = with_keepalive(iter_deepseek_events(hung, False), 0.01)
+            async for item in events:
+                if item is KEEPALIVE:
+                    break
+            await events.aclose()
+            await asyncio.sleep(0)
+
+        hung = FakeResponse([b'data: {"v": "a"}'], delay=10)
+        asyncio.run(stop_early())
+        self.assertTrue(hung.closed)
+
 
 class TestToolCallParsing(unittest.TestCase):
     """工具调用解析测试"""
 
+    def _claude_stream_blocks(self, events: list) -> list:
+        """用给定的上游事件走一遍 Claude 流式响应，返回 [(事件类型, 块索引, 块类型)]"""
+        import asyncio
+        from types import SimpleNamespace
+        from unittest import mock
+        from routes import claude
+
+        async def fake_events(resp, thinking_enabled):
+            for event_type, content in events:
+                yield event_type, content
+
+        async def request_json():
+            return {
+                "model": "claude-sonnet-4",
+                "stream": True,
+                "tools": [{"name": "get_weather", "input_schema": {"type": "object"}}],
+                "messages": [{"role": "user", "content": "weather?"}],
+            }
+
+        async def run():
+            request = SimpleNamespace(json=request_json, state=SimpleNamespace(thinking_enabled=False))
+            response = await claude.claude_messages(request)
+            return [chunk async for chunk in response.body_iterator]
+
+        with mock.patch.object(claude, "determine_mode_and_token", mock.AsyncMock()), \
+                mock.patch.object(claude, "call_claude_via_openai",
+                                  mock.AsyncMock(return_value=SimpleNamespace(status_code=200))), \
+                mock.patch.object(claude, "iter_deepseek_events", fake_events), \
+                mock.patch.object(claude, "close_response", mock.AsyncMock()):
+            chunks = asyncio.run(run())
+
+        blocks = []
+        for chunk in chunks:
+            event = json.loads(chunk[len("data: "):])
+            if event["type"] in ("content_block_start", "content_block_stop"):
+                block_type = event.get("content_block", {}).get("type")
+                blocks.append((event["type"], event["index"], block_type))
+        return blocks
+
+    def test_claude_stream_tool_block_index(self):
+        """流式响应中 tool_use 块的索引从 0 开始，排在已发送的文本块之后"""
+        from core.sse_parser import EVENT_TEXT
+
+        tool_call = '{"tool_calls": [{"name": "get_weather", "input": {"city": "SF"}}]}'
+        self.assertEqual(self._claude_stream_blocks([(EVENT_TEXT, tool_call)]), [
+            ("content_block_start", 0, "tool_use"),
+            ("content_block_stop", 0, None),
+        ])
+        self.assertEqual(self._claude_stream_blocks([(EVENT_TEXT, "Sure. "), (EVENT_TEXT, tool_call)]), [
+            ("content_block_start", 0, "text"),
+            ("content_block_stop", 0, None),
+            ("content_block_start", 1, "tool_use"),
+            ("content_block_stop", 1, None),
+        ])
+
     def test_parse_tool_calls_simple(self):
         """测试简单工具调用解析"""
         from core.sse_parser import parse_tool_calls
@@ -529,6 +1563,24 @@ class TestToolCallParsing(unittest.TestCase):
         # 应该返回空列表而不是抛出异常
         self.assertEqual(result, [])
 
+    def test_tool_call_sieve(self):
+        """流式筛选：普通文本立即放行，疑似工具调用的 JSON 暂存到确认为止"""
+        from core.sse_parser import ToolCallSieve
+
+        sieve = ToolCallSieve()
+        self.assertEqual(sieve.feed("Sure. "), "Sure. ")
+        self.assertEqual(sieve.feed("a {b} {\"tool"), "a {b} ")
+        # 暂存内容与 {"tool_calls": 不符时补发
+        self.assertEqual(sieve.feed("s\": 1}"), '{"tools": 1}')
+        self.assertEqual(sieve.flush(), "")
+
+        self.assertEqual(sieve.feed('{ "tool_calls" '), "")
+        self.assertFalse(sieve.capturing)
+        self.assertEqual(sieve.feed(': [{"name": "f"}]}'), "")
+        self.assertTrue(sieve.capturing)
+        self.assertEqual(sieve.feed(" trailing"), "")
+        self.assertEqual(sieve.flush(), '{ "tool_calls" : [{"name": "f"}]} trailing')
+
 
 class TestTokenEstimation(unittest.TestCase):
     """Token 估算测试"""
@@ -557,6 +1609,94 @@ class TestTokenEstimation(unittest.TestCase):
         self.assertGreater(result, 0)
 
 
+
+class TestTokenCounter(unittest.TestCase):
+    """Token 计数服务测试"""
+
+    def _word_tokenizer_dir(self, tmp_dir):
+        """生成一个按空白切词的最小 tokenizer.json"""
+        from tokenizers import Tokenizer, models, pre_tokenizers
+
+        tokenizer = Tokenizer(models.WordLevel({"[UNK]": 0}, unk_token="[UNK]"))
+        tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+        tokenizer.save(os.path.join(tmp_dir, "tokenizer.json"))
+        return tmp_dir
+
+    def test_heuristic_fallback(self):
+        """tokenizer 不可用时按中英文比例估算"""
+        import asyncio
+        from unittest import mock
+        from core.config import CONFIG
+        from core.utils import TokenCounter
+
+        counter = TokenCounter()
+        with mock.patch.dict(CONFIG, {"tokenizer": {"backend": "heuristic"}}):
+            self.assertEqual(counter.count("a" * 10), 3)
+            self.assertEqual(counter.count("你好世界"), 3)
+            self.assertEqual(counter.count(""), 0)
+            total = asyncio.run(counter.count_messages(
+                [{"role": "user", "content": "a" * 10}], system="a" * 10
+            ))
+            self.assertEqual(total, 3 + 3 + 2)
+
+    def test_cached_batch_and_stream(self):
+        """批量计数命中缓存，流式增量计数与整体计数一致"""
+        import asyncio
+        import tempfile
+        from unittest import mock
+        from core import config
+        from core.utils import TokenCounter
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.dict(config.CONFIG, {"tokenizer": {"backend": "fast"}}), \
+                mock.patch.object(config, "chat_tokenizer_dir", self._word_tokenizer_dir(tmp_dir)), \
+                mock.patch.object(config, "_tokenizer", None), \
+                mock.patch.object(config, "_tokenizer_backend", None):
+            counter = TokenCounter(cache_size=2)
+            self.assertEqual(counter.count_batch(["one two", "three", "one two"]), [2, 1, 2])
+            self.assertEqual(asyncio.run(counter.acount("one two")), 2)
+            self.assertEqual(counter.stats()["hits"], 1)
+
+            counter.count_batch(["a", "b c"])
+            self.assertEqual(counter.stats()["cached"], 2)
+
+            text = " ".join(f"word{i}" for i in range(200))
+            stream = counter.stream()
+            for i in range(0, len(text), 7):
+                stream.feed(text[i:i + 7])
+            self.assertEqual(stream.total(), 200)
+
+    def test_tokenizer_loads_off_event_loop(self):
+        """事件循环中不同步加载 tokenizer，加载完成前使用估算"""
+        import asyncio
+        import tempfile
+        from unittest import mock
+        from core import config
+        from core.utils import TokenCounter
+
+        async def run(counter):
+            first = await counter.acount("one two")
+            await counter._loading
+            second = await counter.acount("one two")
+            stream = counter.stream()
+            text = " ".join(f"word{i}" for i in range(200))
+            for i in range(0, len(text), 7):
+                stream.feed(text[i:i + 7])
+            return first, second, await stream.atotal()
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.dict(config.CONFIG, {"tokenizer": {"backend": "fast"}}), \
+                mock.patch.object(config, "chat_tokenizer_dir", self._word_tokenizer_dir(tmp_dir)), \
+                mock.patch.object(config, "_tokenizer", None), \
+                mock.patch.object(config, "_tokenizer_backend", None):
+            counter = TokenCounter()
+            self.assertFalse(counter.stats()["ready"])
+            first, second, streamed = asyncio.run(run(counter))
+            self.assertEqual(first, 3)  # 估算：7 个字符 * 0.3
+            self.assertEqual(second, 2)
+            self.assertEqual(streamed, 200)
+            self.assertTrue(counter.stats()["ready"])
+
 if __name__ == "__main__":
     # 设置环境变量避免配置警告
     os.environ.setdefault("DS2API_CONFIG_PATH", 